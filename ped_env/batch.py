@@ -0,0 +1,375 @@
+from typing import List, Optional
+
+import numpy as np
+
+from ped_env.envs import PedsMoveEnv, ExitLookup, Parser
+from ped_env.kinematic import KinematicWorld
+from ped_env.mdp import PedsRLHandlerWithForce, _COS_90
+from ped_env.objects import Person
+from ped_env.settings import TICKS_PER_SEC, ACTIONS_ARRAY
+from ped_env.utils.spatial import SpatialHash
+
+
+def _angle_to_x_axis(v: np.ndarray) -> np.ndarray:
+    """
+    functions.angle_between(identity, v)的数组版本，v为零向量时与其相同返回3π/2
+    """
+    norm = np.linalg.norm(v, axis=-1)
+    safe = np.where(norm > 0, norm, 1.0)
+    radian = np.arccos(np.clip(v[..., 0] / safe, -1.0, 1.0))
+    return np.where(v[..., 1] / safe <= 0, 2 * np.pi - radian, radian)
+
+
+class BatchPedsMoveEnv:
+    """
+    在同一张地图上同时仿真num_envs个相互独立的场景(随机种子不同)，所有场景的行人状态保存在形状为(B, N, 2)的数组中，
+    每个子步对所有场景做一次数组化的社会力积分，Python的开销由所有场景分摊。
+    行人的生成、团体的划分与出口的分配直接调用一个PedsMoveEnv(engine="numpy")模板，与PedsMoveEnv完全相同；
+    动力学与KinematicWorld相同(自驱动力、fij_force、fiw_force、半隐式欧拉积分与墙体推出)，
+    观察与奖励与PedsRLHandlerWithForce相同(最近行人按距离排序，与spatial_index=True时一致)。
+    与PedsMoveEnv的区别：follower距离leader超过2米时直接朝leader移动，leader到达出口后沿出口的方向场(FlowField)移动，
+    而不是逐个调用A*，因此轨迹与PedsMoveEnv不逐位相同。
+    接口与PedsMoveVecEnv相同，某个场景的所有智能体结束(或被截断)时自动重置，结束时的观察放在info["final_observation"]中
+    """
+    SPACING = 10.0  # 不同场景在空间哈希中沿x方向错开的距离(米)，大于任何相互作用的范围
+    DETECT_RANGE = 3.0
+
+    def __init__(self, terrain: str, num_envs: int, person_num=10, group_size=(1, 1), discrete=True,
+                 frame_skipping=8, maxStep=10000, disable_reward=False,
+                 r_move=-0.1, r_wait=-0.5, r_collision_person=-0.1, r_collision_wall=-2.0, r_reach=100):
+        """
+        :param num_envs: 同时仿真的场景数B
+        其余参数与PedsMoveEnv以及PedsRLHandlerWithForce相同
+        """
+        self.template = PedsMoveEnv(terrain, person_num, group_size, discrete=discrete, frame_skipping=frame_skipping,
+                                    maxStep=maxStep, engine="numpy", reuse_world=True, follower_flow_field=True)
+        self.terrain = self.template.terrain
+        self.num_envs = num_envs
+        self.discrete = discrete
+        self.frame_skipping = frame_skipping
+        self.maxStep = maxStep
+        self.disable_reward = disable_reward
+        self.r_move, self.r_wait, self.r_reach = r_move, r_wait, r_reach
+        self.r_collision_person, self.r_collision_wall = r_collision_person, r_collision_wall
+        self.possible_agents: List[str] = list(self.template.possible_agents)
+        self.observation_space = self.template.observation_spaces[self.possible_agents[0]]
+        self.action_space = self.template.action_spaces[self.possible_agents[0]]
+        self._obs_shape = self.observation_space.shape
+
+        # 静态数据：模板环境中墙体的候选表、出口查找表、各出口的方向场与出口格子
+        w, h = self.terrain.map.shape
+        self.map_shape = np.array([w, h])
+        self.world = None
+        parser = Parser.load(self.terrain.map, self.terrain.map_spawn)
+        self.exit_lookup = ExitLookup(parser.start_nodes_exit, self.terrain.width, self.terrain.height,
+                                      1 + Person.radius)
+        exit_types = [node[2] for node in parser.start_nodes_exit]
+        self.exit_points = np.array([node[:2] for node in parser.start_nodes_exit], dtype=np.float64).reshape(-1, 2)
+        self.exit_point_type = np.array(exit_types, dtype=np.int64)
+        self.flow_dir = np.zeros([max(exit_types, default=2) + 1, w, h, 2])
+        for i, exit_pos in enumerate(self.terrain.exits):
+            flow = self.template.path_finder.get_flow_field(exit_pos)
+            direction = flow.direction.astype(np.float64) * (flow.distance >= 0)[:, :, None]
+            norm = np.linalg.norm(direction, axis=2, keepdims=True)
+            self.flow_dir[i + 3] = np.divide(direction, norm, out=np.zeros_like(direction), where=norm > 0)
+
+        self.num_peds = None
+        self._rng = np.random.RandomState()
+
+    # ---------------------------- 重置 ----------------------------
+    def _allocate(self, n):
+        b, a = self.num_envs, len(self.possible_agents)
+        self.num_peds = n
+        self.pos = np.zeros([b, n, 2])
+        self.vec = np.zeros([b, n, 2])
+        self.desired_velocity = np.zeros([b, n])
+        self.exit_type = np.zeros([b, n], dtype=np.int64)
+        self.is_leader = np.zeros([b, n], dtype=bool)
+        self.leader_index = np.zeros([b, n], dtype=np.int64)  # 所在团体leader的编号
+        self.group_row = np.zeros([b, n], dtype=np.int64)  # 所在团体对应的动作行(与PedsMoveEnv中的str(group.id)相同)
+        self.agent_index = np.zeros([b, a], dtype=np.int64)  # 每个智能体对应的行人编号
+        self.active = np.zeros([b, n], dtype=bool)  # 未被移除
+        self.arrived = np.zeros([b, n], dtype=bool)  # 到达出口(is_done)
+        self.exit_in_step = np.full([b, n], -1, dtype=np.int64)
+        self.last_pos = np.zeros([b, n, 2])
+        self.step_in_env = np.zeros([b], dtype=np.int64)
+        self.obs = np.zeros((b, a) + self._obs_shape, dtype=np.float32)
+
+    def _reset_scenario(self, b, seed):
+        env = self.template
+        env.reset(seed=seed)
+        if self.world is None:
+            # 复用模板环境的物理世界中按地图方格预计算的静态夹具候选表
+            self.world = env.world
+        peds = env.peds
+        if self.num_peds is None:
+            self._allocate(len(peds))
+        assert len(peds) == self.num_peds, u"不同随机种子生成的行人数不同!"
+        index = {ped: i for i, ped in enumerate(peds)}
+        self.pos[b] = [(ped.getX, ped.getY) for ped in peds]
+        self.vec[b] = 0.0
+        self.desired_velocity[b] = env.state.desired_velocity[[ped.slot for ped in peds]]
+        self.exit_type[b] = [ped.exit_type for ped in peds]
+        self.is_leader[b] = [ped.is_leader for ped in peds]
+        groups = [env.ped_to_group_dic[ped] for ped in peds]
+        self.leader_index[b] = [index[group.leader] for group in groups]
+        self.group_row[b] = [group.id for group in groups]
+        self.agent_index[b] = [index[env.agents_dict[agent]] for agent in self.possible_agents]
+        self.active[b] = True
+        self.arrived[b] = False
+        self.exit_in_step[b] = -1
+        self.last_pos[b] = self.pos[b]
+        self.step_in_env[b] = 0
+
+    def reset(self, seed: Optional[int] = None) -> np.ndarray:
+        """
+        :param seed: 不为None时第i个场景使用seed + i作为随机种子，之后自动重置的种子由它派生
+        :return: 形状为(B, agent_count, *观察形状)的观察
+        """
+        self._rng = np.random.RandomState(seed)
+        for b in range(self.num_envs):
+            self._reset_scenario(b, None if seed is None else seed + b)
+        self._observe()
+        return self.obs.copy()
+
+    # ---------------------------- 仿真 ----------------------------
+    def step(self, actions):
+        """
+        :param actions: 形状为(B, agent_count)的离散动作或(B, agent_count, 2)的连续动作
+        :return: 观察(B, agent_count, ...)、奖励、是否结束、是否被截断(B, agent_count)与每个场景的info
+        """
+        actions = np.asarray(actions)
+        b, a = self.num_envs, len(self.possible_agents)
+        if self.discrete:
+            leader_dir = ACTIONS_ARRAY[actions.reshape(b, a)]
+            # 与follower使用的parse_discrete_action_one_hot相同，对每个动作取argmax
+            control_dir = ACTIONS_ARRAY[np.argmax(actions.reshape(b, a, -1), axis=-1)]
+        else:
+            leader_dir = control_dir = actions.reshape(b, a, 2).astype(np.float64)
+        rows = np.arange(b)[:, None]
+        directions = np.zeros([b, self.num_peds, 2])
+        directions[rows, self.agent_index] = leader_dir
+        follower_control = control_dir[rows, self.group_row]
+
+        for _ in range(self.frame_skipping):
+            self._sub_step(directions, follower_control)
+
+        # 到达出口的行人在本step结束时移除，与PedsMoveEnv相同
+        collide_agents, collide_walls = self._collisions()
+        leaders = self.agent_index
+        was_active = self.active[rows, leaders]
+        reached = was_active & self.arrived[rows, leaders]
+        self.active &= ~self.arrived
+        rewards = self._rewards(leaders, was_active, reached, collide_agents, collide_walls)
+        self.step_in_env += self.frame_skipping
+
+        all_arrived = ~np.any(self.active[rows, leaders], axis=1)
+        truncated = np.repeat((self.step_in_env > self.maxStep)[:, None], a, axis=1)
+        dones = np.repeat(all_arrived[:, None], a, axis=1) | truncated
+        self._observe()
+        obs = self.obs.copy()
+        infos = [{} for _ in range(b)]
+        for i in np.flatnonzero(dones[:, 0]):
+            infos[i]["final_observation"] = obs[i].copy()
+            self._reset_scenario(i, int(self._rng.randint(2 ** 31 - 1)))
+        if np.any(dones[:, 0]):
+            self._observe()
+            obs = self.obs.copy()
+        return obs, rewards, dones, truncated, infos
+
+    def _follower_directions(self, directions, follower_control):
+        """
+        set_follower_actions_batch的数组版本
+        """
+        rows = np.arange(self.num_envs)[:, None]
+        follower = self.active & ~self.is_leader
+        leader = self.leader_index
+        rel = self.pos[rows, leader] - self.pos
+        dis = np.linalg.norm(rel, axis=2)
+        leader_dir = np.divide(rel, dis[:, :, None], out=np.zeros_like(rel), where=dis[:, :, None] > 0)
+        leader_done = self.arrived[rows, leader] | ~self.active[rows, leader]
+
+        length_prod = np.linalg.norm(follower_control, axis=2) * np.linalg.norm(leader_dir, axis=2)
+        cos = (follower_control * leader_dir).sum(axis=2) / (length_prod + 1e-6)
+        mix_dir = np.where((cos < _COS_90)[:, :, None], -leader_dir * 0.2,
+                           Person.alpha * follower_control + (1 - Person.alpha) * leader_dir)
+        # 间距大于2米时直接朝leader移动，leader到达出口后沿出口的方向场移动
+        mix_dir = np.where((dis < 2)[:, :, None], mix_dir, leader_dir)
+        cell = np.clip(self.pos.astype(np.int64), 0, self.map_shape - 1)
+        exit_dir = self.flow_dir[self.exit_type, cell[:, :, 0], cell[:, :, 1]]
+        mix_dir = np.where(leader_done[:, :, None], exit_dir, mix_dir)
+        directions[follower] = mix_dir[follower]
+
+    def _sub_step(self, directions, follower_control):
+        """
+        所有场景的一个子步，与KinematicWorld.Step相同
+        """
+        self._follower_directions(directions, follower_control)
+        idx = np.flatnonzero(self.active.ravel())
+        if len(idx) == 0:
+            return
+        pos = self.pos.reshape(-1, 2)[idx]
+        vec = self.vec.reshape(-1, 2)[idx]
+        scenario = idx // self.num_peds
+        radius = Person.radius
+        sensor_radius = Person.radius + 1
+
+        # 自驱动力
+        d_v = directions.reshape(-1, 2)[idx] * self.desired_velocity.ravel()[idx, None]
+        force = (d_v - vec) * Person.mass / Person.tau
+
+        # 行人之间的排斥力，不同场景沿x方向错开，使得同一个空间哈希不会产生跨场景的近邻对
+        a, b, diff, dis = self._neighbour_pairs(pos, scenario, sensor_radius + radius)
+        group = scenario * self.num_peds + self.leader_index.ravel()[idx]
+        same_group = group[a] == group[b]
+        leader = self.is_leader.ravel()[idx]
+        fij = Person.A * np.exp((dis - 2 * radius) / Person.B)
+        fij = np.where(same_group, fij * 0.2, fij) * (dis < sensor_radius + radius)
+        force[:, 0] += np.bincount(a, weights=fij * ~(leader[a] & same_group) * diff[:, 0], minlength=len(idx))
+        force[:, 1] += np.bincount(a, weights=fij * ~(leader[a] & same_group) * diff[:, 1], minlength=len(idx))
+        force[:, 0] -= np.bincount(b, weights=fij * ~(leader[b] & same_group) * diff[:, 0], minlength=len(idx))
+        force[:, 1] -= np.bincount(b, weights=fij * ~(leader[b] & same_group) * diff[:, 1], minlength=len(idx))
+
+        # 行人与墙之间的排斥力
+        cand, rect_dis, center_diff = self.world.static_candidates(pos)
+        wall = self.world.static_wall_mask(cand) & (rect_dis < sensor_radius)
+        center_dis = (center_diff[:, :, 0] ** 2 + center_diff[:, :, 1] ** 2) ** 0.5
+        fiw = Person.A * np.exp((center_dis - radius - 0.5) / Person.B) * wall
+        force += (fiw[:, :, None] * center_diff).sum(axis=1)
+
+        # 半隐式欧拉积分
+        dt = 1 / TICKS_PER_SEC
+        vec = vec + force / Person.mass * dt
+        translation = vec * dt
+        length = np.linalg.norm(translation, axis=1)
+        scale = np.minimum(1.0, KinematicWorld.MAX_TRANSLATION / np.maximum(length, 1e-12))
+        vec *= scale[:, None]
+        pos = pos + translation * scale[:, None]
+        for _ in range(KinematicWorld.CLIP_ITERATIONS):
+            self._clip_walls(pos, vec, radius)
+        self.pos.reshape(-1, 2)[idx] = pos
+        self.vec.reshape(-1, 2)[idx] = vec
+
+        # 到达出口或离开地图
+        out_of_edge = np.any((pos < 0) | (pos >= self.map_shape), axis=1)
+        in_exit = self.exit_lookup.query(pos, self.exit_type.ravel()[idx])
+        arrived = (in_exit | out_of_edge) & ~self.arrived.ravel()[idx]
+        self.arrived.ravel()[idx[arrived]] = True
+        self.exit_in_step.ravel()[idx[arrived]] = self.step_in_env[scenario[arrived]]
+
+    def _neighbour_pairs(self, pos, scenario, reach):
+        shifted = pos.copy()
+        shifted[:, 0] += scenario * (self.map_shape[0] + self.SPACING)
+        a, b = SpatialHash(reach).build(shifted).query_pairs(reach)
+        diff = pos[a] - pos[b]
+        return a, b, diff, np.linalg.norm(diff, axis=1)
+
+    def _clip_walls(self, pos, vec, radius):
+        """
+        KinematicWorld._clip_walls的数组版本：每个行人的候选墙按顺序依次处理，不同行人之间并行
+        """
+        world = self.world
+        cand, rect_dis, _ = world.static_candidates(pos)
+        overlap = world.static_solid_mask(cand) & (rect_dis < radius)
+        for k in np.flatnonzero(np.any(overlap, axis=0)):
+            rows = np.flatnonzero(overlap[:, k])
+            s = cand[rows, k]
+            center, half = world.static_boxes(s)
+            rel = pos[rows] - center
+            normal = rel - np.clip(rel, -half, half)
+            dist = np.linalg.norm(normal, axis=1)
+            outside = dist > 0
+            normal = np.divide(normal, dist[:, None], out=np.zeros_like(normal), where=outside[:, None])
+            # 中心已经在矩形内部，沿穿透最浅的轴推出
+            arange = np.arange(len(rows))
+            pen = half - np.abs(rel)
+            axis = np.argmin(pen, axis=1)
+            inner = np.zeros_like(normal)
+            inner[arange, axis] = np.where(rel[arange, axis] >= 0, 1.0, -1.0)
+            normal = np.where(outside[:, None], normal, inner)
+            depth = np.where(outside, radius - dist, pen[arange, axis] + radius)
+            push = depth > 0
+            rows, normal, depth = rows[push], normal[push], depth[push]
+            pos[rows] += normal * depth[:, None]
+            vn = (vec[rows] * normal).sum(axis=1)
+            vec[rows] -= np.minimum(vn, 0.0)[:, None] * normal
+
+    # ---------------------------- 观察与奖励 ----------------------------
+    def _collisions(self):
+        """
+        :return: 每个行人是否与其他团体的行人接触、是否与墙接触，形状为(B, N)
+        """
+        collide_agents = np.zeros([self.num_envs, self.num_peds], dtype=bool)
+        idx = np.flatnonzero(self.active.ravel())
+        pos = self.pos.reshape(-1, 2)[idx]
+        scenario = idx // self.num_peds
+        a, b, _, dis = self._neighbour_pairs(pos, scenario, 2 * Person.radius)
+        group = scenario * self.num_peds + self.leader_index.ravel()[idx]
+        touching = (dis < 2 * Person.radius) & (group[a] != group[b])
+        collide_agents.ravel()[idx[a[touching]]] = True
+        collide_agents.ravel()[idx[b[touching]]] = True
+        collide_walls = np.zeros_like(collide_agents)
+        cand, rect_dis, _ = self.world.static_candidates(pos)
+        touching = self.world.static_wall_mask(cand)
+        collide_walls.ravel()[idx] = np.any(touching & (rect_dis < Person.radius + KinematicWorld.POLYGON_RADIUS), axis=1)
+        return collide_agents, collide_walls
+
+    def _rewards(self, leaders, was_active, reached, collide_agents, collide_walls):
+        """
+        PedsRLHandlerWithForce.get_reward的数组版本
+        """
+        rows = np.arange(self.num_envs)[:, None]
+        rewards = np.zeros(leaders.shape, dtype=np.float32)
+        if self.disable_reward:
+            return rewards
+        rewards += np.where(collide_agents[rows, leaders], self.r_collision_person, 0.0)
+        rewards += np.where(collide_walls[rows, leaders], self.r_collision_wall, 0.0)
+        now = self.pos[rows, leaders]
+        moved = np.any(np.abs(now - self.last_pos[rows, leaders]) > 0.001, axis=2)
+        rewards += np.where(reached, self.r_reach, np.where(moved, self.r_move, self.r_wait))
+        update = was_active & ~reached & moved
+        self.last_pos[rows[:, [0]].repeat(leaders.shape[1], 1)[update], leaders[update]] = now[update]
+        return np.where(was_active, rewards, 0.0).astype(np.float32)
+
+    def _observe(self):
+        """
+        PedsRLHandlerWithForce.get_observation的数组版本，到达出口的leader的观察为0
+        """
+        rows = np.arange(self.num_envs)[:, None]
+        leaders = self.agent_index
+        pos = self.pos[rows, leaders]
+        vec = self.vec[rows, leaders]
+        obs = np.zeros((self.num_envs, len(self.possible_agents)) + self._obs_shape)
+        speed = np.linalg.norm(vec, axis=2)
+        obs[:, :, 0] = speed
+        obs[:, :, 1] = np.where(speed > 0, _angle_to_x_axis(vec), 0.0)
+        # 到自己出口最近的出口格子的距离与夹角
+        rel = self.exit_points[None, None, :, :] - pos[:, :, None, :]
+        dis = np.linalg.norm(rel, axis=3)
+        dis = np.where(self.exit_point_type == self.exit_type[rows, leaders][:, :, None], dis, np.inf)
+        nearest = np.argmin(dis, axis=2)
+        exit_dis = np.take_along_axis(dis, nearest[:, :, None], axis=2)[:, :, 0]
+        exit_rel = np.take_along_axis(rel, nearest[:, :, None, None], axis=2)[:, :, 0]
+        obs[:, :, 2] = exit_dis
+        obs[:, :, 3] = np.where(exit_dis != 0, _angle_to_x_axis(exit_rel), 0.0)
+        # 3m范围内最近的行人，障碍物部分与PedsRLHandlerWithForce相同恒为0
+        idx = np.flatnonzero(self.active.ravel())
+        query = (leaders + rows * self.num_peds).ravel()
+        if len(idx) > 0:
+            index_of = np.full([self.num_envs * self.num_peds], -1)
+            index_of[idx] = np.arange(len(idx))
+            shift = np.array([self.map_shape[0] + self.SPACING, 0.0])
+            points = self.pos.reshape(-1, 2)[idx] + (idx // self.num_peds)[:, None] * shift
+            queries = self.pos.reshape(-1, 2)[query] + (query // self.num_peds)[:, None] * shift
+            count = PedsRLHandlerWithForce.DETECT_PED_COUNT
+            found, found_dis = SpatialHash(cell_size=1.5).build(points).query_knn(
+                queries, count, self.DETECT_RANGE / 2, max_distance=self.DETECT_RANGE, exclude=index_of[query])
+            other = points[np.maximum(found, 0)] - queries[:, None, :]
+            ped_obs = np.stack([found_dis, _angle_to_x_axis(other)], axis=2)
+            ped_obs[found < 0] = 0.0
+            obs.reshape((-1,) + self._obs_shape)[:, 4:4 + 2 * count] = ped_obs.reshape(len(query), -1)
+        obs[~self.active[rows, leaders] | self.arrived[rows, leaders]] = 0.0
+        self.obs[:] = obs
+
+    def close(self):
+        self.template.close()
@@ -0,0 +1,267 @@
+"""
+PedsMoveEnv的吞吐量基准测试，对地图、人数、团体大小、frame_skipping、处理器与物理引擎的所有组合分别测量
+step与reset的速度、观察的构建时间、路径规划器的初始化时间与单个环境的内存占用，结果写入JSON文件，便于在不同提交之间比较。
+
+用法：
+python -m ped_env.benchmark --maps map_10 map_12 --person-nums 20 40 --engines box2d numpy --output bench.json
+python -m ped_env.benchmark --env-kwargs '{"vectorized": true}' --steps 500
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+import numpy as np
+from gym.spaces import Discrete
+
+import ped_env.utils.cache as cache
+from ped_env.envs import PedsMoveEnv
+from ped_env.mdp import (PedsRLHandlerWithForce, PedsVisionRLHandler, PedsGridRLHandler, PedsRLHandler,
+                         PedsRLHandlerWithPlanner)
+from ped_env.pathfinder import AStar
+from ped_env.utils.maps import parse_map
+
+MAPS = ("map_simple", "map_07", "map_09", "map_10", "map_11", "map_12")
+HANDLERS = {cls.__name__: cls for cls in (PedsRLHandlerWithForce, PedsVisionRLHandler, PedsGridRLHandler,
+                                          PedsRLHandler, PedsRLHandlerWithPlanner)}
+
+
+class Timer:
+    """
+    累计被包装函数的调用次数与耗时(秒)
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.count = 0
+        self.total = 0.0
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            self.total += time.perf_counter() - start
+            self.count += 1
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.count if self.count > 0 else None
+
+
+def random_actions(env: PedsMoveEnv, rng: np.random.RandomState) -> Dict:
+    """
+    使用固定种子的随机动作，保证不同提交之间的测试负载一致
+    """
+    actions = {}
+    for agent in env.possible_agents:
+        space = env.action_spaces[agent]
+        if isinstance(space, Discrete):
+            actions[agent] = int(rng.randint(space.n))
+        else:
+            actions[agent] = rng.uniform(-1, 1, space.shape).astype(np.float32)
+    return actions
+
+
+@contextlib.contextmanager
+def cold_cache(map_name: str, enabled: bool = True):
+    """
+    在新的临时缓存目录中运行，并清空地图在进程内缓存的距离场，使得规划器与环境的初始化都从头计算，退出时删除临时目录
+    """
+    if not enabled:
+        yield
+        return
+    old_dir = cache.CACHE_DIR
+    cache.CACHE_DIR = tempfile.mkdtemp(prefix="ped_env_bench_")
+    parse_map(map_name)._obstacle_field = None
+    try:
+        yield
+    finally:
+        shutil.rmtree(cache.CACHE_DIR, ignore_errors=True)
+        cache.CACHE_DIR = old_dir
+
+
+def measure_planner_init(map_name: str, cold: bool = False) -> float:
+    """
+    :param cold: 是否使用空的缓存(cold_cache)
+    :return: 创建A*规划器并计算所有出口方向场的耗时(秒)
+    """
+    terrain = parse_map(map_name)
+    with cold_cache(map_name, cold):
+        start = time.perf_counter()
+        planner = AStar(terrain)
+        planner.calculate_dir_vector()
+        return time.perf_counter() - start
+
+
+def measure_memory(make_env) -> Dict[str, int]:
+    """
+    使用tracemalloc统计创建环境并reset一次后仍占用的内存与过程中的峰值(字节)，
+    只包含Python与numpy分配的内存，Box2D等C++扩展内部的内存不在其中
+    """
+    tracemalloc.start()
+    try:
+        env = make_env()
+        env.reset(seed=0)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    env.close()
+    return {"memory_bytes": current, "memory_peak_bytes": peak}
+
+
+def run_case(config: Dict, env_kwargs: Dict, steps: int, resets: int, warmup: int, seed: int,
+             cold: bool = False) -> Dict:
+    """
+    测量一组参数下的各项指标
+    :param config: map, person_num, group_size, frame_skipping, handler与engine
+    :param env_kwargs: 传给PedsMoveEnv的其它参数
+    :param steps: 计时的step次数，所有行人到达出口后自动reset，reset的时间不计入
+    :param resets: 计时的reset次数
+    :param warmup: 正式计时前的step次数(numba编译、缓存等)
+    :param cold: 规划器与环境的初始化时间是否在空的缓存下测量
+    """
+    handler = HANDLERS[config["handler"]]
+    kwargs = dict(env_kwargs, engine=config["engine"], frame_skipping=config["frame_skipping"],
+                  group_size=(config["group_size"], config["group_size"]))
+    if handler is not PedsRLHandlerWithForce:
+        kwargs["person_handler"] = handler
+
+    def make_env():
+        return PedsMoveEnv(config["map"], config["person_num"], **kwargs)
+
+    result = {"planner_init_s": measure_planner_init(config["map"], cold)}
+    with cold_cache(config["map"], cold):
+        start = time.perf_counter()
+        env = make_env()
+        result["env_init_s"] = time.perf_counter() - start
+    # 观察的构建时间：step末尾由处理器计算所有leader的观察与奖励
+    obs_timer = Timer(env.person_handler.step_into if env.array_output else env.person_handler.step)
+    if env.array_output:
+        env.person_handler.step_into = obs_timer
+    else:
+        env.person_handler.step = obs_timer
+
+    rng = np.random.RandomState(seed)
+    env.reset(seed=seed)
+    for _ in range(warmup):
+        _, _, dones, truncated, _ = env.step(random_actions(env, rng))
+        if all(dones.values()) or all(truncated.values()):
+            env.reset()
+    start = time.perf_counter()
+    for i in range(resets):
+        env.reset(seed=seed + i)
+    result["resets_per_s"] = resets / (time.perf_counter() - start) if resets > 0 else None
+
+    env.reset(seed=seed)
+    obs_timer.count, obs_timer.total = 0, 0.0
+    step_time, episodes = 0.0, 0
+    for _ in range(steps):
+        actions = random_actions(env, rng)
+        start = time.perf_counter()
+        _, _, dones, truncated, _ = env.step(actions)
+        step_time += time.perf_counter() - start
+        if all(dones.values()) or all(truncated.values()):
+            episodes += 1
+            env.reset()
+    if env_kwargs.get("profile", False):
+        result["profile"] = env.profile_summary()
+    env.close()
+    result.update({
+        "steps_per_s": steps / step_time if steps > 0 else None,
+        "ticks_per_s": steps * config["frame_skipping"] / step_time if steps > 0 else None,
+        "step_ms": step_time / steps * 1e3 if steps > 0 else None,
+        "obs_build_ms": obs_timer.mean * 1e3 if obs_timer.count > 0 else None,
+        "episodes": episodes,
+    })
+    result.update(measure_memory(make_env))
+    return result
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args) -> Dict:
+    env_kwargs = json.loads(args.env_kwargs)
+    env_kwargs.setdefault("maxStep", args.max_step)
+    results: List[Dict] = []
+    grid = itertools.product(args.maps, args.person_nums, args.group_sizes, args.frame_skips, args.handlers,
+                             args.engines)
+    for map_name, person_num, group_size, frame_skipping, handler, engine in grid:
+        config = {"map": map_name, "person_num": person_num, "group_size": group_size,
+                  "frame_skipping": frame_skipping, "handler": handler, "engine": engine}
+        try:
+            config.update(run_case(config, env_kwargs, args.steps, args.resets, args.warmup, args.seed,
+                                   args.cold_cache))
+        except Exception as e:  # 某些组合不合法(例如人数无法被出口数与团体大小整除)，记录错误后继续
+            config["error"] = "{}: {}".format(type(e).__name__, e)
+        print(json.dumps(config), file=sys.stderr)
+        results.append(config)
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "env_kwargs": env_kwargs,
+            "steps": args.steps,
+            "resets": args.resets,
+            "warmup": args.warmup,
+            "seed": args.seed,
+            "cold_cache": args.cold_cache,
+        },
+        "results": results,
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark PedsMoveEnv throughput and write the results as JSON.")
+    parser.add_argument("--maps", nargs="+", default=list(MAPS), choices=MAPS)
+    parser.add_argument("--person-nums", nargs="+", type=int, default=[20])
+    parser.add_argument("--group-sizes", nargs="+", type=int, default=[1])
+    parser.add_argument("--frame-skips", nargs="+", type=int, default=[8])
+    parser.add_argument("--handlers", nargs="+", default=[PedsRLHandlerWithForce.__name__], choices=list(HANDLERS))
+    parser.add_argument("--engines", nargs="+", default=["box2d"], choices=PedsMoveEnv.ENGINES)
+    parser.add_argument("--env-kwargs", default="{}", type=str, help="JSON dict of extra PedsMoveEnv arguments")
+    parser.add_argument("--steps", default=200, type=int)
+    parser.add_argument("--resets", default=5, type=int)
+    parser.add_argument("--warmup", default=10, type=int)
+    parser.add_argument("--max-step", default=10000, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--cold-cache", action="store_true",
+                        help="measure planner and env init with an empty cache for every case")
+    parser.add_argument("--output", default=None, type=str, help="JSON file, stdout if omitted")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.disable(logging.WARNING)  # 行人到达出口时的日志会干扰计时
+    report = run_benchmark(args)
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
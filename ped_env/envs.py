@@ -26,13 +26,19 @@ except ImportError:
         "pygame is not installed, run `pip install pygame`"
     )
 
-from ped_env.mdp import PedsRLHandlerWithForce
+from ped_env.mdp import PedsRLHandlerWithForce, ActionPlan
 from ped_env.pathfinder import AStar
-from ped_env.listener import MyContactListener
-from ped_env.objects import BoxWall, Person, Exit, Group
+from ped_env.listener import MyContactListener, ContactTracker
+from ped_env.objects import BoxWall, Person, PersonState, Exit, Group, GroupIndex, WALL_PIECES
+from ped_env.state import PedsState
+from ped_env.kinematic import KinematicWorld
 from ped_env.utils.colors import (ColorBlue, ColorWall, ColorRed, ColorYellow)
-from ped_env.utils.misc import ObjectType
+from ped_env.utils.misc import ObjectType, AgentArrayDict, ActiveList
 from ped_env.utils.maps import Map, parse_map
+from ped_env.utils.spatial import SpatialHash
+from ped_env.utils.raster import Rasterizer, greedy_rectangles
+from ped_env.utils import profiler as prof
+from ped_env.utils.cache import hash_arrays, load_or_build
 from ped_env.functions import calculate_each_group_num, calculate_groups_person_num, calc_triangle_points, \
     transfer_to_render, gray_scale_image
 from ped_env.settings import TICKS_PER_SEC, vel_iters, pos_iters, ACTION_DIM, GROUP_SIZE, RENDER_SCALE
@@ -40,22 +46,64 @@ from ped_env.settings import TICKS_PER_SEC, vel_iters, pos_iters, ACTION_DIM, GR
 
 class Spawner:
 
-    def __init__(self, world: b2World, l1, l2):
+    def __init__(self, world: b2World, l1, l2, state: PedsState = None, pool: List[Person] = None,
+                 with_sensor: bool = True, merge_walls: bool = False):
+        """
+        :param pool: 上一回合的行人对象池，不为空时优先从中取出行人复用其刚体
+        :param with_sensor: 新创建的行人是否带有传感器夹具
+        :param merge_walls: 是否将相邻的同类墙块合并为尽量少的矩形刚体
+        """
         self.world = world
         self.l1 = l1
         self.l2 = l2
+        self.state = state
+        self.pool = pool if pool is not None else []
+        self.created = []  # 本回合创建或复用的所有行人
+        self.with_sensor = with_sensor
+        self.merge_walls = merge_walls
 
     def create_walls(self, start_nodes, width_height, object_type, color=ColorWall, CreateClass=BoxWall):
         if CreateClass is Exit:
             return [CreateClass(self.world, start_nodes[i][0],
                                 start_nodes[i][1], start_nodes[i][2], width_height[0],
                                 width_height[1], self.l1) for i in range(len(start_nodes))]
+        elif self.merge_walls:
+            return self.create_merged_walls([(node, tuple(width_height)) for node in start_nodes], object_type, color)
         else:
             return [CreateClass(self.world, start_nodes[i][0],
                                 start_nodes[i][1], width_height[0],
                                 width_height[1], self.l1, object_type, color) for i in range(len(start_nodes))]
 
+    def create_merged_walls(self, pieces, object_type, color=ColorWall):
+        """
+        尺寸以及在方格内的位置都相同的墙块按方格排成网格，用greedy_rectangles合并为尽量少的矩形，每个矩形只创建一个BoxWall，
+        只有边长为1m的方向上相邻的墙块才是连在一起的(例如竖墙只沿y方向合并)，因此合并前后墙体覆盖的区域完全相同。
+        合并后的BoxWall在cells与cell_halves中记录原始墙块，供按方格计算的排斥力使用
+        :param pieces: [((中心x, 中心y), (宽, 高)), ...]
+        """
+        kinds = defaultdict(dict)
+        for (x, y), (w, h) in pieces:
+            i, j = int(math.floor(x)), int(math.floor(y))
+            kinds[(w, h, round(x - i, 6), round(y - j, 6))][(i, j)] = (x, y)
+        walls = []
+        for (w, h, _, _), centers in kinds.items():
+            cells = np.array(list(centers.keys()), dtype=np.int64)
+            mask = np.zeros(cells.max(axis=0) + 1, dtype=bool)
+            mask[cells[:, 0], cells[:, 1]] = True
+            for i0, j0, i1, j1 in greedy_rectangles(mask, grow_x=w == 1, grow_y=h == 1):
+                x0, y0 = centers[(i0, j0)]
+                wall = BoxWall(self.world, x0 + (i1 - i0 - 1) / 2, y0 + (j1 - j0 - 1) / 2,
+                               w + i1 - i0 - 1, h + j1 - j0 - 1, self.l1, object_type, color)
+                wall.cells = np.array([centers[(i, j)] for j in range(j0, j1) for i in range(i0, i1)],
+                                      dtype=np.float64)
+                wall.cell_halves = np.tile(np.array([w / 2, h / 2], dtype=np.float64), (len(wall.cells), 1))
+                walls.append(wall)
+        return walls
+
     def create_wall_extra(self, wall_info, color=ColorWall):
+        if self.merge_walls:
+            pieces = [(node, size) for info in wall_info for node, size in zip(info[:-1], WALL_PIECES[info[-1]])]
+            return self.create_merged_walls(pieces, ObjectType.Wall, color)
         walls = []
         for info in wall_info:
             if len(info) == 2:
@@ -127,8 +175,17 @@ class Spawner:
         :param exit_type:
         :return:
         '''
-        return [Person(self.world, start_nodes[i][0],
-                       start_nodes[i][1], exit_type, self.l1, self.l2) for i in range(len(start_nodes))]
+        persons = []
+        for x, y in start_nodes:
+            if len(self.pool) > 0:
+                person = self.pool.pop()
+                person.respawn(x, y, exit_type)
+            else:
+                person = Person(self.world, x, y, exit_type, self.l1, self.l2, state=self.state,
+                                with_sensor=self.with_sensor)
+            persons.append(person)
+        self.created.extend(persons)
+        return persons
 
     def inner_create_persons_in_radius(self, start_node, radius, person_num, exit_type):
         start_pos = []
@@ -220,11 +277,105 @@ class Parser:
                 if 9 >= e >= 3:
                     self.start_point_dic[e].append((i + 0.5, j + 0.5))
 
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        将解析结果转换为数组以便缓存到磁盘
+        """
+        obs_nodes = np.full([len(self.start_nodes_obs), 4], np.nan)
+        for k, info in enumerate(self.start_nodes_obs):
+            for n, node in enumerate(info[:-1]):
+                obs_nodes[k, n * 2:n * 2 + 2] = node
+        spawn = [(x, y, e) for e, points in self.start_point_dic.items() for x, y in points]
+        return {
+            "wall": np.array(self.start_nodes_wall, dtype=np.float64).reshape(-1, 2),
+            "exit": np.array(self.start_nodes_exit, dtype=np.float64).reshape(-1, 3),
+            "obs_nodes": obs_nodes,
+            "obs_types": np.array([info[-1] for info in self.start_nodes_obs], dtype=str),
+            "spawn": np.array(spawn, dtype=np.float64).reshape(-1, 3),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]):
+        parser = cls()
+        parser.start_nodes_wall = [(float(x), float(y)) for x, y in arrays["wall"]]
+        parser.start_nodes_exit = [(float(x), float(y), int(e)) for x, y, e in arrays["exit"]]
+        for nodes, obs_type in zip(arrays["obs_nodes"], arrays["obs_types"]):
+            info = [(float(nodes[0]), float(nodes[1]))]
+            if not np.isnan(nodes[2]):
+                info.append((float(nodes[2]), float(nodes[3])))
+            parser.start_nodes_obs.append(tuple(info) + (str(obs_type),))
+        for x, y, e in arrays["spawn"]:
+            parser.start_point_dic[int(e)].append((float(x), float(y)))
+        return parser
+
+    @classmethod
+    def load(cls, map, spawn_map):
+        """
+        解析地图，结果以地图内容的哈希为键缓存在磁盘上，之后(包括其他进程)创建环境时直接读取
+        """
+        def build():
+            parser = cls()
+            parser.parse_and_create(map, spawn_map)
+            return parser.to_arrays()
+
+        key = hash_arrays(np.asarray(map).astype(str), np.asarray(spawn_map).astype(str))
+        return cls.from_arrays(load_or_build("parser", key, build))
+
+
+class ExitLookup:
+    RESOLUTION = 10  # 每米细分的格子数
+
+    def __init__(self, start_nodes_exit, width, height, radius, resolution=RESOLUTION):
+        """
+        根据Parser.start_nodes_exit预先计算每个细分格子对应的出口类型(按位存储)，
+        使得到达出口的判定变为一次数组索引而不是遍历所有出口计算距离。
+        sure表示格子内所有点都在某出口radius范围内，maybe表示格子内存在点在范围内，
+        只有落在maybe但不在sure的格子中的行人才需要精确计算距离
+        :param start_nodes_exit: (x, y, exit_type)的列表
+        :param radius: 判定到达出口的距离
+        :param resolution: 每米细分的格子数
+        """
+        self.resolution = resolution
+        self.radius = radius
+        self.exit_pos = np.array([node[:2] for node in start_nodes_exit], dtype=np.float64).reshape(-1, 2)
+        self.exit_type = np.array([node[2] for node in start_nodes_exit], dtype=np.int64)
+        self.sure = np.zeros([width * resolution, height * resolution], dtype=np.int64)
+        self.maybe = np.zeros_like(self.sure)
+        xs = np.arange(width * resolution) / resolution
+        ys = np.arange(height * resolution) / resolution
+        step = 1 / resolution
+        eps = 1e-9
+        for (ex, ey), t in zip(self.exit_pos, self.exit_type):
+            dx_min = np.maximum(np.maximum(xs - ex, ex - xs - step), 0)
+            dy_min = np.maximum(np.maximum(ys - ey, ey - ys - step), 0)
+            dx_max = np.maximum(np.abs(xs - ex), np.abs(xs + step - ex))
+            dy_max = np.maximum(np.abs(ys - ey), np.abs(ys + step - ey))
+            min_dis = (dx_min[:, None] ** 2 + dy_min[None, :] ** 2) ** 0.5
+            max_dis = (dx_max[:, None] ** 2 + dy_max[None, :] ** 2) ** 0.5
+            self.maybe[min_dis <= radius + eps] |= 1 << int(t)
+            self.sure[max_dis <= radius - eps] |= 1 << int(t)
+
+    def query(self, pos: np.ndarray, exit_type: np.ndarray) -> np.ndarray:
+        """
+        :param pos: 形状为(N, 2)的行人坐标
+        :param exit_type: 形状为(N,)的行人出口类型
+        :return: 行人是否位于自己出口的radius范围内
+        """
+        cell = (pos * self.resolution).astype(np.int64)
+        cx = np.clip(cell[:, 0], 0, self.sure.shape[0] - 1)
+        cy = np.clip(cell[:, 1], 0, self.sure.shape[1] - 1)
+        bit = np.left_shift(1, exit_type)
+        result = (self.sure[cx, cy] & bit) != 0
+        unsure = ~result & ((self.maybe[cx, cy] & bit) != 0)
+        for i in np.flatnonzero(unsure):
+            candidates = self.exit_pos[self.exit_type == exit_type[i]]
+            diff = candidates - pos[i]
+            result[i] = np.any((diff[:, 0] ** 2 + diff[:, 1] ** 2) ** 0.5 <= self.radius)
+        return result
+
 
 class PedsMoveEnv(gym.Env):
     viewer = None
-    peds = []
-    not_arrived_peds = []
     once = False
 
     metadata = {
@@ -232,6 +383,12 @@ class PedsMoveEnv(gym.Env):
         "render_fps": 50,
     }
 
+    ENGINES = ("box2d", "numpy")
+    RENDERERS = ("pygame", "numpy")
+    CONTACT_MODES = ("listener", "array")
+    STABILITY_SAFETY = 0.5  # 自适应子步的步长相对稳定性上限的安全系数
+    RENDER_CELL_PIXELS = 40  # rgb_array与gray_array模式下每个地图方格的边长(像素)，图像大小为(宽 * 40, 高 * 40)
+
     def __init__(self,
                  terrain: str,
                  person_num=10,
@@ -244,7 +401,18 @@ class PedsMoveEnv(gym.Env):
                  use_planner=False,
                  with_force=True,
                  random_init_mode: bool = True,
-                 debug_mode: bool = False):
+                 debug_mode: bool = False,
+                 vectorized: bool = False,
+                 engine: str = "box2d",
+                 spatial_index: bool = False,
+                 follower_flow_field: bool = False,
+                 array_output: bool = False,
+                 reuse_world: bool = False,
+                 renderer: str = "pygame",
+                 contacts: str = "listener",
+                 adaptive_substeps: int = 1,
+                 merge_walls: bool = False,
+                 profile: bool = False):
         """
         一个基于Box2D和pyglet的多行人强化学习仿真环境
         对于一个有N个人的环境，其状态空间为：[o1,o2,...,oN]，每一个o都是一个长度为14的list，其代表的意义为：
@@ -257,23 +425,61 @@ class PedsMoveEnv(gym.Env):
         :param discrete: 动作空间是否离散，连续时针对每一个智能体必须输入一个二维单位方向向量（注意！）
         :param frame_skipping: 一次step跳过的帧数，等于一次step环境经过frame_skipping * 1 / TICKS_PER_SEC(50)秒
         :param maxStep: 经过多少次step后就强行结束环境，所有行人到达终点时也会结束环境
-        :param person_handler: 用于处理有关于行人状态空间，动作与返回奖励的类
+        :param person_handler: 用于处理有关于行人状态空间，动作与返回奖励的类(PedsHandlerInterface的子类)，默认为PedsRLHandlerWithForce
         :param random_init_mode: 用于planner的规划时使用，主要区别是在全场随机生成智能体
         :param train_mode: 当为False时，直到所有行人到达出口才会重置环境，当为True时，一旦有leader到达出口就会重置环境
         :param debug_mode: 是否debug
         :param group_size:一个团体的人数，其中至少包含1个leader和多个follower
+        :param vectorized: 是否在每个子步中使用数组批量计算自驱动力，跟随混合和到达出口的判定，行人较多时使用
+        :param engine: 物理引擎，"box2d"使用Box2D刚体仿真，"numpy"使用不做刚体碰撞求解的运动学社会力模型(KinematicWorld)，
+                       行人之间与行人和墙之间的排斥力由处理器施加(PEDS_APPLY_SOCIAL_FORCE，例如PedsRLHandler)，
+                       否则由KinematicWorld施加，两者不会叠加
+        :param spatial_index: 是否使用每step重建一次的空间哈希(行人)与地图预计算的距离场(墙与障碍物)
+                              代替QueryAABB和传感器来查询最近的行人与障碍物，此时返回的元素按距离由近到远排序
+        :param follower_flow_field: leader到达出口后，follower是否直接读取出口的方向场(AStar.get_flow_field)，
+                                    而不是每次离开缓存的路径时都重新调用A*
+        :param array_output: 是否将观察与奖励写入预先分配的数组(obs_buffer, reward_buffer)，观察数组的形状与类型
+                             由处理器的observation_space决定，奖励为float32，此时reset与step返回的是这两个数组的字典视图(AgentArrayDict)
+        :param reuse_world: 是否在多次reset之间复用物理世界与墙、出口等静态刚体，并将行人放入对象池，
+                            下一回合重新启用并移动其刚体，而不是重新创建
+        :param renderer: rgb_array与gray_array模式的渲染后端，"pygame"每次重新绘制整张图，
+                         "numpy"使用预先光栅化的静态背景并直接写入行人圆盘(Rasterizer)，不需要pygame，结果逐像素一致
+        :param contacts: 碰撞与探测关系的统计方式，"listener"使用contactListener回调，
+                         "array"不再安装回调，也不再创建box2d引擎中行人的传感器夹具，每个子步由ContactTracker批量计算。
+                         注意box2d引擎下QueryAABB的返回顺序取决于宽相位中的夹具，没有传感器夹具时查询最近行人得到的顺序不同，
+                         相同种子下的观察与"listener"不一致，建议同时使用spatial_index=True(按距离排序，与接触统计方式无关)
+        :param adaptive_substeps: 大于1时(需要vectorized=True)，局部密度较低时把至多这么多个tick合并为一次物理步，
+                                  步长受社会力的稳定性条件约束，行人稀疏时可以减少一个step内的物理步数
+        :param merge_walls: 是否将相邻的同类墙块合并为尽量少的静态刚体(需要engine="box2d")，以减少宽相位、
+                            传感器与射线检测需要遍历的夹具数，此时obstacles与walls中是合并后的矩形，
+                            距离场等按方格的查询通过static_owner映射到合并后的墙。
+                            注意collide_wall_count按行人与墙刚体开始接触的次数统计，沿墙移动时经过相邻的方格不再重复计数，
+                            因此其数值(以及日志与快照中的碰撞次数)比不合并时小，不能与不合并时的结果直接比较
+        :param profile: 是否记录step中各阶段的耗时，通过profile_summary()获取统计结果，关闭时几乎没有额外开销
         """
         super(PedsMoveEnv, self).__init__()
 
         self.random_init_mode = random_init_mode
         self.left_person_num = 0
         self.step_in_env = 0
-        self.elements = []
+        self.peds: List[Person] = []
+        self.not_arrived_peds = ActiveList()  # 尚未到达出口的行人，按创建顺序排列，移除为O(1)
+        self._render_statics = []  # 渲染队列中的静态物体，行人部分直接使用not_arrived_peds
         self.terrain: Map = parse_map(terrain)
         self.screen: Optional[pygame.Surface] = None
         self.clock = None
         self.render_data = None
         self.render_scale = RENDER_SCALE
+        assert renderer in self.RENDERERS, u"不支持的渲染后端{}!".format(renderer)
+        self.renderer = renderer
+        assert contacts in self.CONTACT_MODES, u"不支持的接触统计方式{}!".format(contacts)
+        self.contacts = contacts
+        if contacts == "array" and engine == "box2d" and not spatial_index:
+            logging.warning(u"box2d引擎使用contacts=\"array\"时最近行人的顺序与\"listener\"不同，建议使用spatial_index=True!")
+        self.contact_tracker: Optional[ContactTracker] = None
+        self.group_index: Optional[GroupIndex] = None
+        self._rasterizer: Optional[Rasterizer] = None
+        self._rasterizer_key = None
 
         self.person_num = person_num
         self.discrete = discrete
@@ -282,11 +488,35 @@ class PedsMoveEnv(gym.Env):
         self.distance_to_exit = []
         self.points_in_last_step = []
         self.init_map_points = False
+        self.reuse_world = reuse_world
+        self.world = None
+        self._ped_pool: List[Person] = []
 
         self.frame_skipping = frame_skipping
         self.group_size = group_size
+        assert engine in self.ENGINES, u"不支持的物理引擎{}!".format(engine)
+        self.engine = engine
+        self.vectorized = vectorized
+        assert adaptive_substeps == 1 or vectorized, u"自适应子步需要vectorized=True!"
+        self.adaptive_substeps = adaptive_substeps
+        assert not merge_walls or engine == "box2d", u"合并墙体需要engine=\"box2d\"!"
+        self.merge_walls = merge_walls
+        self.static_owner: Optional[np.ndarray] = None
+        self.profiler = prof.StepProfiler() if profile else prof.NullProfiler()
+        self.state = PedsState(person_num)
+        self.exit_lookup = None
+        self.spatial_index = spatial_index
+        self.follower_flow_field = follower_flow_field
+        self._nearest_cache = {}
+        self._ped_index = None
+        self.frame_count = 0  # 每次产生新的观察前加一，作为观察相关缓存(例如渲染结果)的键
+        self._episode = 0  # reset的次数，快照只能恢复到同一回合中
+        self.obstacle_field = None
+        self.path_finder = AStar(self.terrain)  # 需要在person_handler之前创建，供其路径缓存使用
         if person_handler is None:
             self.person_handler = PedsRLHandlerWithForce(self, use_planner=use_planner, with_force=with_force)
+        else:
+            self.person_handler = person_handler(self, use_planner=use_planner, with_force=with_force)
         # 由PersonHandler类提供的属性代替，从而使用策略模式来加强灵活性
         # self.observation_space = self.person_handler.observation_space[0]
         # self.action_space = self.person_handler.action_space[0]
@@ -301,11 +531,15 @@ class PedsMoveEnv(gym.Env):
         self.debug_mode = debug_mode
         self.vec = [0.0 for _ in range(self.agent_count)]
 
-        self.path_finder = AStar(self.terrain)
         # for pettingzoo interface
         self._cumulative_rewards = defaultdict(int)
         self.agents = [str(i) for i in range(self.agent_count)]
         self.possible_agents = copy.deepcopy(self.agents)
+        self.array_output = array_output
+        if array_output:
+            obs_space = self.person_handler.observation_space[0]
+            self.bind_output_buffers(np.zeros((self.agent_count,) + obs_space.shape, dtype=obs_space.dtype),
+                                     np.zeros([self.agent_count], dtype=np.float32))
         self.max_num_agents = len(self.possible_agents)
         self.observation_spaces = {agentid: copy.copy(self.person_handler.observation_space[0]) for agentid in
                                    self.agents}
@@ -323,6 +557,7 @@ class PedsMoveEnv(gym.Env):
 
     def _reset_property(self):
         # reset ped_env,清空所有全局变量以供下一次使用
+        self._episode += 1
         Person.counter = 0
         BoxWall.counter = 0
         Exit.counter = 0
@@ -331,34 +566,86 @@ class PedsMoveEnv(gym.Env):
         self.step_in_env = 0
         self.peds.clear()
         self.not_arrived_peds.clear()
-        self.elements.clear()
+        self.state.clear()
 
     def seed(self, seed=None):
         np.random.seed(seed)
         random.seed(seed)
 
-    def _initialize_env(self, maps: np.ndarray, spawn_maps: np.ndarray, person_num_sum: int = 60):
+    def bind_output_buffers(self, obs_buffer: np.ndarray, reward_buffer: np.ndarray):
+        """
+        指定array_output模式下观察与奖励写入的数组(例如PedsMoveVecEnv的共享内存)
+        :param obs_buffer: 形状为(agent_count, *观察形状)的数组
+        :param reward_buffer: 形状为(agent_count,)的数组
+        """
+        self.obs_buffer = obs_buffer
+        self.reward_buffer = reward_buffer
+        self._obs_view = AgentArrayDict(self.possible_agents, self.obs_buffer)
+        self._reward_view = AgentArrayDict(self.possible_agents, self.reward_buffer)
+
+    def _create_world(self, maps: np.ndarray, spawn_maps: np.ndarray):
+        """
+        创建物理世界以及墙、障碍物、出口等静态刚体
+        """
+        self._rasterizer = None
         # 创建物理引擎
-        self.world = b2World(gravity=(0, 0), doSleep=True)
+        if self.engine == "numpy":
+            self.world = KinematicWorld(gravity=(0, 0), doSleep=True)
+            # 处理器自己施加排斥力时由它负责，否则由KinematicWorld在物理步中施加
+            self.world.social_forces = not self.person_handler.PEDS_APPLY_SOCIAL_FORCE
+        else:
+            self.world = b2World(gravity=(0, 0), doSleep=True)
         self.listener = MyContactListener(self)  # 现在使用aabb_query的方式来判定
-        self.world.contactListener = self.listener
+        if self.contacts == "listener":
+            self.world.contactListener = self.listener
+        elif self.engine == "numpy":
+            self.world.track_contacts = False
         # 创建渲染所需
         self.batch = pyglet.graphics.Batch()
         self.display_level = pyglet.graphics.OrderedGroup(0)
         self.debug_level = pyglet.graphics.OrderedGroup(1)
         # 创建一个行人工厂以供生成行人调用
-        self.factory = Spawner(self.world, self.display_level, self.debug_level)
+        self.factory = Spawner(self.world, self.display_level, self.debug_level, self.state,
+                               with_sensor=self._with_sensor, merge_walls=self.merge_walls)
         # 是否按照地图生成墙
         if not self.init_map_points:
             # 根据shape为50*50的map来构建1*1的墙，当该处值为1代表是墙
-            self.parser = Parser()
-            self.parser.parse_and_create(maps, spawn_maps)
+            self.parser = Parser.load(maps, spawn_maps)
             self.init_map_points = True
 
         self.obstacles = self.factory.create_wall_extra(self.parser.start_nodes_obs, color=ColorBlue)
         self.exits = self.factory.create_walls(self.parser.start_nodes_exit, (1, 1), ObjectType.Exit, color=ColorRed,
                                                CreateClass=Exit)  # 创建出口
         self.walls = self.factory.create_walls(self.parser.start_nodes_wall, (1, 1), ObjectType.Wall, ColorWall)  # 建造围墙
+        self._build_static_owner()
+
+    def _build_static_owner(self):
+        """
+        static_owner[k]为距离场(Map.obstacle_field)中第k块墙所属的墙在obstacles + walls中的编号，未合并墙体时为恒等映射
+        """
+        statics = self.obstacles + self.walls
+        if not self.merge_walls:
+            self.static_owner = np.arange(len(statics), dtype=np.int64)
+            return
+        owner = {}
+        for k, wall in enumerate(statics):
+            for center, half in zip(wall.cells.tolist(), wall.cell_halves.tolist()):
+                owner[tuple(np.round(center + half, 6))] = k
+        centers, halves = self.terrain.get_obstacle_nodes()
+        self.static_owner = np.array([owner[tuple(np.round(list(c) + list(h), 6))]
+                                      for c, h in zip(centers.tolist(), halves.tolist())], dtype=np.int64)
+
+    def _initialize_env(self, maps: np.ndarray, spawn_maps: np.ndarray, person_num_sum: int = 60):
+        if self.reuse_world and self.world is not None:
+            # 复用物理世界与静态刚体，上一回合的所有行人进入对象池
+            self.batch = pyglet.graphics.Batch()
+            for ped in self._ped_pool:
+                ped.body.active = False
+            # 倒序放入，使得按pop取出的顺序与上一回合创建的顺序相同
+            self.factory = Spawner(self.world, self.display_level, self.debug_level, self.state,
+                                   pool=self._ped_pool[::-1], with_sensor=self._with_sensor)
+        else:
+            self._create_world(maps, spawn_maps)
 
         # 随机初始化行人点，给每个生成点平均分配到不同出口的人群,并根据平均数来计算需要的领队数
         self.peds = []
@@ -377,9 +664,12 @@ class PedsMoveEnv(gym.Env):
                                                        self.group_size, self.parser.start_point_dic))
         self.left_person_num = sum(person_num)
         self.left_leader_num = self.agent_count
-        self.not_arrived_peds = copy.copy(self.peds)
+        self.not_arrived_peds = ActiveList(self.peds)
+        if self.reuse_world:
+            self._ped_pool = self.factory.created + self.factory.pool[::-1]
 
-        self.elements = self.exits + self.obstacles + self.walls + self.not_arrived_peds
+        self._render_statics = self.exits + self.obstacles + self.walls
+        self._init_spatial_indices()
         # 得到一开始各个智能体距离出口的距离
         self.distance_to_exit.clear()
         self.get_peds_distance_to_exit()
@@ -396,26 +686,60 @@ class PedsMoveEnv(gym.Env):
                 self.agents_rev_dict[ped] = self.agents[idx]
                 self.leaders.append(ped)
                 idx += 1
+        self._init_vectorized_indices()
+
+    def _init_vectorized_indices(self):
+        """
+        为数组化的子步准备leader,follower的槽位以及出口查找表
+        """
+        if self.exit_lookup is None:
+            self.exit_lookup = ExitLookup(self.parser.start_nodes_exit, self.terrain.width, self.terrain.height,
+                                          1 + Person.radius)
+        if self.contacts == "array":
+            self.contact_tracker = ContactTracker(self)
+        self.group_index = GroupIndex(self.groups, self.state)
+        self._update_vectorized_indices()
+
+    def _update_vectorized_indices(self):
+        self._moving_peds = list(self.not_arrived_peds)
+        self._moving_leaders = [ped for ped in self.not_arrived_peds if ped.is_leader]
+        self._moving_followers = [ped for ped in self.not_arrived_peds if not ped.is_leader]
+        self._moving_slots = np.array([ped.slot for ped in self.not_arrived_peds], dtype=np.int64)
+        if self.contact_tracker is not None:
+            self.contact_tracker.set_peds(self.not_arrived_peds)
+
+    @property
+    def _with_sensor(self):
+        # numpy引擎的社会力直接使用传感器半径作为作用范围，传感器夹具本身没有额外开销，因此只在box2d引擎下去掉
+        return self.contacts == "listener" or self.engine == "numpy"
 
-    def _delete_person(self, per: Person, ready_to_remove: List[Person]):
-        self._pop_from_render_list(per.id)
-        self.left_person_num -= 1
-        per.delete(self.world)
-        if per.is_leader:
-            self.left_leader_num -= 1
-        ready_to_remove.append(per)
+    @property
+    def elements(self) -> List:
+        """
+        渲染队列：出口、障碍物、墙以及尚未到达出口的行人(后绘制的覆盖先绘制的)
+        """
+        return self._render_statics + list(self.not_arrived_peds)
 
-    def _pop_from_render_list(self, person_id):
+    def _remove_arrived_peds(self):
         """
-        将行人从渲染队列中移除
-        :param person_id:
-        :return:
+        从状态数组中找出本step到达出口的行人，先将它们从not_arrived_peds(同时也是渲染队列)中移除，
+        再统一销毁(或停用)刚体
         """
-        for idx, per in enumerate(self.elements):
-            if per.type == ObjectType.Agent and per.id == person_id:
-                self.elements.pop(idx)
-                return
-        # logging.error(u"移除一个不存在的行人!")
+        slots = self._moving_slots
+        arrived = [self._moving_peds[i] for i in
+                   np.flatnonzero(self.state.is_done[slots] & ~self.state.has_removed[slots])]
+        if len(arrived) == 0:
+            return
+        for ped in arrived:  # 移除到达出口的leader和follower
+            logging.warning("Agent{}:Leave the exit{}!".format(ped.id, ped.exit_type))
+            self.not_arrived_peds.remove(ped)
+            self.left_person_num -= 1
+            if ped.is_leader:
+                self.left_leader_num -= 1
+                # self.agents.remove(self.agents_rev_dict[ped]) # 为了tianshou框架的方便，这里将到达出口的人的is_done置为False，本来应该是True的！
+        for ped in arrived:
+            ped.delete(self.world, keep_body=self.reuse_world)
+        self._update_vectorized_indices()
 
     def get_peds_distance_to_exit(self):
         # 废弃多目标点的设置，替换为最近的出口距离
@@ -461,6 +785,8 @@ class PedsMoveEnv(gym.Env):
 
     def get_ped_nearest_elements(self, ped: Person, n: int, detect_range: float = 3.0,
                                  detect_type: ObjectType = ObjectType.Agent):
+        if self.spatial_index and detect_type != ObjectType.Exit:
+            return self.get_peds_nearest_elements([ped], n, detect_range, detect_type)[0]
         detect_peds = ped.aabb_query(self.world, detect_range, detect_type)
         detect_peds = cast(List[Person], detect_peds)
         ret_elements = []
@@ -475,6 +801,57 @@ class PedsMoveEnv(gym.Env):
                 break
         return ret_elements
 
+    def _init_spatial_indices(self):
+        """
+        墙与障碍物使用地图预计算的距离场(Map.obstacle_field)，行人的空间哈希在每个step第一次查询时重建
+        """
+        self._invalidate_spatial_indices()
+        self.obstacle_field = self.terrain.obstacle_field if self.spatial_index else None
+
+    def _invalidate_spatial_indices(self):
+        self._nearest_cache.clear()
+        self._ped_index = None
+        self.frame_count += 1
+
+    def get_peds_nearest_elements(self, peds: List[Person], n: int, detect_range: float = 3.0,
+                                  detect_type: ObjectType = ObjectType.Agent) -> List[List]:
+        """
+        get_ped_nearest_elements的批量版本，使用空间哈希一次性为所有行人查询以其为中心、边长为detect_range的
+        正方形内(且距离不超过detect_range)最近的n个元素，结果按距离升序排列。
+        同一step内所有未到达出口的leader的查询结果会被一起计算并缓存
+        """
+        key = (n, detect_range, detect_type)
+        cache = self._nearest_cache.setdefault(key, {})
+        missing = [ped for ped in peds if ped not in cache]
+        if len(missing) > 0:
+            # 一次性计算所有leader，之后同一step内的查询直接命中缓存
+            batch = missing + [le for le in self.leaders if le not in cache and not le.is_done and le not in missing]
+            for ped, elements in zip(batch, self._query_nearest(batch, n, detect_range, detect_type)):
+                cache[ped] = elements
+        return [cache[ped] for ped in peds]
+
+    def _query_nearest(self, peds: List[Person], n, detect_range, detect_type):
+        queries = np.array([[ped.getX, ped.getY] for ped in peds]).reshape(-1, 2)
+        if detect_type == ObjectType.Agent:
+            if self._ped_index is None:
+                self._indexed_peds = list(self.not_arrived_peds)
+                self._ped_slot_to_index = {ped.slot: i for i, ped in enumerate(self._indexed_peds)}
+                self._ped_index = SpatialHash(cell_size=1.5).build(
+                    np.array([[ped.getX, ped.getY] for ped in self._indexed_peds]))
+            index, elements = self._ped_index, self._indexed_peds
+            exclude = np.array([self._ped_slot_to_index.get(ped.slot, -1) for ped in peds])
+        elif detect_type == ObjectType.Wall:
+            # 解析地图时所有的墙与障碍物都是以ObjectType.Wall类型创建的
+            elements = self.obstacles + self.walls
+            indices, _ = self.obstacle_field.nearest(queries, n, detect_range / 2, max_distance=detect_range)
+            # 合并墙体时距离场中的多块墙可能属于同一个BoxWall，只保留第一次出现的
+            return [[elements[k] for k in dict.fromkeys(self.static_owner[row[row >= 0]].tolist())]
+                    for row in indices]
+        else:
+            return [[] for _ in peds]
+        indices, _ = index.query_knn(queries, n, detect_range / 2, max_distance=detect_range, exclude=exclude)
+        return [[elements[i] for i in row if i >= 0] for row in indices]
+
     def reset(self, seed: Optional[int] = None, return_info: bool = False, options: Optional[dict] = None) -> Dict[
         str, Any]:
         self.seed(seed)
@@ -484,6 +861,11 @@ class PedsMoveEnv(gym.Env):
         if self.person_handler.use_planner:
             self.person_handler.init_exit_kd_trees()  # 初始化KDTree以供后续使用
         # 添加初始观察状态
+        if self.array_output:
+            for ped in self.leaders:
+                self.person_handler.get_observation_into(ped, self.ped_to_group_dic[ped], 0,
+                                                         self._obs_view[self.agents_rev_dict[ped]])
+            return self._obs_view
         init_obs = {}
         for ped in self.peds:
             if ped.is_leader:
@@ -502,49 +884,58 @@ class PedsMoveEnv(gym.Env):
         #     if len(actions[0]) != 2: raise Exception("动作向量的长度不正确!")
         # 清空上一步的碰撞状态
 
-        for i in range(self.frame_skipping):
-            # update box2d physical world
-            for ped in self.not_arrived_peds:
-                if ped.is_done and ped.has_removed:
-                    continue
-                belong_group = self.ped_to_group_dic[ped]
-                if ped.is_leader:
-                    # 是leader用强化学习算法来控制
-                    self.person_handler.set_action(ped, actions[self.agents_rev_dict[ped]])
-                else:
-                    # 是follower用社会力模型来控制
-                    self.person_handler.set_follower_action(ped,
-                                                            actions[str(belong_group.id)],
-                                                            belong_group,
-                                                            self.terrain.exits[ped.exit_type - 3])
-                # 施加合力给行人
-                ped.body.ApplyForceToCenter(b2Vec2(ped.total_force), wake=True)
-                ped.total_force = np.zeros([2])
-            self.world.Step(1 / TICKS_PER_SEC, vel_iters, pos_iters)
-            self.world.ClearForces()
-            for ped in self.peds:
-                ped.update(self.exits, self.step_in_env, self.terrain.map)
-
-            for group in self.groups:
-                group.update()
-
-        ready_to_remove = []
-        for ped in self.not_arrived_peds:
-            if ped.is_done and not ped.has_removed:  # 移除到达出口的leader和follower
-                logging.warning("Agent{}:Leave the exit{}!".format(ped.id, ped.exit_type))
-                self._delete_person(ped, ready_to_remove)
-                if ped.is_leader:
-                    pass
-                    # self.agents.remove(self.agents_rev_dict[ped]) # 为了tianshou框架的方便，这里将到达出口的人的is_done置为False，本来应该是True的！
-        for ped in ready_to_remove:
-            self.not_arrived_peds.remove(ped)
-
+        profiler = self.profiler
+        profiler.begin()
+        if self.vectorized:
+            self._vectorized_sub_steps(actions)
+        else:
+            for i in range(self.frame_skipping):
+                # update box2d physical world
+                for ped in self.not_arrived_peds:
+                    if ped.is_done and ped.has_removed:
+                        continue
+                    belong_group = self.ped_to_group_dic[ped]
+                    if ped.is_leader:
+                        # 是leader用强化学习算法来控制
+                        self.person_handler.set_action(ped, actions[self.agents_rev_dict[ped]])
+                    else:
+                        # 是follower用社会力模型来控制
+                        self.person_handler.set_follower_action(ped,
+                                                                actions[str(belong_group.id)],
+                                                                belong_group,
+                                                                self.terrain.exits[ped.exit_type - 3])
+                    # 施加合力给行人
+                    ped.body.ApplyForceToCenter(b2Vec2(ped.total_force), wake=True)
+                    ped.total_force = np.zeros([2])
+                profiler.lap(prof.ACTIONS)
+                self._world_step()
+                for ped in self.peds:
+                    ped.update(self.exits, self.step_in_env, self.terrain.map)
+                profiler.lap(prof.PERSON_UPDATE)
+                if self.contact_tracker is not None and self.engine == "numpy":
+                    self.contact_tracker.update()
+                    profiler.lap(prof.CONTACTS)
+
+                self.group_index.update()
+                profiler.lap(prof.GROUP_UPDATE)
+
+        self._remove_arrived_peds()
+        profiler.lap(prof.REMOVAL)
+
+        self._invalidate_spatial_indices()
         # 该环境中智能体是合作关系，因此使用统一奖励为好，此处使用了pettingzoo的形式
-        obs, rewards = self.person_handler.step(self.peds, self.ped_to_group_dic, self.agents_rev_dict,
-                                                int(self.step_in_env / self.frame_skipping))
+        if self.array_output:
+            obs, rewards = self._obs_view, self._reward_view
+            self.reward_buffer[:] = 0.0
+            self.person_handler.step_into(self.peds, self.ped_to_group_dic, self.agents_rev_dict,
+                                          int(self.step_in_env / self.frame_skipping), obs, rewards)
+        else:
+            obs, rewards = self.person_handler.step(self.peds, self.ped_to_group_dic, self.agents_rev_dict,
+                                                    int(self.step_in_env / self.frame_skipping))
         if self.disable_reward:
             for key in rewards.keys():
                 rewards[key] = 0.0
+        profiler.lap(prof.HANDLER)
 
         # for idx, group in enumerate(self.groups):
         #     if group.leader.is_done:
@@ -584,18 +975,165 @@ class PedsMoveEnv(gym.Env):
         #     "leader_pos": leader_pos
         # }
         info = {agent: {} for i, agent in enumerate(self.possible_agents)}
+        profiler.end()
         return obs, rewards, is_done, truncated, info
 
+    def _vectorized_sub_steps(self, actions: Dict[str, int]):
+        """
+        step中所有子步的数组化版本，与逐个行人计算的结果一致。
+        leader与follower的列表在一个step内不变(行人只在step结束时被移除)，
+        由动作得到的方向等只在step开始时计算一次，每个子步只重新计算与位置和速度有关的部分
+        """
+        # 到达出口但未被移除的行人在本step剩余的子步中依然受力
+        leaders = [ped for ped in self._moving_leaders if not (ped.is_done and ped.has_removed)]
+        followers = [ped for ped in self._moving_followers if not (ped.is_done and ped.has_removed)]
+        groups = [self.ped_to_group_dic[ped] for ped in followers]
+        plan = self.person_handler.plan_actions_batch(leaders, [actions[self.agents_rev_dict[ped]] for ped in leaders],
+                                                      followers, [actions[str(group.id)] for group in groups], groups,
+                                                      [self.terrain.exits[ped.exit_type - 3] for ped in followers])
+        peds = plan.peds
+        self.profiler.lap(prof.ACTIONS)
+        tick, ticks = 0, self.adaptive_substeps
+        while tick < self.frame_skipping:
+            # 局部密度较高时本step剩余的子步都不再合并，省去重复的邻居查询
+            ticks = self._substep_ticks(self.frame_skipping - tick) if ticks > 1 else 1
+            self.profiler.lap(prof.SUBSTEPS)
+            self._vectorized_sub_step(plan, peds, ticks)
+            tick += ticks
+
+    def _vectorized_sub_step(self, plan: ActionPlan, peds: List[Person], ticks: int = 1):
+        profiler = self.profiler
+        self.person_handler.apply_action_plan(plan)
+        profiler.lap(prof.ACTIONS)
+        # 施加合力给行人
+        self._scatter_forces(peds)
+        profiler.lap(prof.FORCES)
+        self._world_step(ticks)
+        self._vectorized_update()
+        profiler.lap(prof.PERSON_UPDATE)
+        if self.contact_tracker is not None and self.engine == "numpy":
+            self.contact_tracker.update()
+            profiler.lap(prof.CONTACTS)
+
+        self.group_index.update()
+        profiler.lap(prof.GROUP_UPDATE)
+
+    def _substep_ticks(self, remaining: int) -> int:
+        """
+        自适应子步：局部密度较低时把多个tick合并为一次物理步，合并后的步长同时满足
+        1. 社会力的稳定性条件 dt < 2 * sqrt(m / K)，K为当前最强的行人或墙体排斥力的刚度A/|B| * exp((d - c) / B)
+        2. 自驱动力的松弛时间 dt <= tau / 2
+        3. 一步内相互接近的距离不超过行人之间(或行人与墙之间)空隙的一半，速度按步内自驱动力的最大加速度放大
+        :param remaining: 本step剩余的tick数
+        :return: 下一次物理步包含的tick数
+        """
+        horizon = min(self.adaptive_substeps, remaining)
+        if horizon <= 1 or len(self._moving_slots) == 0:
+            return max(1, horizon)
+        dt = 1 / TICKS_PER_SEC
+        slots = self._moving_slots
+        pos, vec = self.state.pos[slots], self.state.vec[slots]
+        speed = (vec[:, 0] ** 2 + vec[:, 1] ** 2) ** 0.5
+        boost = self.state.desired_velocity[slots].max() / Person.tau * horizon * dt
+        radius, sensor_radius = Person.radius, Person.radius + 1
+        reach = sensor_radius + radius
+        max_dt = Person.tau / 2
+        stiffness = 0.0
+        # 传感器范围之外的行人对没有排斥力，按范围边界处的空隙与最大的相对速度约束
+        max_dt = min(max_dt, (reach - 2 * radius) / 2 / (2 * (speed.max() + boost)))
+        a, b = SpatialHash(reach).build(pos).query_pairs(reach)
+        if len(a) > 0:
+            diff = pos[a] - pos[b]
+            dis = (diff[:, 0] ** 2 + diff[:, 1] ** 2) ** 0.5
+            stiffness = Person.A / abs(Person.B) * np.exp((dis.min() - 2 * radius) / Person.B)
+            rel_speed = np.linalg.norm(vec[a] - vec[b], axis=1) + 2 * boost
+            max_dt = min(max_dt, float(np.min(np.maximum(dis - 2 * radius, 0.0) / 2 / rel_speed)))
+        field = self.terrain.obstacle_field
+        cand, rect_dis = field.candidates(pos, sensor_radius)
+        near = np.any(cand >= 0, axis=1)
+        if np.any(near):
+            center_diff = pos[near][:, None, :] - field.centers[np.maximum(cand[near], 0)]
+            center_dis = np.where(cand[near] >= 0, np.linalg.norm(center_diff, axis=2), np.inf)
+            stiffness = max(stiffness, Person.A / abs(Person.B) * np.exp((center_dis.min() - radius - 0.5) / Person.B))
+            wall_gap = np.maximum(rect_dis[near].min(axis=1) - radius, 0.0)
+            max_dt = min(max_dt, float(np.min(wall_gap / 2 / (speed[near] + boost))))
+        if stiffness > 0:
+            max_dt = min(max_dt, self.STABILITY_SAFETY * 2 * (Person.mass / stiffness) ** 0.5)
+        return int(min(horizon, max(1, int(max_dt / dt))))
+
+    def _world_step(self, ticks: int = 1):
+        if self.contact_tracker is not None and self.engine == "box2d":
+            # Box2D在Step开始时根据上一子步结束时的位置更新接触，KinematicWorld则在积分之后
+            self.contact_tracker.update()
+            self.profiler.lap(prof.CONTACTS)
+        self.world.Step(ticks / TICKS_PER_SEC, vel_iters, pos_iters)
+        self.world.ClearForces()
+        if self.listener.resync is not None:
+            self.listener.end_resync()
+        self.profiler.lap(prof.WORLD_STEP)
+
+    def _scatter_forces(self, peds: List[Person]):
+        """
+        一次性将PedsState中的合力写回所有刚体并清零，
+        直接传入元组比构造b2Vec2少了一次SWIG对象的创建
+        """
+        force = self.state.force
+        slots = [ped.slot for ped in peds]
+        if isinstance(self.world, KinematicWorld):
+            self.world.apply_forces([ped.body for ped in peds], force[slots])
+        else:
+            for ped, f in zip(peds, force[slots].tolist()):
+                ped.body.ApplyForceToCenter(f, True)
+        force[self._moving_slots] = 0.0
+
+    def _gather_body_states(self, peds: List[Person]):
+        """
+        一次性读取所有刚体的位置与速度写入PedsState的预分配数组，
+        每个刚体只访问一次position与linearVelocity
+        """
+        if len(peds) == 0:
+            return
+        state = self.state
+        slots = [ped.slot for ped in peds]
+        if isinstance(self.world, KinematicWorld):
+            state.pos[slots], state.vec[slots] = self.world.gather([ped.body for ped in peds])
+            return
+        positions = [ped.body.position for ped in peds]
+        velocities = [ped.body.linearVelocity for ped in peds]
+        state.pos[slots] = [(p.x, p.y) for p in positions]
+        state.vec[slots] = [(v.x, v.y) for v in velocities]
+
+    def _vectorized_update(self):
+        """
+        Person.update的数组版本：同步刚体的位置与速度，并通过出口查找表批量判断行人是否到达出口
+        """
+        state = self.state
+        n = state.size
+        removed = state.removed_mask
+        self._gather_body_states([ped for ped in self.peds if not removed[ped.slot] and ped.body is not None])
+        state.pos[:n][removed] = 0.0
+        state.vec[:n][removed] = 0.0
+
+        pos = state.pos[:n]
+        w, h = self.terrain.map.shape
+        out_of_edge = (pos[:, 0] < 0) | (pos[:, 0] >= w) | (pos[:, 1] < 0) | (pos[:, 1] >= h)
+        in_exit = self.exit_lookup.query(pos, state.exit_type[:n])
+        arrived = (in_exit | out_of_edge) & ~removed
+        state.is_done[:n] |= arrived
+        state.exit_in_step[:n][arrived] = self.step_in_env
+
     def _render(self, mode: str = "human"):
         assert mode in self.metadata["render_modes"]
         import ped_env.settings as set
 
-        S = 40
+        S = self.RENDER_CELL_PIXELS
         if self.screen is None and mode == "human":
             pygame.init()
             pygame.display.init()
             S = set.init_settings(self.terrain.width, self.terrain.height)
             self.screen = pygame.display.set_mode((self.terrain.width * S, self.terrain.height * S))
+        if mode != "human" and self.renderer == "numpy" and not self.debug_mode:
+            return self._rasterize(mode, (self.terrain.width * S, self.terrain.height * S), set.RENDER_SCALE)
         if self.clock is None:
             self.clock = pygame.time.Clock()
 
@@ -671,6 +1209,23 @@ class PedsMoveEnv(gym.Env):
             )[:, :]
             return data if mode == "rgb_array" else cv2.cvtColor(data, cv2.COLOR_RGB2GRAY)
 
+    def _rasterize(self, mode: str, size: Tuple[int, int], scale: float):
+        """
+        使用Rasterizer渲染rgb_array或gray_array，静态背景只在重新创建静态刚体或缩放比例改变时重新光栅化
+        """
+        self.render_scale = scale
+        statics = self.exits + self.obstacles + self.walls
+        key = (size, scale)
+        if self._rasterizer is None or self._rasterizer_key != key:
+            self._rasterizer = Rasterizer(size[0], size[1], scale, statics)
+            self._rasterizer_key = key
+        peds = list(self.not_arrived_peds)
+        positions = np.array([(ped.getX, ped.getY) for ped in peds]).reshape(-1, 2)
+        radii = np.array([ped.radius for ped in peds])
+        colors = np.array([ped.color for ped in peds]).reshape(-1, 3)
+        # 缓冲区会在下一次渲染时被覆盖，因此返回一份拷贝
+        return self._rasterizer.render(positions, radii, colors, mode).copy()
+
     def render(self, mode="human", ratio=1):
         """
         mode为human时，代表显示经过pygame渲染的图像
@@ -679,14 +1234,176 @@ class PedsMoveEnv(gym.Env):
 
         mode为gray_array时，代表返回经过pygame渲染的图像并灰度化，将数据存放在render_data属性
         """
+        start = self.profiler.now()
         self.render_data = self._render(mode)
+        self.profiler.record(prof.RENDER, start)
+
+    def profile_summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: 最近至多1024个step中各阶段耗时的统计(微秒)与占比，需要在创建环境时指定profile=True，否则为空字典。
+                 非数组化的子步中自驱动力的计算与施加计入actions，render为调用render的耗时(在step内调用时同时计入所在的阶段)
+        """
+        return self.profiler.summary()
+
+    CONTACT_DICTS = ("collide_agents", "detected_agents", "collide_obstacles", "detected_obstacles")
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        """
+        回合中途的快照，全部由numpy数组组成(可以直接用np.savez保存)：行人的状态数组与刚体、尚未到达出口的行人、
+        团体成员、follower的A*路径、接触关系、计数器、全局随机数发生器以及person_handler的状态。
+        只能通过set_state恢复到同一回合(同一次reset之后)的这个环境中
+        """
+        index = {ped: i for i, ped in enumerate(self.peds)}
+        alive = list(self.not_arrived_peds)
+        np_random = np.random.get_state()
+        py_random = random.getstate()
+        arrays = {
+            "episode": np.array([self._episode], dtype=np.int64),
+            "ped_id": np.array([ped.id for ped in self.peds], dtype=np.int64),
+            "counters": np.array([self.step_in_env, self.left_person_num, self.left_leader_num,
+                                  self.collide_wall_count, self.collide_agents_count], dtype=np.int64),
+            "agents": np.array([agent in self.agents for agent in self.possible_agents], dtype=bool),
+            "alive": np.array([index[ped] for ped in alive], dtype=np.int64),
+            "reward_in_episode": np.array([ped.reward_in_episode for ped in self.peds], dtype=np.float64),
+            "person_state": np.array([ped.person_state.value for ped in self.peds], dtype=np.int64),
+            "force_last_eps": np.array([[*ped.fij_force_last_eps, *ped.fiw_force_last_eps] for ped in self.peds],
+                                       dtype=np.float64).reshape(-1, 4),
+            # 路径只与起点和终点有关，恢复时从路径缓存中重新取得
+            "a_star_path": np.array([[-1] * 4 if ped.a_star_path is None else
+                                     [*ped.a_star_path.start_pos, *ped.a_star_path.end_pos] for ped in self.peds],
+                                    dtype=np.int64).reshape(-1, 4),
+            "group_leader": np.array([index[group.leader] for group in self.groups], dtype=np.int64),
+            "group_followers": np.array([index[ped] for group in self.groups for ped in group.followers],
+                                        dtype=np.int64),
+            "points_in_last_step": np.array(self.points_in_last_step, dtype=np.float64).reshape(-1, 2),
+            "distance_to_exit": np.array(self.distance_to_exit, dtype=np.float64),
+            "np_random_keys": np_random[1].copy(),
+            "np_random_meta": np.array(np_random[2:4], dtype=np.int64),
+            "np_random_gauss": np.array([np_random[4]], dtype=np.float64),
+            "py_random": np.array((py_random[0],) + py_random[1], dtype=np.int64),
+            "py_random_gauss": np.array([np.nan if py_random[2] is None else py_random[2]], dtype=np.float64),
+        }
+        for name in PedsState.FIELDS:
+            arrays["state/" + name] = getattr(self.state, name)[:self.state.size].copy()
+        for name in self.CONTACT_DICTS:
+            # 字典的顺序会影响社会力的累加顺序，按插入顺序保存
+            arrays["contacts/" + name] = np.array([(i, key) for i, ped in enumerate(self.peds)
+                                                   for key in getattr(ped, name)], dtype=np.int64).reshape(-1, 2)
+        if self.contact_tracker is not None:
+            for name, keys in self.contact_tracker.pairs.items():
+                arrays["tracker/" + name] = keys.copy()
+        if isinstance(self.world, KinematicWorld):
+            for name, value in self.world.get_state().items():
+                arrays["world/" + name] = value
+        else:
+            arrays["bodies"] = np.array([[*ped.body.position, *ped.body.linearVelocity, ped.body.angle,
+                                          ped.body.angularVelocity] for ped in alive], dtype=np.float64).reshape(-1, 6)
+        for name, value in self.person_handler.get_state().items():
+            arrays["handler/" + name] = value
+        return arrays
+
+    def set_state(self, arrays: Dict[str, np.ndarray]):
+        """
+        将get_state得到的快照恢复到当前环境中，之后以相同的动作step得到的结果逐位相同。
+        numpy引擎直接原地写回刚体数组，与不经过快照继续运行的结果也相同；
+        box2d引擎重建物理世界，接触缓存(warm starting)无法恢复，从同一快照出发的各个分支之间逐位相同，
+        但与不经过快照继续运行的结果不同，并且需要spatial_index=True(QueryAABB返回的顺序取决于宽相位树)
+        """
+        assert int(arrays["episode"][0]) == self._episode and \
+            np.array_equal(arrays["ped_id"], [ped.id for ped in self.peds]), u"快照不属于当前回合!"
+        current = set(self.not_arrived_peds)
+        alive = [self.peds[i] for i in arrays["alive"].tolist()]
+        for ped in current.difference(alive):
+            ped.delete(self.world, keep_body=self.reuse_world)
+        if isinstance(self.world, KinematicWorld):
+            for ped in alive:
+                if ped.body is None:  # KinematicWorld中销毁的刚体只是被停用，通过夹具找回
+                    ped.body = ped.box.body
+            self.world.set_state({name[len("world/"):]: value for name, value in arrays.items()
+                                  if name.startswith("world/")})
+        else:
+            # 宽相位树中的编号与接触的顺序取决于刚体创建和销毁的历史，会影响之后的求解结果，无法原地恢复，
+            # 因此重新创建物理世界与静态刚体(编号与reset时相同)，再按槽位顺序重建行人的刚体
+            BoxWall.counter = Exit.counter = 0
+            self._create_world(self.terrain.map, self.terrain.map_spawn)
+            self._render_statics = self.exits + self.obstacles + self.walls
+            if self.contacts == "array":
+                self.contact_tracker = ContactTracker(self)
+            for ped in self.peds:
+                ped.body = None  # 属于旧的物理世界
+            for ped, (x, y, vx, vy, angle, omega) in zip(alive, arrays["bodies"].tolist()):
+                ped.create_body(self.world, x, y, self._with_sensor)
+                ped.body.angle = angle
+                ped.body.linearVelocity = (vx, vy)
+                ped.body.angularVelocity = omega
+            if self.reuse_world:
+                # 对象池中的其它行人在下一回合重新启用时会移动到新的位置
+                for ped in self._ped_pool:
+                    if ped.body is None:
+                        ped.create_body(self.world, 0, 0, self._with_sensor)
+                        ped.body.active = False
+        self.not_arrived_peds = ActiveList(alive)
+        self._update_vectorized_indices()
+
+        for name in PedsState.FIELDS:
+            getattr(self.state, name)[:self.state.size] = arrays["state/" + name]
+        paths = self.person_handler.path_cache
+        for ped, reward, person_state, forces, path in zip(self.peds, arrays["reward_in_episode"].tolist(),
+                                                           arrays["person_state"].tolist(),
+                                                           arrays["force_last_eps"], arrays["a_star_path"].tolist()):
+            ped.reward_in_episode = reward
+            ped.person_state = PersonState(person_state)
+            ped.fij_force_last_eps, ped.fiw_force_last_eps = forces[:2].copy(), forces[2:].copy()
+            ped.a_star_path = None if path[0] < 0 else paths.get((path[0], path[1]), (path[2], path[3]))
+            for name in self.CONTACT_DICTS:
+                getattr(ped, name).clear()
+        models = {ped.id: ped for ped in self.peds}
+        statics = {wall.id: wall for wall in self.obstacles + self.walls}
+        for name in self.CONTACT_DICTS:
+            lookup = models if name.endswith("agents") else statics
+            for i, key in arrays["contacts/" + name].tolist():
+                getattr(self.peds[i], name)[key] = lookup[key]
+        if self.contact_tracker is not None:
+            self.contact_tracker.pairs = {name: arrays["tracker/" + name].copy() for name in self.contact_tracker.pairs}
+        elif self.contacts == "listener" and not isinstance(self.world, KinematicWorld):
+            self.listener.begin_resync()
+
+        followers = np.split(arrays["group_followers"],
+                             np.cumsum([len(group.followers) for group in self.groups])[:-1])
+        changed = False
+        for group, leader, members in zip(self.groups, arrays["group_leader"].tolist(), followers):
+            members = [self.peds[i] for i in members.tolist()]
+            if group.leader is not self.peds[leader] or group.followers != members:
+                group.leader, group.followers = self.peds[leader], members
+                group.followers_set = set(members)
+                changed = True
+        if changed:
+            self.group_index.rebuild()
+        self.group_index.update()
+
+        (self.step_in_env, self.left_person_num, self.left_leader_num, self.collide_wall_count,
+         self.collide_agents_count) = arrays["counters"].tolist()
+        self.agents = [agent for agent, active in zip(self.possible_agents, arrays["agents"].tolist()) if active]
+        self.points_in_last_step = [tuple(pos) for pos in arrays["points_in_last_step"].tolist()]
+        self.distance_to_exit = arrays["distance_to_exit"].tolist()
+        self.person_handler.set_state({name[len("handler/"):]: value for name, value in arrays.items()
+                                       if name.startswith("handler/")})
+        pos, has_gauss = arrays["np_random_meta"].tolist()
+        np.random.set_state(("MT19937", arrays["np_random_keys"].copy(), pos, has_gauss,
+                             float(arrays["np_random_gauss"][0])))
+        gauss = float(arrays["py_random_gauss"][0])
+        py_random = arrays["py_random"].tolist()
+        random.setstate((py_random[0], tuple(py_random[1:]), None if np.isnan(gauss) else gauss))
+        # 观察相关的缓存(最近邻、渲染结果等)以frame_count为键，全部失效
+        self._invalidate_spatial_indices()
 
     def close(self):
         """
         销毁行人仿真环境的函数
         """
         self.peds = []
-        self.elements = []
+        self.not_arrived_peds = ActiveList()
+        self._render_statics = []
         self.ped_to_group_dic = {}
         self.groups = []
         self.leaders = []
@@ -0,0 +1,556 @@
+import math
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from ped_env.utils.misc import ObjectType
+from ped_env.utils.spatial import SpatialHash
+
+Vec2 = namedtuple("Vec2", ["x", "y"])
+
+
+class KinematicFixture:
+    """
+    对应b2Fixture，只记录形状信息与userData
+    圆形: radius > 0；矩形: half_extents不为None
+    """
+
+    def __init__(self, uid, body, is_sensor, radius=0.0, half_extents=None, user_data=None):
+        self.uid = uid
+        self.body = body
+        self.isSensor = is_sensor
+        self.radius = radius
+        self.half_extents = half_extents
+        self.userData = user_data
+
+
+class KinematicContact:
+    """对应b2Contact，供MyContactListener读取fixtureA,fixtureB"""
+
+    def __init__(self, fixtureA, fixtureB):
+        self.fixtureA = fixtureA
+        self.fixtureB = fixtureB
+
+
+class KinematicBody:
+    """
+    对应b2Body，动态刚体的位置、速度与受力都存放在KinematicWorld的数组中
+    """
+
+    def __init__(self, world, index, position, dynamic):
+        self.world = world
+        self.index = index
+        self.dynamic = dynamic
+        self.fixtures = []
+        self.allowSleep = True
+        self.angle = 0.0
+        self._static_position = Vec2(float(position[0]), float(position[1]))
+
+    @property
+    def position(self):
+        if not self.dynamic:
+            return self._static_position
+        x, y = self.world.positions[self.index]
+        return Vec2(float(x), float(y))
+
+    @position.setter
+    def position(self, value):
+        if not self.dynamic:
+            self._static_position = Vec2(float(value[0]), float(value[1]))
+        else:
+            self.world.positions[self.index] = value[0], value[1]
+
+    @property
+    def linearVelocity(self):
+        if not self.dynamic:
+            return Vec2(0.0, 0.0)
+        x, y = self.world.velocities[self.index]
+        return Vec2(float(x), float(y))
+
+    @linearVelocity.setter
+    def linearVelocity(self, value):
+        if self.dynamic:
+            self.world.velocities[self.index] = value[0], value[1]
+
+    @property
+    def active(self):
+        return not self.dynamic or bool(self.world.active[self.index])
+
+    @active.setter
+    def active(self, value):
+        if not self.dynamic:
+            return
+        if value:
+            self.world.active[self.index] = True
+            self.world._group_ids = None  # 复用的行人可能属于新的团体
+        else:
+            self.world.DestroyBody(self)
+
+    def ApplyForceToCenter(self, force, wake=True):
+        if self.dynamic:
+            self.world.forces[self.index] += (force[0], force[1])
+
+    def CreateFixture(self, fixtureDef):
+        shape = fixtureDef.shape
+        if hasattr(shape, "radius") and not hasattr(shape, "vertices"):
+            fixture = self.world._create_fixture(self, fixtureDef.isSensor, radius=shape.radius,
+                                                 user_data=fixtureDef.userData, density=fixtureDef.density)
+        else:
+            xs = [v[0] for v in shape.vertices]
+            ys = [v[1] for v in shape.vertices]
+            half_extents = ((max(xs) - min(xs)) / 2, (max(ys) - min(ys)) / 2)
+            fixture = self.world._create_fixture(self, fixtureDef.isSensor, half_extents=half_extents,
+                                                 user_data=fixtureDef.userData)
+        return fixture
+
+    def CreatePolygonFixture(self, box, density=0):
+        return self.world._create_fixture(self, False, half_extents=(box[0], box[1]))
+
+
+class KinematicWorld:
+    """
+    不依赖Box2D刚体求解的运动学社会力世界，接口上模仿b2World中PedsMoveEnv用到的部分，
+    行人之间与行人和墙之间不做刚体碰撞，而是由fij_force/fiw_force的排斥力分开，
+    排斥力默认在Step中批量计算(social_forces)，处理器在set_action中自己施加时(PEDS_APPLY_SOCIAL_FORCE)由环境关闭，避免施加两次，
+    墙体穿透时将行人沿法线推出并去掉指向墙内的速度分量，
+    接触(碰撞、传感器探测、到达出口)依然通过contactListener回调，保证奖励与统计的语义不变
+    """
+    MAX_TRANSLATION = 2.0  # 与Box2D的b2_maxTranslation一致，单步最大位移
+    CLIP_ITERATIONS = 2
+    POLYGON_RADIUS = 0.01  # 与Box2D的b2_polygonRadius一致，墙被推出后仍视为接触
+
+    def __init__(self, gravity=(0, 0), doSleep=True, capacity=64):
+        self.contactListener = None
+        self.track_contacts = True  # 为False时不再计算接触(由ContactTracker代替)
+        self.social_forces = True  # 为False时不计算排斥力，由处理器调用Person.fij_force与Person.fiw_force施加
+        self.positions = np.zeros([capacity, 2])
+        self.velocities = np.zeros([capacity, 2])
+        self.forces = np.zeros([capacity, 2])
+        self.mass = np.zeros([capacity])
+        self.radius = np.zeros([capacity])
+        self.sensor_radius = np.zeros([capacity])
+        self.active = np.zeros([capacity], dtype=bool)
+        self.bodies: List[KinematicBody] = []
+        self.static_bodies: List[KinematicBody] = []
+        self.fixtures = {}
+        self._solid_fixtures: List[Optional[KinematicFixture]] = []
+        self._sensor_fixtures: List[Optional[KinematicFixture]] = []
+        self._static_fixtures: List[KinematicFixture] = []
+        self._static_table = None
+        self._group_ids = None
+        self._is_leader = None
+        self._contacts = set()
+        self._next_uid = 0
+
+    # ---------------------------- 刚体与夹具 ----------------------------
+    def CreateDynamicBody(self, position):
+        index = len(self.bodies)
+        if index >= len(self.positions):
+            self._grow(len(self.positions) * 2)
+        body = KinematicBody(self, index, position, dynamic=True)
+        self.positions[index] = position
+        self.velocities[index] = 0.0
+        self.forces[index] = 0.0
+        self.active[index] = True
+        self.bodies.append(body)
+        self._solid_fixtures.append(None)
+        self._sensor_fixtures.append(None)
+        self._group_ids = None
+        return body
+
+    def CreateStaticBody(self, position):
+        body = KinematicBody(self, len(self.static_bodies), position, dynamic=False)
+        self.static_bodies.append(body)
+        return body
+
+    def DestroyBody(self, body: KinematicBody):
+        if not body.dynamic or not self.active[body.index]:
+            return
+        self.active[body.index] = False
+        uids = {fixture.uid for fixture in body.fixtures}
+        for pair in [pair for pair in self._contacts if pair[0] in uids or pair[1] in uids]:
+            self._end_contact(pair)
+
+    def _grow(self, new_capacity):
+        for name in ("positions", "velocities", "forces", "mass", "radius", "sensor_radius", "active"):
+            old = getattr(self, name)
+            new = np.zeros((new_capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _create_fixture(self, body, is_sensor, radius=0.0, half_extents=None, user_data=None, density=0.0):
+        fixture = KinematicFixture(self._next_uid, body, is_sensor, radius, half_extents, user_data)
+        self._next_uid += 1
+        self.fixtures[fixture.uid] = fixture
+        body.fixtures.append(fixture)
+        if body.dynamic:
+            if is_sensor:
+                self.sensor_radius[body.index] = radius
+                self._sensor_fixtures[body.index] = fixture
+            else:
+                self.radius[body.index] = radius
+                self.mass[body.index] += density * math.pi * radius ** 2
+                self._solid_fixtures[body.index] = fixture
+        else:
+            self._static_fixtures.append(fixture)
+            self._static_table = None
+        return fixture
+
+    # ---------------------------- 仿真 ----------------------------
+    def ClearForces(self):
+        self.forces[:] = 0.0
+
+    def Step(self, time_step, velocity_iterations=0, position_iterations=0):
+        n = len(self.bodies)
+        if n == 0:
+            return
+        if self._static_table is None:
+            self._build_static_table()
+        if self._group_ids is None:
+            self._build_group_ids()
+        idx = np.flatnonzero(self.active[:n])
+        pos, vec = self.positions[idx], self.velocities[idx]
+        radius, sensor_radius = self.radius[idx], self.sensor_radius[idx]
+
+        if self.social_forces:
+            force = self._social_forces(idx, pos, radius, sensor_radius)
+        else:
+            force = np.zeros_like(pos)
+
+        # 半隐式欧拉积分
+        mass = np.where(self.mass[idx] > 0, self.mass[idx], 1.0)
+        vec = vec + (self.forces[idx] + force) / mass[:, None] * time_step
+        translation = vec * time_step
+        length = np.linalg.norm(translation, axis=1)
+        too_fast = length > self.MAX_TRANSLATION
+        if np.any(too_fast):
+            scale = self.MAX_TRANSLATION / length[too_fast]
+            vec[too_fast] *= scale[:, None]
+            translation[too_fast] *= scale[:, None]
+        pos = pos + translation
+        for _ in range(self.CLIP_ITERATIONS):
+            pos, vec = self._clip_walls(pos, vec, radius)
+        self.positions[idx] = pos
+        self.velocities[idx] = vec
+        if self.track_contacts:
+            self._update_contacts(idx, pos, radius, sensor_radius)
+
+    def _social_forces(self, idx, pos, radius, sensor_radius):
+        """
+        :return: 与Person.fij_force和Person.fiw_force相同的行人之间与行人和墙之间的排斥力
+        """
+        # 行人之间的排斥力(fij_force)，近邻对由空间哈希给出
+        from ped_env.objects import Person
+        force = np.zeros_like(pos)
+        a, b, diff, dis = self._neighbour_pairs(pos, radius, sensor_radius)
+        detected = (dis < sensor_radius[a] + radius[b]) | (dis < sensor_radius[b] + radius[a])
+        group = self._group_ids[idx]
+        same_group = group[a] == group[b]
+        leader = self._is_leader[idx]
+        fij = Person.A * np.exp((dis - radius[a] - radius[b]) / Person.B)
+        fij = np.where(same_group, fij * 0.2, fij) * detected
+        # leader不受自己团体成员的排斥力
+        np.add.at(force, a, (fij * ~(leader[a] & same_group))[:, None] * diff)
+        np.add.at(force, b, -(fij * ~(leader[b] & same_group))[:, None] * diff)
+
+        # 行人与墙之间的排斥力(fiw_force)
+        cand, rect_dis, center_diff = self._static_candidates(pos)
+        wall = cand >= 0
+        wall &= self._static_is_wall[np.maximum(cand, 0)]
+        wall &= rect_dis < sensor_radius[:, None]
+        center_dis = (center_diff[:, :, 0] ** 2 + center_diff[:, :, 1] ** 2) ** 0.5
+        fiw = Person.A * np.exp((center_dis - radius[:, None] - 0.5) / Person.B) * wall
+        force += (fiw[:, :, None] * center_diff).sum(axis=1)
+        return force
+
+    def _neighbour_pairs(self, pos, radius, sensor_radius):
+        """
+        :return: 可能相互接触或探测到的行人对(a, b)，a < b，以及pos[a] - pos[b]与其长度
+        """
+        reach = float(sensor_radius.max(initial=0.0) + radius.max(initial=0.0))
+        if len(pos) < 2 or reach <= 0:
+            empty = np.zeros([0], dtype=np.int64)
+            return empty, empty, np.zeros([0, 2]), np.zeros([0])
+        a, b = SpatialHash(reach).build(pos).query_pairs(reach)
+        diff = pos[a] - pos[b]
+        dis = (diff[:, 0] ** 2 + diff[:, 1] ** 2) ** 0.5
+        return a, b, diff, dis
+
+    def _build_group_ids(self):
+        n = len(self.bodies)
+        self._group_ids = np.arange(n) + n  # 没有团体的行人只与自己同组
+        self._is_leader = np.zeros([n], dtype=bool)
+        for i, fixture in enumerate(self._solid_fixtures):
+            model = getattr(fixture.userData, "model", None) if fixture is not None else None
+            group = getattr(model, "group", None)
+            if group is not None:
+                self._group_ids[i] = group.id
+                self._is_leader[i] = model.is_leader
+
+    def _build_static_table(self):
+        """
+        以地图方格为单位，记录每个方格附近(传感器范围内)可能接触到的静态夹具，
+        查询时只需按行人所在方格取出候选夹具
+        """
+        fixtures = self._static_fixtures
+        self._static_center = np.array([f.body.position for f in fixtures], dtype=np.float64).reshape(-1, 2)
+        self._static_half = np.array([f.half_extents for f in fixtures], dtype=np.float64).reshape(-1, 2)
+        self._static_is_sensor = np.array([f.isSensor for f in fixtures], dtype=bool)
+        types = [getattr(f.userData, "type", None) for f in fixtures]
+        self._static_is_wall = np.array([t in (ObjectType.Wall, ObjectType.Obstacle) for t in types], dtype=bool)
+        self._static_is_wall &= ~self._static_is_sensor
+        if len(fixtures) == 0:
+            self._static_table = np.full([1, 1, 1], -1, dtype=np.int64)
+            return
+        margin = max(1.0, float(self.sensor_radius.max()) + 0.5)
+        low = np.floor(self._static_center - self._static_half - margin).astype(np.int64)
+        high = np.floor(self._static_center + self._static_half + margin).astype(np.int64)
+        width = int(max(1, high[:, 0].max() + 1))
+        height = int(max(1, high[:, 1].max() + 1))
+        cells = [[[] for _ in range(height)] for _ in range(width)]
+        for k in range(len(fixtures)):
+            for i in range(max(0, low[k, 0]), high[k, 0] + 1):
+                for j in range(max(0, low[k, 1]), high[k, 1] + 1):
+                    cells[i][j].append(k)
+        depth = max(1, max(len(c) for column in cells for c in column))
+        table = np.full([width, height, depth], -1, dtype=np.int64)
+        for i in range(width):
+            for j in range(height):
+                table[i, j, :len(cells[i][j])] = cells[i][j]
+        self._static_table = table
+
+    def _static_candidates(self, pos):
+        """
+        :return: 候选静态夹具编号(N,K)(-1为空)，行人中心到矩形的距离(N,K)，行人中心相对矩形中心的向量(N,K,2)
+        """
+        table = self._static_table
+        cx = np.clip(pos[:, 0].astype(np.int64), 0, table.shape[0] - 1)
+        cy = np.clip(pos[:, 1].astype(np.int64), 0, table.shape[1] - 1)
+        cand = table[cx, cy]
+        safe = np.maximum(cand, 0)
+        if len(self._static_center) == 0:
+            return cand, np.full(cand.shape, np.inf), np.zeros(cand.shape + (2,))
+        center_diff = pos[:, None, :] - self._static_center[safe]
+        outside = np.maximum(np.abs(center_diff) - self._static_half[safe], 0.0)
+        rect_dis = np.where(cand >= 0, np.linalg.norm(outside, axis=2), np.inf)
+        return cand, rect_dis, center_diff
+
+    # ---------------------------- 静态几何查询 ----------------------------
+    def static_candidates(self, pos):
+        """
+        按地图方格查询位置附近的静态夹具，供批量环境等外部模块使用
+        :param pos: 位置(N,2)
+        :return: 候选静态夹具编号(N,K)(-1为空)，位置到矩形的距离(N,K)，位置相对矩形中心的向量(N,K,2)
+        """
+        if self._static_table is None:
+            self._build_static_table()
+        return self._static_candidates(np.asarray(pos, dtype=np.float64))
+
+    def static_wall_mask(self, cand):
+        """:return: 候选编号中哪些是墙或障碍物(不含传感器)"""
+        return (cand >= 0) & self._static_is_wall[np.maximum(cand, 0)]
+
+    def static_solid_mask(self, cand):
+        """:return: 候选编号中哪些是实心夹具(非传感器)"""
+        return (cand >= 0) & ~self._static_is_sensor[np.maximum(cand, 0)]
+
+    def static_boxes(self, index):
+        """:return: 静态夹具矩形的中心与半边长"""
+        return self._static_center[index], self._static_half[index]
+
+    def _clip_walls(self, pos, vec, radius):
+        """将与实心静态夹具重叠的行人沿法线推出，并去掉指向墙内的速度分量"""
+        cand, rect_dis, center_diff = self._static_candidates(pos)
+        solid = (cand >= 0) & ~self._static_is_sensor[np.maximum(cand, 0)]
+        overlap = solid & (rect_dis < radius[:, None])
+        rows, cols = np.nonzero(overlap)
+        if len(rows) == 0:
+            return pos, vec
+        pos, vec = pos.copy(), vec.copy()
+        for i, k in zip(rows, cols):
+            s = cand[i, k]
+            half = self._static_half[s]
+            rel = pos[i] - self._static_center[s]
+            closest = np.clip(rel, -half, half)
+            normal = rel - closest
+            dist = np.linalg.norm(normal)
+            if dist > 0:
+                normal /= dist
+                depth = radius[i] - dist
+            else:
+                # 中心已经在矩形内部，沿穿透最浅的轴推出
+                pen = half - np.abs(rel)
+                axis = int(np.argmin(pen))
+                normal = np.zeros(2)
+                normal[axis] = 1.0 if rel[axis] >= 0 else -1.0
+                depth = pen[axis] + radius[i]
+            if depth <= 0:
+                continue
+            pos[i] += normal * depth
+            vn = vec[i].dot(normal)
+            if vn < 0:
+                vec[i] -= vn * normal
+        return pos, vec
+
+    # ---------------------------- 接触 ----------------------------
+    def _update_contacts(self, idx, pos, radius, sensor_radius):
+        contacts = set()
+        solid = [self._solid_fixtures[i] for i in idx]
+        sensor = [self._sensor_fixtures[i] for i in idx]
+
+        a, b, _, dis = self._neighbour_pairs(pos, radius, sensor_radius)
+        touching = dis < radius[a] + radius[b]
+        for i, j in zip(a[touching], b[touching]):
+            contacts.add(self._pair(solid[i], solid[j]))
+        for sensed, target in ((a, b), (b, a)):
+            hit = dis < sensor_radius[sensed] + radius[target]
+            for i, j in zip(sensed[hit], target[hit]):
+                if sensor[i] is not None:
+                    contacts.add(self._pair(sensor[i], solid[j]))
+
+        cand, rect_dis, _ = self._static_candidates(pos)
+        for i, k in zip(*np.nonzero((cand >= 0) & (rect_dis < radius[:, None] + self.POLYGON_RADIUS))):
+            contacts.add(self._pair(solid[i], self._static_fixtures[cand[i, k]]))
+        sensed = (cand >= 0) & (rect_dis < sensor_radius[:, None]) & ~self._static_is_sensor[np.maximum(cand, 0)]
+        for i, k in zip(*np.nonzero(sensed)):
+            if sensor[i] is not None:
+                contacts.add(self._pair(sensor[i], self._static_fixtures[cand[i, k]]))
+
+        for pair in self._contacts - contacts:
+            self._end_contact(pair)
+        for pair in contacts - self._contacts:
+            self._begin_contact(pair)
+
+    @staticmethod
+    def _pair(fa, fb):
+        return (fa.uid, fb.uid) if fa.uid < fb.uid else (fb.uid, fa.uid)
+
+    def _begin_contact(self, pair):
+        self._contacts.add(pair)
+        if self.contactListener is not None:
+            self.contactListener.BeginContact(KinematicContact(self.fixtures[pair[0]], self.fixtures[pair[1]]))
+
+    def _end_contact(self, pair):
+        self._contacts.discard(pair)
+        if self.contactListener is not None:
+            self.contactListener.EndContact(KinematicContact(self.fixtures[pair[0]], self.fixtures[pair[1]]))
+
+    # ---------------------------- 快照 ----------------------------
+    def get_state(self) -> Dict[str, np.ndarray]:
+        """
+        :return: 动态刚体的位置、速度、是否启用以及当前的接触(按集合的迭代顺序)
+        """
+        n = len(self.bodies)
+        return {"positions": self.positions[:n].copy(), "velocities": self.velocities[:n].copy(),
+                "active": self.active[:n].copy(),
+                "contacts": np.array(list(self._contacts), dtype=np.int64).reshape(-1, 2)}
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        """
+        原地恢复get_state的结果，不触发接触回调，刚体数量需要与快照时相同
+        """
+        n = len(self.bodies)
+        assert len(state["positions"]) == n, u"刚体数量与快照不一致!"
+        self.positions[:n] = state["positions"]
+        self.velocities[:n] = state["velocities"]
+        self.active[:n] = state["active"]
+        self.forces[:n] = 0.0
+        self._contacts = set(map(tuple, state["contacts"].tolist()))
+        self._group_ids = None
+
+    # ---------------------------- 查询 ----------------------------
+    def QueryAABB(self, callback, aabb):
+        lx, ly = aabb.lowerBound[0], aabb.lowerBound[1]
+        ux, uy = aabb.upperBound[0], aabb.upperBound[1]
+        n = len(self.bodies)
+        if n > 0:
+            pos = self.positions[:n]
+            for fixtures, r in ((self._solid_fixtures, self.radius[:n]), (self._sensor_fixtures, self.sensor_radius[:n])):
+                hit = self.active[:n] & (pos[:, 0] + r >= lx) & (pos[:, 0] - r <= ux) & \
+                      (pos[:, 1] + r >= ly) & (pos[:, 1] - r <= uy)
+                for i in np.flatnonzero(hit):
+                    if fixtures[i] is not None and not callback.ReportFixture(fixtures[i]):
+                        return
+        if self._static_table is None:
+            self._build_static_table()
+        if len(self._static_fixtures) > 0:
+            c, h = self._static_center, self._static_half
+            hit = (c[:, 0] + h[:, 0] >= lx) & (c[:, 0] - h[:, 0] <= ux) & (c[:, 1] + h[:, 1] >= ly) & \
+                  (c[:, 1] - h[:, 1] <= uy)
+            for k in np.flatnonzero(hit):
+                if not callback.ReportFixture(self._static_fixtures[k]):
+                    return
+
+    def RayCast(self, callback, point1, point2):
+        """
+        与b2World.RayCast相同：对线段point1->point2穿入的每个夹具(包括传感器，起点在其内部的除外)调用
+        callback.ReportFixture(fixture, point, normal, fraction)，返回值为-1时忽略该夹具，为0时结束，
+        否则将线段截短到返回的比例。这里按fraction由小到大依次报告
+        """
+        p1 = np.array([point1[0], point1[1]], dtype=np.float64)
+        d = np.array([point2[0], point2[1]], dtype=np.float64) - p1
+        rr = float(d @ d)
+        if rr <= 1e-12:
+            return
+        hits = []  # (fraction, 序号, 夹具, 法线)
+
+        # 圆形(行人的刚体与传感器)，只有从外部穿入时才算命中
+        n = len(self.bodies)
+        if n > 0:
+            s = p1 - self.positions[:n]
+            c = s @ d
+            for fixtures, r in ((self._solid_fixtures, self.radius[:n]), (self._sensor_fixtures, self.sensor_radius[:n])):
+                sigma = c ** 2 - rr * ((s ** 2).sum(axis=1) - r ** 2)
+                a = -(c + np.sqrt(np.maximum(sigma, 0.0)))
+                hit = self.active[:n] & (r > 0) & (sigma >= 0) & (a >= 0) & (a <= rr)
+                for i in np.flatnonzero(hit):
+                    fraction = a[i] / rr
+                    normal = s[i] + fraction * d
+                    hits.append((fraction, len(hits), fixtures[i], normal / np.linalg.norm(normal)))
+
+        # 矩形(墙、障碍物与出口)，按坐标轴的slab求穿入点
+        if self._static_table is None:
+            self._build_static_table()
+        for k in range(len(self._static_fixtures)):
+            lower, upper, normal = 0.0, 1.0, None
+            for axis in range(2):
+                lo = self._static_center[k, axis] - self._static_half[k, axis]
+                hi = self._static_center[k, axis] + self._static_half[k, axis]
+                if abs(d[axis]) < 1e-12:
+                    if p1[axis] < lo or p1[axis] > hi:
+                        break
+                    continue
+                t1, t2, sign = (lo - p1[axis]) / d[axis], (hi - p1[axis]) / d[axis], -1.0
+                if t1 > t2:
+                    t1, t2, sign = t2, t1, 1.0
+                if t1 > lower:
+                    lower, normal = t1, (sign, 0.0) if axis == 0 else (0.0, sign)
+                upper = min(upper, t2)
+                if lower > upper:
+                    break
+            else:
+                if normal is not None:
+                    hits.append((lower, len(hits), self._static_fixtures[k], np.array(normal)))
+
+        max_fraction = 1.0
+        for fraction, _, fixture, normal in sorted(hits, key=lambda hit: hit[:2]):
+            if fraction > max_fraction:
+                break
+            point = p1 + fraction * d
+            value = callback.ReportFixture(fixture, Vec2(float(point[0]), float(point[1])),
+                                           Vec2(float(normal[0]), float(normal[1])), float(fraction))
+            if value == 0:
+                return
+            if value > 0:
+                max_fraction = min(max_fraction, value)
+
+    # ---------------------------- 批量读写 ----------------------------
+    def apply_forces(self, bodies: List[KinematicBody], forces: np.ndarray):
+        """一次性给多个动态刚体施加力"""
+        np.add.at(self.forces, [body.index for body in bodies], forces)
+
+    def gather(self, bodies: List[KinematicBody]):
+        """一次性读取多个动态刚体的位置与速度"""
+        index = [body.index for body in bodies]
+        return self.positions[index], self.velocities[index]
@@ -1,11 +1,39 @@
+import numpy as np
 from Box2D import b2ContactListener, b2Contact
 from ped_env.utils.misc import ObjectType
+from ped_env.utils.spatial import SpatialHash
 
 
 class MyContactListener(b2ContactListener):
     def __init__(self, env):
         super(MyContactListener, self).__init__()
         self.env = env
+        self.resync = None  # 恢复快照后第一次Step中重新开始的接触，见begin_resync
+
+    def begin_resync(self):
+        """
+        Box2D恢复快照时重建了行人的刚体，下一次Step会对所有仍然重叠的接触重新调用BeginContact，
+        此时快照中已经存在的接触不再计数，Step之后没有重新开始的接触视为已经结束(由end_resync移除)
+        """
+        self.resync = set()
+
+    def end_resync(self):
+        for ped in self.env.peds:
+            for contacts in (ped.collide_agents, ped.detected_agents, ped.collide_obstacles, ped.detected_obstacles):
+                for key in [key for key in contacts if (id(contacts), key) not in self.resync]:
+                    contacts.pop(key)
+        self.resync = None
+
+    def _add(self, contacts, key, model) -> bool:
+        """
+        :return: 是否是新出现的接触
+        """
+        if self.resync is not None:
+            self.resync.add((id(contacts), key))
+            if key in contacts:
+                return False
+        contacts[key] = model
+        return True
 
     def BeginContact(self, contact: b2Contact):
         infoA, infoB = contact.fixtureA.userData, contact.fixtureB.userData # 得到碰撞的双方的用户数据
@@ -23,28 +51,28 @@ class MyContactListener(b2ContactListener):
         elif infoA.type == ObjectType.Agent and infoB.type == ObjectType.Agent:
             if infoB.model in infoA.model.group:
                 return
-            self.env.collide_agents_count += 1
             # 互相添加彼此
-            infoA.model.collide_agents[infoB.id] = infoB.model
-            infoB.model.collide_agents[infoA.id] = infoA.model
+            if self._add(infoA.model.collide_agents, infoB.id, infoB.model):
+                self.env.collide_agents_count += 1
+            self._add(infoB.model.collide_agents, infoA.id, infoA.model)
 
         elif (infoA.type == ObjectType.Sensor and infoB.type == ObjectType.Agent) or (
                 infoA.type == ObjectType.Agent and infoB.type == ObjectType.Sensor):
-            infoA.model.detected_agents[infoB.id] = infoB.model
-            infoB.model.detected_agents[infoA.id] = infoA.model
+            self._add(infoA.model.detected_agents, infoB.id, infoB.model)
+            self._add(infoB.model.detected_agents, infoA.id, infoA.model)
 
         elif (infoA.type == ObjectType.Agent and infoB.type in (ObjectType.Wall, ObjectType.Obstacle)) \
                 or (infoA.type in (ObjectType.Wall, ObjectType.Obstacle) and infoB.type == ObjectType.Agent):
-            self.env.collide_wall_count += 1
             agent = infoA if infoA.type == ObjectType.Agent else infoB
             obs = infoA if infoA.type in (ObjectType.Wall, ObjectType.Obstacle) else infoB
-            agent.model.collide_obstacles[obs.id] = obs.model
+            if self._add(agent.model.collide_obstacles, obs.id, obs.model):
+                self.env.collide_wall_count += 1
 
         elif (infoA.type == ObjectType.Sensor and infoB.type in (ObjectType.Wall, ObjectType.Obstacle)) \
                 or (infoA.type in (ObjectType.Wall, ObjectType.Obstacle) and infoB.type == ObjectType.Sensor):
             agent = infoA if infoA.type == ObjectType.Agent else infoB
             obs = infoA if infoA.type in (ObjectType.Wall, ObjectType.Obstacle) else infoB
-            agent.model.detected_obstacles[obs.id] = obs.model
+            self._add(agent.model.detected_obstacles, obs.id, obs.model)
         else:
             pass
             # print("出现未知类型的碰撞!{}-{}".format(infoA.type, infoB.type))
@@ -77,3 +105,114 @@ class MyContactListener(b2ContactListener):
         else:
             pass
             # print("出现未知类型的碰撞!{}-{}".format(infoA.type, infoB.type))
+
+
+class ContactTracker:
+    """
+    不依赖contactListener回调的接触统计(contacts="array")：每个子步结束后用空间哈希(行人)与地图的障碍物距离场(墙)
+    一次性求出所有接触与探测关系，与上一子步的结果求差集后只对发生变化的行人对更新
+    collide_agents、detected_agents、collide_obstacles与detected_obstacles字典，字典的内容与MyContactListener相同，
+    环境的碰撞计数按新出现的接触数累加，每个行人当前的接触数写入PedsState.agent_contacts与wall_contacts
+    """
+    KEY = 1 << 32  # 将(行人编号, 行人或墙编号)编码为一个整数
+    POLYGON_RADIUS = 0.01  # 与Box2D的b2_polygonRadius一致
+
+    def __init__(self, env):
+        from ped_env.objects import Person
+        self.env = env
+        self.field = env.terrain.obstacle_field
+        self.statics = env.obstacles + env.walls
+        self.owner = env.static_owner  # 距离场中的墙块 -> statics中的编号
+        self.radius = Person.radius
+        self.sensor_radius = Person.radius + 1
+        # Box2D中传感器与墙的重叠判定包含多边形的外皮半径，KinematicWorld则不包含
+        self.detect_range = self.sensor_radius + (self.POLYGON_RADIUS if env.engine == "box2d" else 0.0)
+        self.models = {ped.id: ped for ped in env.peds}
+        self.pairs = {name: np.zeros([0], dtype=np.int64) for name in
+                      ("collide_agents", "detected_agents", "collide_obstacles", "detected_obstacles")}
+        self.set_peds(env.not_arrived_peds)
+
+    def set_peds(self, peds):
+        """
+        :param peds: 仍然拥有刚体的行人，被移除的行人的所有接触立即结束(与销毁刚体时的EndContact相同)
+        """
+        self.slots = np.array([ped.slot for ped in peds], dtype=np.int64)
+        self.ids = np.array([ped.id for ped in peds], dtype=np.int64)
+        self.groups = np.array([self.env.ped_to_group_dic[ped].id for ped in peds], dtype=np.int64)
+        state = self.env.state
+        ids = np.sort(self.ids)
+        for name, keys in self.pairs.items():
+            alive = self._contains(ids, keys // self.KEY)
+            if name.endswith("agents"):
+                alive &= self._contains(ids, keys % self.KEY)
+            self._end(name, keys[~alive])
+            self.pairs[name] = keys[alive]
+        removed = np.setdiff1d(np.array([ped.slot for ped in self.models.values()], dtype=np.int64), self.slots)
+        state.agent_contacts[removed] = 0
+        state.wall_contacts[removed] = 0
+
+    def update(self):
+        state = self.env.state
+        pos = state.pos[self.slots]
+        n = len(pos)
+        reach = self.sensor_radius + self.radius
+        a, b = SpatialHash(reach).build(pos).query_pairs(reach)
+        diff = pos[a] - pos[b]
+        dis = (diff[:, 0] ** 2 + diff[:, 1] ** 2) ** 0.5
+        ids_a, ids_b = self.ids[a], self.ids[b]
+        keys = np.minimum(ids_a, ids_b) * self.KEY + np.maximum(ids_a, ids_b)
+        # 同一团体内的碰撞不计入
+        touch = (dis < 2 * self.radius) & (self.groups[a] != self.groups[b])
+        self._update("collide_agents", keys[touch])
+        self._update("detected_agents", keys[dis < reach])
+        state.agent_contacts[self.slots] = np.bincount(np.concatenate([a[touch], b[touch]]), minlength=n)
+
+        cand, rect_dis = self.field.candidates(pos, self.detect_range)
+        rows, cols = np.nonzero(cand >= 0)
+        owner = self.owner[cand[rows, cols]]
+        wall_keys = self.ids[rows] * self.KEY + owner
+        touch = rect_dis[rows, cols] < self.radius + self.POLYGON_RADIUS
+        # 合并墙体时同一行人可能与同一个BoxWall中的多块墙接触，只算一次
+        self._update("collide_obstacles", np.unique(wall_keys[touch]))
+        self._update("detected_obstacles", np.unique(wall_keys))
+        touched = np.unique(rows[touch] * len(self.statics) + owner[touch]) // max(len(self.statics), 1)
+        state.wall_contacts[self.slots] = np.bincount(touched, minlength=n)
+
+    def _update(self, name, keys):
+        keys = np.sort(keys)  # 调用方保证同一对只出现一次
+        old = self.pairs[name]
+        if not np.array_equal(keys, old):
+            self._end(name, old[~self._contains(keys, old)])
+            self._begin(name, keys[~self._contains(old, keys)])
+        self.pairs[name] = keys
+
+    @staticmethod
+    def _contains(sorted_keys, values):
+        if len(sorted_keys) == 0:
+            return np.zeros(len(values), dtype=bool)
+        index = np.minimum(np.searchsorted(sorted_keys, values), len(sorted_keys) - 1)
+        return sorted_keys[index] == values
+
+    def _begin(self, name, keys):
+        if name == "collide_agents":
+            self.env.collide_agents_count += len(keys)
+        elif name == "collide_obstacles":
+            self.env.collide_wall_count += len(keys)
+        for first, second in zip((keys // self.KEY).tolist(), (keys % self.KEY).tolist()):
+            ped = self.models[first]
+            if name.endswith("agents"):
+                other = self.models[second]
+                getattr(ped, name)[second] = other
+                getattr(other, name)[first] = ped
+            else:
+                wall = self.statics[second]
+                getattr(ped, name)[wall.id] = wall
+
+    def _end(self, name, keys):
+        for first, second in zip((keys // self.KEY).tolist(), (keys % self.KEY).tolist()):
+            ped = self.models[first]
+            if name.endswith("agents"):
+                getattr(ped, name).pop(second, None)
+                getattr(self.models[second], name).pop(first, None)
+            else:
+                getattr(ped, name).pop(self.statics[second].id, None)
@@ -12,13 +12,48 @@ from gym.spaces import Box, Discrete
 from ped_env.functions import parse_discrete_action_one_hot, calculate_nij, angle_of_vector, \
     calculate_groups_person_num, parse_discrete_action, normalize_vector
 from ped_env.objects import Person, PersonState, Group
-from ped_env.pathfinder import AStar
-from ped_env.settings import ACTION_DIM
+from ped_env.pathfinder import AStar, PathCache
+from ped_env.settings import ACTION_DIM, ACTIONS_ARRAY
+from ped_env.utils.colors import ColorWall
+from ped_env.utils.misc import AgentArrayDict
+from ped_env.utils.raster import rgb_to_gray, rasterize_boxes
+
+# angle_of_vector中使用了pi=3.1415，这里取其对应的余弦值作为大于90度的判定阈值
+_COS_90 = np.cos(3.1415 / 2)
+
+
+class ActionPlan:
+    """
+    一个step内不变的动作相关数据：行人列表、动作以及由动作得到的方向等，
+    由PersonHandler.plan_actions_batch在每个step开始时计算一次，之后每个子步只需重新计算与位置和速度有关的部分
+    """
+
+    def __init__(self, leaders: List[Person], leader_actions: List, followers: List[Person], follower_actions: List,
+                 groups: List[Group], exit_poses: List):
+        self.leaders = leaders
+        self.leader_actions = leader_actions
+        self.followers = followers
+        self.follower_actions = follower_actions
+        self.groups = groups
+        self.exit_poses = exit_poses
+
+    @property
+    def peds(self) -> List[Person]:
+        return self.leaders + self.followers
 
 
 class PedsHandlerInterface(abc.ABC):
-    def __init__(self, env):
-        pass
+    PATH_CACHE_SIZE = 1024
+    # set_action中是否调用Person.fij_force与Person.fiw_force施加排斥力，
+    # 为True时numpy引擎(KinematicWorld)不再在物理步中重复施加
+    PEDS_APPLY_SOCIAL_FORCE = False
+
+    def __init__(self, env, with_force: bool = False):
+        """
+        :param with_force: 动作是否以施加力的方式控制行人，环境总是传入，只有PedsRLHandlerWithForce及其子类使用
+        """
+        self.path_cache = PathCache(env.path_finder, PedsHandlerInterface.PATH_CACHE_SIZE)
+        self.with_force = with_force
 
     def step(self, peds: List[Person], group_dic: Dict[Person, Group], agent_id_dict: Dict[Person, str], time):
         obs = {}
@@ -34,6 +69,27 @@ class PedsHandlerInterface(abc.ABC):
             rewards[key] += global_reward
         return obs, rewards
 
+    def step_into(self, peds: List[Person], group_dic: Dict[Person, Group], agent_id_dict: Dict[Person, str], time,
+                  obs: AgentArrayDict, rewards: AgentArrayDict):
+        """
+        step的数组版本，将观察与奖励直接写入预先分配的数组obs.array与rewards.array中
+        """
+        global_reward = 0.0
+        for idx, ped in enumerate(peds):
+            if ped.is_leader:
+                row = obs.row(agent_id_dict[ped])
+                self.get_observation_into(ped, group_dic[ped], time, obs.array[row])
+                gr, lr = self.get_reward(ped, idx, time)
+                global_reward += gr
+                rewards.array[row] = lr
+        rewards.array += global_reward
+
+    def get_observation_into(self, ped: Person, group: Group, time, out: np.ndarray):
+        """
+        将观察写入out中，默认复制get_observation的结果
+        """
+        out[...] = self.get_observation(ped, group, time)
+
     def init_exit_kd_trees(self):
         if not hasattr(self, "planner"):
             self.planner = AStar(self.env.terrain)
@@ -63,13 +119,64 @@ class PedsHandlerInterface(abc.ABC):
     def set_follower_action(self, ped: Person, action, group: Group, exit_pos):
         pass
 
+    def set_actions_batch(self, leaders: List[Person], actions: List):
+        """
+        批量为leader设置动作，供环境的数组化子步调用，默认逐个调用set_action
+        """
+        for ped, action in zip(leaders, actions):
+            self.set_action(ped, action)
+
+    def set_follower_actions_batch(self, followers: List[Person], actions: List, groups: List[Group], exit_poses: List):
+        """
+        批量为follower设置动作，默认逐个调用set_follower_action
+        """
+        for ped, action, group, exit_pos in zip(followers, actions, groups, exit_poses):
+            self.set_follower_action(ped, action, group, exit_pos)
+
+    def plan_actions_batch(self, leaders: List[Person], leader_actions: List, followers: List[Person],
+                           follower_actions: List, groups: List[Group], exit_poses: List) -> ActionPlan:
+        """
+        每个step开始时调用一次，预先计算一个step内不变的部分，默认只保存参数
+        """
+        return ActionPlan(leaders, leader_actions, followers, follower_actions, groups, exit_poses)
+
+    def apply_action_plan(self, plan: ActionPlan):
+        """
+        每个子步调用一次，根据plan与当前的位置和速度施加自驱动力，默认调用set_actions_batch与set_follower_actions_batch
+        """
+        self.set_actions_batch(plan.leaders, plan.leader_actions)
+        if len(plan.followers) > 0:
+            self.set_follower_actions_batch(plan.followers, plan.follower_actions, plan.groups, plan.exit_poses)
+
     @abc.abstractmethod
     def get_reward(self, ped: Person, ped_index: int, time):
         pass
 
+    def get_follower_flow_field_dir(self, ped: Person, exit_pos):
+        """
+        leader到达出口后，follower直接读取出口方向场中所在格子的方向，而不是调用A*寻路
+        """
+        field = self.env.path_finder.get_flow_field(exit_pos)
+        return normalize_vector(field.next_dir(int(ped.getX), int(ped.getY)))
+
     def update_image_data(self):
         pass
 
+    def get_state(self) -> Dict[str, np.ndarray]:
+        """
+        回合中会变化的状态(各leader最后一次的观察)，供PedsMoveEnv.get_state调用，
+        路径缓存与按frame_count缓存的画面只影响速度，不在其中
+        """
+        ids = list(self.last_observation.keys())
+        observations = [self.last_observation[i] for i in ids]
+        return {"obs_ids": np.array(ids, dtype=np.int64),
+                "obs": np.array(observations) if len(ids) > 0 else np.zeros([0]),
+                "obs_is_list": np.array([isinstance(obs, list) for obs in observations], dtype=bool)}
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        self.last_observation = {i: obs.tolist() if is_list else obs.copy() for i, obs, is_list in
+                                 zip(state["obs_ids"].tolist(), state["obs"], state["obs_is_list"])}
+
 
 class PedsRLHandlerWithForce(PedsHandlerInterface):
     """
@@ -82,7 +189,7 @@ class PedsRLHandlerWithForce(PedsHandlerInterface):
 
     def __init__(self, env, r_move=-0.1, r_wait=-0.5, r_collision_person=-0.1, r_collision_wall=-2.0, r_reach=100,
                  use_planner=False, with_force=True):
-        super().__init__(env)
+        super().__init__(env, with_force)
         self.last_observation = {}
         self.env = env
 
@@ -112,48 +219,55 @@ class PedsRLHandlerWithForce(PedsHandlerInterface):
         self.r_reach = r_reach
 
         self.use_planner = use_planner
-        self.with_force = with_force
 
-    def get_observation(self, ped: Person, group: Group, time):
+    def get_observation(self, ped: Person, group: Group, time, out: np.ndarray = None):
+        """
+        :param out: 给定时将观察写入该数组(例如预先分配的观察数组的一行)，否则返回一个列表
+        """
         from ped_env.utils.misc import ObjectType
-        observation = []
 
         if ped.is_done:
             # 根据 The Surprising Effectiveness of PPO in Cooperative Multi-Agent Games结果，这里给予零奖励
-            return np.zeros(self._obs_shape)
+            if out is None:
+                return np.zeros(self._obs_shape)
+            out[:] = 0.0
+            return out
+        observation = [0.0] * self._obs_shape[0] if out is None else out
         # 给予智能体当前速度大小，速度相对于参考向量的夹角
-        observation.append(ped.vec_norm)
-        observation.append(ped.vec_angle)
+        observation[0] = ped.vec_norm
+        observation[1] = ped.vec_angle
         # 给予智能体相对目标的距离和夹角
         dis, angle = self.env.terrain.get_ped_to_exit_dis_and_dir(ped)
-        observation.append(dis)
-        observation.append(angle)
+        observation[2] = dis
+        observation[3] = angle
         # 给予附近3m内的所有智能体位置信息
         persons = self.env.get_ped_nearest_elements(ped, PedsRLHandlerWithForce.DETECT_PED_COUNT,
                                                     detect_type=ObjectType.Agent)
+        k = 4
         for pe in persons:
-            observation.append(ped.relative_distence(pe.pos))
-            observation.append(ped.relative_angle(pe.pos))
-        left = PedsRLHandlerWithForce.DETECT_PED_COUNT - len(persons)
-        if left > 0:  # 以0值作为填充
-            for i in range(left):
-                observation.append(0.0)
-                observation.append(0.0)
+            observation[k] = ped.relative_distence(pe.pos)
+            observation[k + 1] = ped.relative_angle(pe.pos)
+            k += 2
+        end = 4 + PedsRLHandlerWithForce.DETECT_PED_COUNT * 2
+        observation[k:end] = [0.0] * (end - k)  # 以0值作为填充
 
         obstacles = self.env.get_ped_nearest_elements(ped, PedsRLHandlerWithForce.DETECT_OBSTACLE_COUNT,
                                                       detect_type=ObjectType.Obstacle)
+        k = end
         for ob in obstacles:
-            observation.append(ped.relative_distence(ob.pos))
-            observation.append(ped.relative_angle(ob.pos))
-        left = PedsRLHandlerWithForce.DETECT_OBSTACLE_COUNT - len(obstacles)
-        if left > 0:
-            for i in range(left):
-                observation.append(0.0)
-                observation.append(0.0)
-
-        self.last_observation[ped.id] = observation
+            observation[k] = ped.relative_distence(ob.pos)
+            observation[k + 1] = ped.relative_angle(ob.pos)
+            k += 2
+        end += PedsRLHandlerWithForce.DETECT_OBSTACLE_COUNT * 2
+        observation[k:end] = [0.0] * (end - k)
+
+        if out is None:
+            self.last_observation[ped.id] = observation
         return observation
 
+    def get_observation_into(self, ped: Person, group: Group, time, out: np.ndarray):
+        self.get_observation(ped, group, time, out)
+
     def set_action(self, ped: Person, action):
         if self.with_force:
             ped.self_driven_force(parse_discrete_action(action) if self.env.discrete else action)
@@ -164,6 +278,13 @@ class PedsRLHandlerWithForce(PedsHandlerInterface):
         else:
             ped.set_velocity(action)
 
+    def set_actions_batch(self, leaders: List[Person], actions: List):
+        if not self.with_force or len(leaders) == 0:
+            return super().set_actions_batch(leaders, actions)
+        slots = np.array([ped.slot for ped in leaders])
+        directions = ACTIONS_ARRAY[np.asarray(actions)] if self.env.discrete else np.asarray(actions, dtype=np.float64)
+        Person.batch_self_driven_force(self.env.state, slots, directions)
+
     def set_follower_action(self, ped: Person, action, group: Group, exit_pos):
         diff = group.get_distance_to_leader(ped)
         if not group.leader.is_done:
@@ -184,12 +305,82 @@ class PedsRLHandlerWithForce(PedsHandlerInterface):
             # 当leader到达出口后
             force = (ped.person_state != PersonState.route_to_exit)
             ped.person_state = PersonState.route_to_exit  # 更新当前状态
-            int_pos_j = self.get_follower_a_star_path(ped, exit_pos, ped.pos, force)
-            mix_dir = normalize_vector(ped.a_star_path.vec_dir[int_pos_j]) if ped.a_star_path is not None else (1, 0)  # 保护语句
+            if self.env.follower_flow_field:
+                mix_dir = self.get_follower_flow_field_dir(ped, exit_pos)
+            else:
+                int_pos_j = self.get_follower_a_star_path(ped, exit_pos, ped.pos, force)
+                mix_dir = normalize_vector(ped.a_star_path.vec_dir[int_pos_j]) if ped.a_star_path is not None else (1, 0)  # 保护语句
         ped.self_driven_force(mix_dir)  # 跟随者的方向为alpha*control_dir + (1-alpha)*leader_dir
         # logging.error("该奖励模型中不应该出现follower!")
         # ped.ij_group_force(group)
 
+    def set_follower_actions_batch(self, followers: List[Person], actions: List, groups: List[Group], exit_poses: List):
+        """
+        处于跟随状态(leader未到达出口且间距小于2米)的follower按数组批量计算混合方向，
+        需要A*寻路的follower依然逐个调用set_follower_action
+        """
+        slots = np.array([ped.slot for ped in followers])
+        leader_slots = np.array([group.leader.slot for group in groups])
+        self._set_follower_forces(followers, actions, groups, exit_poses, slots, leader_slots,
+                                  lambda idx: self._parse_control_dirs([actions[i] for i in idx]))
+
+    def _parse_control_dirs(self, actions) -> np.ndarray:
+        parse = parse_discrete_action_one_hot if self.env.discrete else np.asarray
+        return np.array([parse(action) for action in actions], dtype=np.float64).reshape(-1, 2)
+
+    def _set_follower_forces(self, followers, actions, groups, exit_poses, slots, leader_slots, control_dirs):
+        """
+        :param control_dirs: 给定跟随状态的follower编号，返回它们的控制方向
+        """
+        state = self.env.state
+        leader_done = state.is_done[leader_slots]
+        rel = state.pos[leader_slots] - state.pos[slots]
+        diff = (rel[:, 0] ** 2 + rel[:, 1] ** 2) ** 0.5
+        follow = ~leader_done & (diff < 2)
+        for i in np.flatnonzero(~follow):
+            self.set_follower_action(followers[i], actions[i], groups[i], exit_poses[i])
+        idx = np.flatnonzero(follow)
+        if len(idx) == 0:
+            return
+        for i in idx:
+            followers[i].person_state = PersonState.follow_leader
+        control_dir = control_dirs(idx)
+        leader_dir = rel[idx]
+        norm = np.linalg.norm(leader_dir, axis=1, keepdims=True)
+        leader_dir = np.divide(leader_dir, norm, out=leader_dir, where=norm != 0)
+        # 与angle_of_vector(control_dir, leader_dir) > 90等价
+        length_prod = np.linalg.norm(control_dir, axis=1) * np.linalg.norm(leader_dir, axis=1)
+        cos = (control_dir * leader_dir).sum(axis=1) / (length_prod + 1e-6)
+        backward = (cos < _COS_90)[:, None]
+        mix_dir = np.where(backward, -leader_dir * 0.2,
+                           Person.alpha * control_dir + (1 - Person.alpha) * leader_dir)
+        Person.batch_self_driven_force(state, slots[idx], mix_dir)
+
+    def plan_actions_batch(self, leaders: List[Person], leader_actions: List, followers: List[Person],
+                           follower_actions: List, groups: List[Group], exit_poses: List) -> ActionPlan:
+        """
+        leader的方向、follower的控制方向以及各自的槽位在一个step内不变，只在step开始时计算一次
+        """
+        plan = super().plan_actions_batch(leaders, leader_actions, followers, follower_actions, groups, exit_poses)
+        if not self.with_force:
+            return plan
+        plan.leader_slots = np.array([ped.slot for ped in leaders], dtype=np.int64)
+        plan.leader_directions = (ACTIONS_ARRAY[np.asarray(leader_actions, dtype=np.int64)] if self.env.discrete
+                                  else np.asarray(leader_actions, dtype=np.float64)).reshape(-1, 2)
+        plan.follower_slots = np.array([ped.slot for ped in followers], dtype=np.int64)
+        plan.follower_leader_slots = np.array([group.leader.slot for group in groups], dtype=np.int64)
+        plan.control_dirs = self._parse_control_dirs(follower_actions)
+        return plan
+
+    def apply_action_plan(self, plan: ActionPlan):
+        if not self.with_force:
+            return super().apply_action_plan(plan)
+        if len(plan.leaders) > 0:
+            Person.batch_self_driven_force(self.env.state, plan.leader_slots, plan.leader_directions)
+        if len(plan.followers) > 0:
+            self._set_follower_forces(plan.followers, plan.follower_actions, plan.groups, plan.exit_poses,
+                                      plan.follower_slots, plan.follower_leader_slots, lambda idx: plan.control_dirs[idx])
+
     def get_follower_a_star_path(self, ped, pos_i, pos_j, force=False):
         """
         :param ped: 控制的行人
@@ -201,10 +392,8 @@ class PedsRLHandlerWithForce(PedsHandlerInterface):
         int_pos_i = (int(pos_i[0]), int(pos_i[1]))
         int_pos_j = (int(pos_j[0]), int(pos_j[1]))
         if ped.a_star_path is None or force or (ped.a_star_path.vec_dir.get(int_pos_j) is None):  # 使用A*计算得到一条去出口的路
-            re, path = self.env.path_finder.next_loc(int_pos_j[0], int_pos_j[1],
-                                                     int_pos_i[0], int_pos_i[1])
+            path = self.path_cache.get(int_pos_j, int_pos_i)
             if path is not None:
-                path.calculate_vec_dir_in_path()
                 ped.a_star_path = path
         return int_pos_j
 
@@ -241,7 +430,11 @@ class PedsVisionRLHandler(PedsRLHandlerWithForce):
     """
 
     def __init__(self, env, r_move=0, r_wait=0, r_collision_person=0, r_collision_wall=0, r_reach=100,
-                 use_planner=False, render_ratio=0.25, test_mode=False):
+                 use_planner=False, render_ratio=0.25, test_mode=False, crop_size=None, with_force=True):
+        """
+        :param crop_size: 不为None时，每个leader的观察为从整帧图像中裁剪出的以其为中心、边长为crop_size像素的局部图像，
+                          地图外的部分以墙的颜色填充
+        """
         import ped_env.settings as set
         set.RENDER_RATIO = render_ratio
         set.init_settings(env.terrain.width, env.terrain.height)
@@ -251,31 +444,172 @@ class PedsVisionRLHandler(PedsRLHandlerWithForce):
             r_collision_person = -0.1
             r_collision_wall = -2.0
             r_reach = 100
-        super().__init__(env, r_move, r_wait, r_collision_person, r_collision_wall, r_reach, use_planner)
+        super().__init__(env, r_move, r_wait, r_collision_person, r_collision_wall, r_reach, use_planner, with_force)
         self.env.render_mode = "gray_array"  # 设置渲染模式为灰度图
-        self.observation_space = [Box(-1, 1, (set.VIEWPORT_H, set.VIEWPORT_H))]  # 定义新的观察空间为地图的俯视图(RGB经过加权平均后的灰度模式)
+        # 观察空间为地图的俯视图(RGB经过加权平均后的灰度模式)，与env.render得到的图像形状和类型相同
+        frame_shape = (env.terrain.width * env.RENDER_CELL_PIXELS, env.terrain.height * env.RENDER_CELL_PIXELS)
+        self.observation_space = [Box(0, 255, frame_shape, dtype=np.uint8)]
+        self.crop_size = crop_size
+        if crop_size is not None:
+            self.observation_space = [Box(0, 255, (crop_size, crop_size), dtype=np.uint8)]
+        self._frame = None
+        self._frame_key = None
+
+    def _get_frame(self):
+        """
+        同一帧内(以env.frame_count为键)只渲染一次，所有leader共享渲染结果，裁剪模式下返回四周填充过的图像
+        """
+        if self._frame_key != self.env.frame_count:
+            self.env.render(self.env.render_mode)
+            frame = self.env.render_data
+            if self.crop_size is not None:
+                c = self.crop_size
+                padded = np.empty((frame.shape[0] + 2 * c, frame.shape[1] + 2 * c) + frame.shape[2:], dtype=frame.dtype)
+                padded[...] = rgb_to_gray(ColorWall) if frame.ndim == 2 else ColorWall
+                padded[c:-c, c:-c] = frame
+                frame = padded
+            self._frame = frame
+            self._frame_key = self.env.frame_count
+        return self._frame
 
     def get_observation(self, ped: Person, group: Group, time):
         assert self.env.render_mode in ["rgb_array", "gray_array"]
         if ped.is_done:
             return self.last_observation[ped.id]
-        self.env.render(self.env.render_mode)
-        # 给予智能体当前渲染出的观察图像
-        obs = self.env.render_data
+        # 给予智能体当前渲染出的观察图像，同一帧内的leader共享同一个数组
+        obs = self._get_frame()
+        if self.crop_size is not None:
+            size = self.crop_size
+            x = int(ped.getX * self.env.render_scale) + size - size // 2
+            y = int(ped.getY * self.env.render_scale) + size - size // 2
+            x = min(max(x, 0), obs.shape[0] - size)
+            y = min(max(y, 0), obs.shape[1] - size)
+            obs = obs[x:x + size, y:y + size]
         self.last_observation[ped.id] = obs
         return obs
 
+    def get_observation_into(self, ped: Person, group: Group, time, out: np.ndarray):
+        out[...] = self.get_observation(ped, group, time)
+
     def set_action(self, ped: Person, action):
         ped.self_driven_force(parse_discrete_action(action) if self.env.discrete else action)
 
 
+class PedsGridRLHandler(PedsRLHandlerWithForce):
+    """
+    以leader为中心的局部占据栅格观察，形状为(CHANNELS, grid_size, grid_size)，通道依次为:
+    墙与障碍物、其他行人的数量、自己的出口、其他行人的平均速度x分量、平均速度y分量。
+    静态通道只在第一次使用时光栅化一次，行人通道每帧用bincount散射一次，所有leader的观察一起从中切片得到，
+    奖励与动作和PedsRLHandlerWithForce相同
+    """
+    CHANNELS = 5
+
+    def __init__(self, env, r_move=-0.1, r_wait=-0.5, r_collision_person=-0.1, r_collision_wall=-2.0, r_reach=100,
+                 use_planner=False, with_force=True, grid_size=21, cell_size=0.25):
+        """
+        :param grid_size: 栅格的边长(格子数)，取奇数时leader位于正中间的格子
+        :param cell_size: 每个格子的边长(米)
+        """
+        super().__init__(env, r_move, r_wait, r_collision_person, r_collision_wall, r_reach, use_planner, with_force)
+        self.grid_size = grid_size
+        self.cell_size = cell_size
+        self._obs_shape = (self.CHANNELS, grid_size, grid_size)
+        self.observation_space = [Box(-inf, inf, self._obs_shape) for _ in range(self.agent_count)]
+        self._static = None
+        self._grids = {}
+        self._grid_key = None
+
+    def _build_static(self):
+        """
+        将墙、障碍物与各个出口光栅化，四周填充grid_size个墙格子，使得切片永远不会越界
+        """
+        cs, pad = self.cell_size, self.grid_size
+        shape = (int(np.ceil(self.env.terrain.width / cs)), int(np.ceil(self.env.terrain.height / cs)))
+
+        def boxes(elements):
+            centers = np.array([(ele.getX, ele.getY) for ele in elements]).reshape(-1, 2)
+            halves = np.array([(ele.width / 2, ele.height / 2) for ele in elements]).reshape(-1, 2)
+            return centers, halves
+
+        walls = np.pad(rasterize_boxes(*boxes(self.env.obstacles + self.env.walls), shape, cs), pad,
+                       mode="constant", constant_values=1.0)
+        exit_types = sorted(set(ex.exit_type for ex in self.env.exits))
+        exits = np.zeros((max(exit_types, default=0) + 1,) + walls.shape)
+        for exit_type in exit_types:
+            elements = [ex for ex in self.env.exits if ex.exit_type == exit_type]
+            exits[exit_type] = np.pad(rasterize_boxes(*boxes(elements), shape, cs), pad)
+        self._static = walls, exits
+
+    def _build_grids(self):
+        """
+        同一帧内(以env.frame_count为键)只计算一次，批量得到所有未到达出口的leader的观察
+        """
+        if self._static is None:
+            self._build_static()
+        walls, exits = self._static
+        g, cs = self.grid_size, self.cell_size
+        leaders = [ped for ped in self.env.leaders if not ped.is_done]
+        self._grids = {}
+        self._grid_key = self.env.frame_count
+        if len(leaders) == 0:
+            return
+        state = self.env.state
+        # 行人所在的格子(加上填充的偏移)，地图外的行人不计入
+        slots = np.array([ped.slot for ped in self.env.not_arrived_peds], dtype=np.int64)
+        cells = np.floor(state.pos[slots] / cs).astype(np.int64) + g
+        inside = np.all((cells >= 0) & (cells < walls.shape), axis=1)
+        flat = np.ravel_multi_index(cells[inside].T, walls.shape)
+        size = walls.size
+        count = np.bincount(flat, minlength=size).reshape(walls.shape).astype(np.float64)
+        vx = np.bincount(flat, weights=state.vec[slots][inside, 0], minlength=size).reshape(walls.shape)
+        vy = np.bincount(flat, weights=state.vec[slots][inside, 1], minlength=size).reshape(walls.shape)
+
+        leader_slots = np.array([ped.slot for ped in leaders], dtype=np.int64)
+        centers = np.clip(np.floor(state.pos[leader_slots] / cs).astype(np.int64) + g, g // 2,
+                          np.array(walls.shape) - g + g // 2)
+        ix = (centers[:, 0:1] - g // 2 + np.arange(g))[:, :, None]
+        iy = (centers[:, 1:2] - g // 2 + np.arange(g))[:, None, :]
+        grids = np.empty((len(leaders),) + self._obs_shape, dtype=np.float32)
+        grids[:, 0] = walls[ix, iy]
+        grids[:, 1] = count[ix, iy]
+        grids[:, 2] = exits[np.array([ped.exit_type for ped in leaders])[:, None, None], ix, iy]
+        grids[:, 3] = vx[ix, iy]
+        grids[:, 4] = vy[ix, iy]
+        # 去掉leader自己的贡献，然后将速度之和转换为平均速度
+        own = np.floor(state.pos[leader_slots] / cs).astype(np.int64) + g - (centers - g // 2)
+        mine = np.all((own >= 0) & (own < g), axis=1)
+        rows = np.flatnonzero(mine)
+        grids[rows, 1, own[rows, 0], own[rows, 1]] -= 1
+        grids[rows, 3, own[rows, 0], own[rows, 1]] -= state.vec[leader_slots[rows], 0]
+        grids[rows, 4, own[rows, 0], own[rows, 1]] -= state.vec[leader_slots[rows], 1]
+        grids[:, 3:] /= np.maximum(grids[:, 1:2], 1.0)
+        self._grids = dict(zip(leaders, grids))
+
+    def get_observation(self, ped: Person, group: Group, time, out: np.ndarray = None):
+        if ped.is_done:
+            if out is None:
+                return np.zeros(self._obs_shape, dtype=np.float32)
+            out[...] = 0.0
+            return out
+        if self._grid_key != self.env.frame_count or ped not in self._grids:
+            self._build_grids()
+        observation = self._grids[ped]
+        if out is None:
+            self.last_observation[ped.id] = observation
+            return observation
+        out[...] = observation
+        return out
+
+
 class PedsRLHandler(PedsHandlerInterface):
     """
     合作的奖励机制
     """
+    PEDS_APPLY_SOCIAL_FORCE = True
 
-    def __init__(self, env, r_arrival=10, r_move=-0.1, r_wait=-0.5, r_collision=-1, use_planner=False):
-        super().__init__(env)
+    def __init__(self, env, r_arrival=10, r_move=-0.1, r_wait=-0.5, r_collision=-1, use_planner=False,
+                 with_force=False):
+        super().__init__(env, with_force)
         self.env = env
 
         person_num = calculate_groups_person_num(env, env.person_num)
@@ -346,7 +680,7 @@ class PedsRLHandler(PedsHandlerInterface):
     def set_action(self, ped: Person, action):
         ped.self_driven_force(parse_discrete_action_one_hot(action) if self.env.discrete else action)
         ped.fij_force(self.env.not_arrived_peds, self.env.ped_to_group_dic[ped])
-        ped.fiw_force(self.env.walls + self.env.obstacles)   # 出口不再作为障碍物
+        ped.fiw_force(self.env.walls + self.env.obstacles, self.env.obstacle_field)   # 出口不再作为障碍物
 
     def set_follower_action(self, ped: Person, action, group: Group, exit_pos):
         diff = group.get_distance_to_leader(ped)
@@ -368,11 +702,14 @@ class PedsRLHandler(PedsHandlerInterface):
             # 当leader到达出口后
             force = (ped.person_state != PersonState.route_to_exit)
             ped.person_state = PersonState.route_to_exit  # 更新当前状态
-            int_pos_j = self.get_follower_a_star_path(ped, exit_pos, ped.pos, force)
-            mix_dir = normalize_vector(ped.a_star_path.vec_dir[int_pos_j])
+            if self.env.follower_flow_field:
+                mix_dir = self.get_follower_flow_field_dir(ped, exit_pos)
+            else:
+                int_pos_j = self.get_follower_a_star_path(ped, exit_pos, ped.pos, force)
+                mix_dir = normalize_vector(ped.a_star_path.vec_dir[int_pos_j])
         ped.self_driven_force(mix_dir)  # 跟随者的方向为alpha*control_dir + (1-alpha)*leader_dir
         ped.fij_force(self.env.not_arrived_peds, self.env.ped_to_group_dic[ped])
-        ped.fiw_force(self.env.walls + self.env.obstacles)
+        ped.fiw_force(self.env.walls + self.env.obstacles, self.env.obstacle_field)
         # ped.ij_group_force(group)
 
     def get_follower_a_star_path(self, ped, pos_i, pos_j, force=False):
@@ -386,10 +723,7 @@ class PedsRLHandler(PedsHandlerInterface):
         int_pos_i = (int(pos_i[0]), int(pos_i[1]))
         int_pos_j = (int(pos_j[0]), int(pos_j[1]))
         if ped.a_star_path is None or force or (ped.a_star_path.vec_dir.get(int_pos_j) is None):  # 使用A*计算得到一条去出口的路
-            re, path = self.env.path_finder.next_loc(int_pos_j[0], int_pos_j[1],
-                                                     int_pos_i[0], int_pos_i[1])
-            path.calculate_vec_dir_in_path()
-            ped.a_star_path = path
+            ped.a_star_path = self.path_cache.get(int_pos_j, int_pos_i)
         return int_pos_j
 
     def get_reward(self, ped: Person, ped_index: int, time):
@@ -418,7 +752,7 @@ class PedsRLHandler(PedsHandlerInterface):
 
 class PedsRLHandlerWithPlanner(PedsRLHandler):
     def __init__(self, env, r_arrival=0, r_move=-0.1, r_wait=-1, r_collision=-1, r_planner=-0.01, use_planner=False,
-                 ratio=10):
+                 ratio=10, with_force=False):
         if ratio != 1:
             r_arrival *= ratio
             r_move *= ratio
@@ -426,7 +760,8 @@ class PedsRLHandlerWithPlanner(PedsRLHandler):
             r_collision *= ratio
             r_planner *= ratio
         super(PedsRLHandlerWithPlanner, self).__init__(env=env, r_arrival=r_arrival, r_move=r_move,
-                                                       r_wait=r_wait, r_collision=r_collision, use_planner=use_planner)
+                                                       r_wait=r_wait, r_collision=r_collision, use_planner=use_planner,
+                                                       with_force=with_force)
         self.r_planner = r_planner
         self.use_planner = use_planner
         if use_planner:
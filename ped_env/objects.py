@@ -2,7 +2,6 @@ import copy
 import random
 import enum
 import typing
-from collections import defaultdict
 from typing import List
 
 import pyglet
@@ -16,8 +15,9 @@ from numpy import ndarray
 
 from ped_env.settings import DIRECTIONS, identity
 from ped_env.utils.colors import ColorRed, exit_type_to_color, ColorYellow
-from ped_env.functions import transfer_to_render, ij_power, normalize_vector, angle_between
+from ped_env.functions import transfer_to_render, ij_power, angle_between
 from ped_env.utils.misc import FixtureInfo, ObjectType
+from ped_env.state import PedsState
 
 
 class Agent:
@@ -69,7 +69,9 @@ class Person(Agent):
                  display_level,
                  debug_level,
                  desired_velocity=2.4,
-                 view_length=5.0):
+                 view_length=5.0,
+                 state: PedsState = None,
+                 with_sensor: bool = True):
         """
 
         暂定观察空间为8个方向的射线传感器（只探测墙壁）与8个方向的射线传感器（只探测其他行人）与导航力的方向以及与终点的距离，类型为Box(-inf,inf,(18,))，
@@ -86,38 +88,63 @@ class Person(Agent):
         :param max_velocity:
         :param view_length: 智能体最远能观察到的距离
         :param tau: 社会力模型中关于地面摩擦和自驱动力的参数
+        :param state: 行人状态数组，为None时该行人单独持有一份状态
+        :param with_sensor: 是否创建探测范围为1m的传感器夹具，接触由ContactTracker统计时不需要
         """
         super(Person, self).__init__()
+        # 位置、速度、合力等状态都存放在PedsState的数组中，Person只保存自己的槽位
+        self._state = state if state is not None else PedsState(1)
+        self.slot = self._state.allocate()
+        self.id = Person.counter
+        Person.counter += 1
+        self.create_body(env, new_x, new_y, with_sensor)
+        self.exit_type = exit_type
+        self.type = ObjectType.Agent
+        self.view_length = view_length
+
+        self.display_level = display_level
+        self.debug_level = debug_level
+
+        self.aabb_callback = AABBCallBack(self)
+        self.raycast_callback = RaycastCallBack(self)
+
+        self.directions = DIRECTIONS
+
+        self._reset_episode_state(desired_velocity)
+
+    def create_body(self, env: b2World, new_x, new_y, with_sensor: bool = True):
+        """
+        创建行人的刚体与夹具，恢复快照(PedsMoveEnv.set_state)时也用它重建刚体
+        """
         self.body = env.CreateDynamicBody(position=(new_x, new_y))
         self.body = typing.cast(b2BodyDef, self.body)
         self.body.allowSleep = True
-        self.exit_type = exit_type
-        self.reward_in_episode = 0.0
-        self.is_done = False
-        self.has_removed = False
 
         # Add a fixture to it
-        self.color = exit_type_to_color(self.exit_type)
         fixtureDef = b2FixtureDef()
         fixtureDef.shape = b2CircleShape(radius=self.radius)
         fixtureDef.density = self.mass / (math.pi * self.radius ** 2)
         fixtureDef.friction = 0.1  # 指的是行人与墙以及其他行人间的摩擦
-        fixtureDef.userData = FixtureInfo(Person.counter, self, ObjectType.Agent)
-        self.id = Person.counter
-        Person.counter += 1
+        fixtureDef.userData = FixtureInfo(self.id, self, ObjectType.Agent)
         self.box = self.body.CreateFixture(fixtureDef)
         # 添加传感器用于社会力控制
-        sensorDef = b2FixtureDef()
-        sensorDef.shape = b2CircleShape(radius=self.radius + 1)  # 探测范围为1m
-        sensorDef.isSensor = True
-        sensorDef.userData = FixtureInfo(self.id, self, ObjectType.Sensor)
-        self.sensor = self.body.CreateFixture(sensorDef)
-        self.type = ObjectType.Agent
-        self.view_length = view_length
-        self.desired_velocity = desired_velocity
-
-        self.display_level = display_level
-        self.debug_level = debug_level
+        self.sensor = None
+        if with_sensor:
+            sensorDef = b2FixtureDef()
+            sensorDef.shape = b2CircleShape(radius=self.radius + 1)  # 探测范围为1m
+            sensorDef.isSensor = True
+            sensorDef.userData = FixtureInfo(self.id, self, ObjectType.Sensor)
+            self.sensor = self.body.CreateFixture(sensorDef)
+
+    def _reset_episode_state(self, desired_velocity):
+        """
+        重置与回合有关的状态，行人被对象池复用时同样调用
+        """
+        self.reward_in_episode = 0.0
+        self.is_done = False
+        self.has_removed = False
+        self.color = exit_type_to_color(self.exit_type)
+        self._state.desired_velocity[self.slot] = desired_velocity
 
         self.collide_obstacles = {}
         self.collide_agents = {}
@@ -130,33 +157,46 @@ class Person(Agent):
         # 利用以空间换时间的方法，x,y每step更新一次
         self.x = self.body.position.x
         self.y = self.body.position.y
-        self.pos = np.array([self.getX, self.getY])
         self.vec = np.array([0, 0])
 
-        self.aabb_callback = AABBCallBack(self)
-        self.raycast_callback = RaycastCallBack(self)
-
-        self.total_force = np.zeros([2])
+        self.total_force = 0.0
         self.fij_force_last_eps = np.zeros([2])
         self.fiw_force_last_eps = np.zeros([2])
 
         self.person_state = PersonState.walk_to_goal
         self.group = None
-
-        self.directions = DIRECTIONS
+        self.a_star_path = None
 
         self.exit_in_step = -1
 
+    def respawn(self, new_x, new_y, exit_type, desired_velocity=2.4):
+        """
+        对象池复用：重新分配状态槽位与编号，将已停用的刚体移动到新的位置后重新启用，
+        不再重新创建刚体、夹具与回调
+        """
+        self.slot = self._state.allocate()
+        self.exit_type = exit_type
+        self.id = Person.counter
+        Person.counter += 1
+        self.box.userData.id = self.id
+        if self.sensor is not None:
+            self.sensor.userData.id = self.id
+        self.body.active = False  # 停用时会结束它的所有接触
+        self.body.position = (new_x, new_y)
+        self.body.linearVelocity = (0, 0)
+        self.body.active = True
+        self.body_pic = None
+        self._reset_episode_state(desired_velocity)
+
     def update(self, exits, step_in_env, map: ndarray):
         if self.is_done and self.has_removed:
-            self.x, self.y = 0, 0
-            self.pos = np.array([0, 0])
-            self.vec = np.array([0, 0])
+            self.pos = 0.0
+            self.vec = 0.0
             return -1
-        # 首先更新目前每个ped的坐标
-        self.x, self.y = self.body.position.x, self.body.position.y
-        self.pos = np.array([self.getX, self.getY])
-        self.vec = np.array([self.body.linearVelocity.x, self.body.linearVelocity.y])
+        # 首先更新目前每个ped的坐标，刚体已经销毁的行人(到达出口的follower)保持最后的位置
+        if self.body is not None:
+            self.pos = (self.body.position.x, self.body.position.y)
+            self.vec = (self.body.linearVelocity.x, self.body.linearVelocity.y)
 
         # 检查是否有行人到达出口要进行移除
         def exam_self_exit(a, b):
@@ -168,6 +208,91 @@ class Person(Agent):
             self.is_done = True
             self.exit_in_step = step_in_env
 
+    # 以下属性均为PedsState中对应槽位的视图，赋值时原地写入数组
+    @property
+    def x(self):
+        return self._state.pos[self.slot, 0]
+
+    @x.setter
+    def x(self, value):
+        self._state.pos[self.slot, 0] = value
+
+    @property
+    def y(self):
+        return self._state.pos[self.slot, 1]
+
+    @y.setter
+    def y(self, value):
+        self._state.pos[self.slot, 1] = value
+
+    @property
+    def pos(self):
+        return self._state.pos[self.slot]
+
+    @pos.setter
+    def pos(self, value):
+        self._state.pos[self.slot] = value
+
+    @property
+    def vec(self):
+        return self._state.vec[self.slot]
+
+    @vec.setter
+    def vec(self, value):
+        self._state.vec[self.slot] = value
+
+    @property
+    def total_force(self):
+        return self._state.force[self.slot]
+
+    @total_force.setter
+    def total_force(self, value):
+        self._state.force[self.slot] = value
+
+    @property
+    def desired_velocity(self):
+        return self._state.desired_velocity[self.slot]
+
+    @property
+    def exit_type(self):
+        return int(self._state.exit_type[self.slot])
+
+    @exit_type.setter
+    def exit_type(self, value):
+        self._state.exit_type[self.slot] = value
+
+    @property
+    def exit_in_step(self):
+        return int(self._state.exit_in_step[self.slot])
+
+    @exit_in_step.setter
+    def exit_in_step(self, value):
+        self._state.exit_in_step[self.slot] = value
+
+    @property
+    def is_done(self):
+        return bool(self._state.is_done[self.slot])
+
+    @is_done.setter
+    def is_done(self, value):
+        self._state.is_done[self.slot] = value
+
+    @property
+    def has_removed(self):
+        return bool(self._state.has_removed[self.slot])
+
+    @has_removed.setter
+    def has_removed(self, value):
+        self._state.has_removed[self.slot] = value
+
+    @property
+    def is_leader(self):
+        return bool(self._state.is_leader[self.slot])
+
+    @is_leader.setter
+    def is_leader(self, value):
+        self._state.is_leader[self.slot] = value
+
     @property
     def vec_norm(self):
         return np.linalg.norm(self.vec)
@@ -263,6 +388,17 @@ class Person(Agent):
         applied_force = (d_v - self.vec) * self.mass / self.tau
         self.total_force += applied_force
 
+    @classmethod
+    def batch_self_driven_force(cls, state: PedsState, slots: np.ndarray, directions: np.ndarray):
+        """
+        self_driven_force的数组版本，一次性给slots中的所有行人施加自驱动力
+        :param state: 行人状态数组
+        :param slots: 行人的槽位
+        :param directions: 形状为(len(slots), 2)的方向数组
+        """
+        d_v = directions * state.desired_velocity[slots, None]
+        state.force[slots] += (d_v - state.vec[slots]) * cls.mass / cls.tau
+
     # 社会力模型添加
     def fij_force(self, peds, group):
         detect_persons = list(self.detected_agents.values())
@@ -279,11 +415,22 @@ class Person(Agent):
         self.fij_force_last_eps = total_force
         self.total_force += total_force
 
-    def fiw_force(self, obj):
-        detect_things = list(self.detected_obstacles.values())
+    def fiw_force(self, obj, field=None):
+        """
+        :param field: 地图的障碍物距离场(ObstacleField)，给定时从距离场中读取传感器范围内的障碍物，
+                      而不是使用传感器的接触结果
+        """
+        if field is not None:
+            index, _ = field.candidates(np.array([[self.getX, self.getY]]), self.radius + 1)  # 与传感器的探测范围相同
+            detect_things = [tuple(field.centers[i]) for i in index[0] if i >= 0]
+        else:
+            pos = (self.getX, self.getY)
+            detect_range = self.radius + 1 + b2_polygonRadius  # 与传感器的探测范围相同
+            detect_things = [center for obs in self.detected_obstacles.values()
+                             for center in obs.cell_centers_near(pos, detect_range)]
         total_force = b2Vec2(0, 0)
-        for obs in detect_things:
-            pos, next_pos = (self.getX, self.getY), (obs.getX, obs.getY)
+        for next_pos in detect_things:
+            pos = (self.getX, self.getY)
             dis = ((pos[0] - next_pos[0]) ** 2 + (pos[1] - next_pos[1]) ** 2) ** 0.5
             fiw = self.A * math.exp((dis - self.radius - 0.5) / self.B)  # 因为每块墙的大小都为1*1m
             total_force += b2Vec2(fiw * (pos[0] - next_pos[0]), fiw * (pos[1] - next_pos[1]))
@@ -337,7 +484,10 @@ class Person(Agent):
         world.RayCast(callback, start_point, end_point)
         return callback.obs
 
-    def delete(self, env: b2World):
+    def delete(self, env: b2World, keep_body=False):
+        """
+        :param keep_body: 为True时只停用刚体而不销毁，供对象池在下一回合复用
+        """
         if self.body_pic != None:
             self.body_pic.delete()
             del self.body_pic
@@ -345,7 +495,11 @@ class Person(Agent):
                 self.leader_pic.delete()
                 del self.leader_pic
         if self.body != None:
-            env.DestroyBody(self.body)
+            if keep_body:
+                self.body.active = False
+            else:
+                env.DestroyBody(self.body)
+                self.body = None
         # self.has_removed = True  # 因为逻辑可能不对，选择了在奖励模型处设置has_removed
 
     def __str__(self):
@@ -415,6 +569,10 @@ class BoxWall:
 
     counter = 0
 
+    # 由多个相邻方格合并而成时(Spawner.merge_walls)，原始方格的中心与半宽高，形状为(K, 2)
+    cells = None
+    cell_halves = None
+
     def __init__(self, env: b2World, new_x, new_y, new_width, new_height, display_level, object_type,
                  color=ColorRed):
         # new_x,new_y代表的是矩形墙的中心坐标
@@ -444,6 +602,18 @@ class BoxWall:
     def delete(self):
         del self
 
+    def cell_centers_near(self, pos, distance):
+        """
+        :return: 未合并的墙返回自身的中心，合并后的墙返回其中与pos的距离小于distance的原始方格的中心，
+                 使得fiw_force等按方格计算的排斥力与合并前相同
+        """
+        if self.cells is None:
+            return [(self.getX, self.getY)]
+        rel = np.asarray(pos, dtype=np.float64) - self.cells
+        gap = rel - np.clip(rel, -self.cell_halves, self.cell_halves)
+        near = (gap ** 2).sum(axis=1) < distance ** 2
+        return [tuple(center) for center in self.cells[near].tolist()]
+
     @property
     def getX(self):
         return self.x
@@ -456,6 +626,16 @@ class BoxWall:
         return "BoxWall{}".format(self.id)
 
 
+# 地图中每种墙由哪几块矩形(宽, 高)组成，拐角墙为一块竖墙加一块横墙
+_BOX = (BoxWall.BOX_WALL_WIDTH, BoxWall.BOX_WALL_HEIGHT)
+_COLUMN = (BoxWall.PIECE_WALL_WIDTH, BoxWall.PIECE_WALL_HEIGHT)
+_ROW = (BoxWall.PIECE_WALL_HEIGHT, BoxWall.PIECE_WALL_WIDTH)
+WALL_PIECES = {"box": [_BOX], "lwall": [_COLUMN], "rwall": [_COLUMN], "uwall": [_ROW], "dwall": [_ROW],
+               "midrow_wall": [_ROW], "midcolumn_wall": [_COLUMN],
+               "corner_left_up_wall": [_COLUMN, _ROW], "corner_left_down_wall": [_COLUMN, _ROW],
+               "corner_right_up_wall": [_COLUMN, _ROW], "corner_right_down_wall": [_COLUMN, _ROW]}
+
+
 class Exit(BoxWall):
     counter = 0
 
@@ -479,11 +659,19 @@ class Exit(BoxWall):
 
 class Group:
     counter = 0
-    group_force_magnitude_dic = defaultdict(float)
+    # 团体力的大小ij_power(r)，r四舍五入到GROUP_FORCE_STEP并限制在[GROUP_FORCE_MIN, GROUP_FORCE_MAX]之间，
+    # 按量化后的下标预先计算为一维数组。原先的实现以np.arange(0.37, 1.5, 0.01)的浮点数为键查字典(defaultdict)，
+    # 只有与四舍五入后的距离精确相等的键(0.37~0.40)能查到，其余距离的团体力为0，表中保留了这一结果
+    GROUP_FORCE_MIN = 0.37
+    GROUP_FORCE_MAX = 1.5
+    GROUP_FORCE_STEP = 0.01
+    group_force_table: np.ndarray = None
 
     # 通过设置这个值来决定智能体跟随leader的点位
     LEADER_BEHIND_DIST = 0.25
 
+    _index: "GroupIndex" = None
+
     def __init__(self, leader: Person, followers: List[Person]):
         self.id = Group.counter
         Group.counter += 1
@@ -495,16 +683,54 @@ class Group:
         self.members = followers.copy()
         self.members.append(leader)
         self.members_set = set(self.members)
-        self.dir_force_dic = defaultdict(lambda: defaultdict(float))
-        self.group_center = self.__get_group_center()
-        self._get_group_force_dis_nij()
+
+    def _bind(self, index: "GroupIndex", center: np.ndarray, follower_vec: np.ndarray, follower_dis: np.ndarray):
+        """
+        center, follower_vec与follower_dis是index中数组对应行的视图
+        """
+        self._index = index
+        self._center = center
+        self._follower_vec = follower_vec
+        self._follower_dis = follower_dis
+        self._follower_row = {ped: i for i, ped in enumerate(self.followers)}
+
+    def _ensure_bound(self):
+        # 环境中的所有团体由环境创建的GroupIndex统一更新，在环境之外单独使用时第一次用到才由自己组成一个
+        if self._index is None:
+            GroupIndex([self], self.leader._state)
+
+    @property
+    def index(self) -> "GroupIndex":
+        self._ensure_bound()
+        return self._index
 
     @classmethod
     def get_gp_magnitude(cls):
-        if len(Group.group_force_magnitude_dic) > 0:
+        if cls.group_force_table is not None:
             return
-        for r in np.arange(0.37, 1.5, 0.01):
-            Group.group_force_magnitude_dic[r] = ij_power(r)
+        count = int(round((cls.GROUP_FORCE_MAX - cls.GROUP_FORCE_MIN) / cls.GROUP_FORCE_STEP)) + 1
+        keys = set(np.arange(cls.GROUP_FORCE_MIN, cls.GROUP_FORCE_MAX, cls.GROUP_FORCE_STEP).tolist())
+        table = np.zeros(count)
+        for k in range(count):
+            r = float(np.round(cls.GROUP_FORCE_MIN + k * cls.GROUP_FORCE_STEP, 2))
+            if r in keys:
+                table[k] = ij_power(r)
+        cls.group_force_table = table
+
+    @classmethod
+    def group_force_magnitude(cls, dis) -> np.ndarray:
+        """
+        :param dis: follower到leader身后跟随点的距离(可以是数组)
+        :return: 查表得到的团体力大小，与原先的字典查找逐位相同(只有距离四舍五入后为0.37~0.40时不为0)
+        """
+        dis = np.clip(np.round(dis, 2), cls.GROUP_FORCE_MIN, cls.GROUP_FORCE_MAX)
+        index = np.rint((dis - cls.GROUP_FORCE_MIN) / cls.GROUP_FORCE_STEP).astype(np.int64)
+        return cls.group_force_table[index]
+
+    @property
+    def group_center(self):
+        self._ensure_bound()
+        return tuple(self._center)
 
     def is_done(self):
         """
@@ -523,48 +749,25 @@ class Group:
         new_leader.is_leader = True
         self.followers.append(last_leader)
         last_leader.is_leader = False
-
-    @classmethod
-    def __get_distance(cls, a, b):
-        ax, ay = a.getX, a.getY
-        bx, by = b[0], b[1]
-        return ((ax - bx) ** 2 + (ay - by) ** 2) ** 0.5
-
-    def __get_group_center(self):
-        center_x, center_y = self.leader.getX, self.leader.getY
-        for ped in self.followers:
-            center_x += ped.getX
-            center_y += ped.getY
-        center_x /= (len(self.followers) + 1)
-        center_y /= (len(self.followers) + 1)
-        return (center_x, center_y)
-
-    def __get_nij(self, target, now):
-        return normalize_vector(target - now.pos)
+        self.index.rebuild()
 
     def get_distance_to_leader(self, ped: Person):
         lx, ly = self.leader.getX, self.leader.getY
         gx, gy = ped.getX, ped.getY
         return ((lx - gx) ** 2 + (ly - gy) ** 2) ** 0.5
 
-    def _get_group_force_dis_nij(self):
-        # 先计算leader身后一定间距的点与各个follower的间距
-        lv, lpos = self.leader.vec, self.leader.pos
-        fpos = lpos - lv * Group.LEADER_BEHIND_DIST
-        for follower in self.followers:
-            dis = self.__get_distance(follower, fpos)
-            self.dir_force_dic[follower][self.leader] = [dis * self.__get_nij(fpos, follower), dis]
-
     def update(self):
-        self.group_center = self.__get_group_center()
-        self._get_group_force_dis_nij()
+        """
+        更新所在GroupIndex中所有团体的中心与团体力，多个团体共享一个GroupIndex时直接调用GroupIndex.update
+        """
+        self.index.update()
 
     def get_group_force(self, follower: Person):
         if follower not in self.followers_set:
             raise Exception("跟随者")
-        nij, dis = self.dir_force_dic[follower][self.leader]
-        dis = np.clip(np.round(dis, 2), 0.37, 1.5)
-        return nij * Group.group_force_magnitude_dic[dis]
+        self._ensure_bound()
+        k = self._follower_row[follower]
+        return self._follower_vec[k] * Group.group_force_magnitude(self._follower_dis[k])
 
     def __contains__(self, item):
         return item in self.members_set
@@ -586,3 +789,56 @@ class Group:
 
     # def setup(self, batch, render_scale):
     #     self.pic = pyglet.shapes.Circle(self.group_center[0], self.group_center[1], 0.5, color=(0, 0, 255), batch=batch)
+
+
+class GroupIndex:
+    """
+    所有团体的成员以索引数组(PedsState中的槽位)的形式保存，每个子步用一次数组运算更新所有团体的中心
+    以及每个follower指向leader身后跟随点的向量与距离，Group的group_center等属性是这里数组对应行的视图
+    """
+
+    def __init__(self, groups: List[Group], state: PedsState):
+        self.groups = groups
+        self.state = state
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        团体的成员或leader改变后重新建立索引数组
+        """
+        groups = self.groups
+        follower_counts = np.array([len(group.followers) for group in groups], dtype=np.int64)
+        # 与原来的逐个累加顺序相同，leader在前
+        self.member_slots = np.array([ped.slot for group in groups for ped in [group.leader] + group.followers],
+                                     dtype=np.int64)
+        self.counts = follower_counts + 1
+        self.offsets = np.cumsum(self.counts) - self.counts
+        self.leader_slots = np.array([group.leader.slot for group in groups], dtype=np.int64)
+        self.follower_slots = np.array([ped.slot for group in groups for ped in group.followers], dtype=np.int64)
+        self.follower_group = np.repeat(np.arange(len(groups)), follower_counts)
+        self.centers = np.zeros([len(groups), 2])
+        self.follower_vec = np.zeros([len(self.follower_slots), 2])
+        self.follower_dis = np.zeros([len(self.follower_slots)])
+        start = 0
+        for row, group in enumerate(groups):
+            end = start + len(group.followers)
+            group._bind(self, self.centers[row], self.follower_vec[start:end], self.follower_dis[start:end])
+            start = end
+        self.update()
+
+    def update(self):
+        if len(self.groups) == 0:
+            return
+        pos, vec = self.state.pos, self.state.vec
+        self.centers[:] = np.add.reduceat(pos[self.member_slots], self.offsets, axis=0) / self.counts[:, None]
+        # leader身后一定间距的点与各个follower的向量与间距
+        target = pos[self.leader_slots] - vec[self.leader_slots] * Group.LEADER_BEHIND_DIST
+        rel = target[self.follower_group] - pos[self.follower_slots]
+        self.follower_vec[:] = rel
+        self.follower_dis[:] = (rel[:, 0] ** 2 + rel[:, 1] ** 2) ** 0.5
+
+    def group_forces(self) -> np.ndarray:
+        """
+        :return: 按follower_slots排列的所有follower受到的团体力
+        """
+        return self.follower_vec * Group.group_force_magnitude(self.follower_dis)[:, None]
@@ -1,3 +1,4 @@
+import heapq
 import logging
 import random
 import time
@@ -5,12 +6,121 @@ import time
 import gym
 import kdtree
 
-from typing import List, Tuple
-from collections import defaultdict
+from typing import List, Tuple, Optional
+from collections import defaultdict, OrderedDict
 
+from numba import njit
 from tqdm import tqdm
 
 from ped_env.utils.maps import *
+from ped_env.utils.cache import hash_arrays, load_or_build
+
+# A*中相邻格子的遍历顺序，与AStar.next_loc的list_offset保持一致，第k位表示允许向OFFSETS[k]扩展
+OFFSETS = ((-1, 0), (0, -1), (0, 1), (1, 0))
+ALL_DIRECTIONS = 0b1111
+
+
+@njit(cache=True)
+def _heap_a_star(barrier, explore_mask, sx, sy, ex, ey, max_iter):
+    """
+    基于二叉堆的A*，open列表中f值相同时按照加入open列表的先后顺序出列，
+    因此得到的父节点与AStar.next_loc中线性扫描open列表得到的完全相同
+    :return: 是否找到路径，父节点坐标矩阵(x, y)
+    """
+    w, h = barrier.shape
+    g = np.zeros((w, h), dtype=np.int64)
+    f = np.zeros((w, h), dtype=np.int64)
+    order = np.zeros((w, h), dtype=np.int64)  # 加入open列表的顺序
+    father_x = np.zeros((w, h), dtype=np.int64)
+    father_y = np.zeros((w, h), dtype=np.int64)
+    opened = np.zeros((w, h), dtype=np.bool_)
+    closed = np.zeros((w, h), dtype=np.bool_)
+    if sx < 0 or sx >= w or sy < 0 or sy >= h:
+        return False, father_x, father_y
+    heap = [(np.int64(0), np.int64(0), np.int64(sx), np.int64(sy))]
+    opened[sx, sy] = True
+    counter = 1
+    clock = 0
+    while len(heap) > 0 and clock < max_iter:
+        nf, no, x, y = heapq.heappop(heap)
+        if closed[x, y] or nf != f[x, y] or no != order[x, y]:
+            continue  # 已经过期的堆元素
+        closed[x, y] = True
+        for k in range(4):
+            if (explore_mask[x, y] >> k) & 1 == 0:
+                continue
+            dx, dy = OFFSETS[k]
+            nx, ny = x + dx, y + dy
+            if nx < 0 or nx >= w or ny < 0 or ny >= h or barrier[nx, ny] or closed[nx, ny]:
+                continue
+            new_g = g[x, y] + 10
+            if not opened[nx, ny]:
+                opened[nx, ny] = True
+                order[nx, ny] = counter
+                counter += 1
+                g[nx, ny] = new_g
+                f[nx, ny] = new_g + (abs(ex - nx) + abs(ey - ny)) * 10
+                father_x[nx, ny], father_y[nx, ny] = x, y
+                heapq.heappush(heap, (f[nx, ny], order[nx, ny], np.int64(nx), np.int64(ny)))
+            elif g[nx, ny] > new_g:
+                f[nx, ny] += new_g - g[nx, ny]
+                g[nx, ny] = new_g
+                father_x[nx, ny], father_y[nx, ny] = x, y
+                heapq.heappush(heap, (f[nx, ny], order[nx, ny], np.int64(nx), np.int64(ny)))
+        clock += 1
+        if x == ex and y == ey:
+            return True, father_x, father_y
+    return False, father_x, father_y
+
+
+@njit(cache=True)
+def _flow_field(barrier, explore_mask, ex, ey):
+    """
+    从出口出发的反向广度优先搜索(所有边的代价相同，等价于Dijkstra)，
+    一次得到所有格子到出口的步数以及下一步的方向
+    :return: 步数矩阵(无法到达为-1)，方向矩阵(W, H, 2)
+    """
+    w, h = barrier.shape
+    distance = np.full((w, h), -1, dtype=np.int64)
+    direction = np.zeros((w, h, 2), dtype=np.int64)
+    if ex < 0 or ex >= w or ey < 0 or ey >= h or barrier[ex, ey]:
+        return distance, direction
+    queue_x = np.empty(w * h, dtype=np.int64)
+    queue_y = np.empty(w * h, dtype=np.int64)
+    queue_x[0], queue_y[0] = ex, ey
+    distance[ex, ey] = 0
+    head, tail = 0, 1
+    while head < tail:
+        vx, vy = queue_x[head], queue_y[head]
+        head += 1
+        if barrier[vx, vy]:
+            continue  # 障碍物只能作为起点，不能作为中间节点
+        for k in range(4):
+            dx, dy = OFFSETS[k]
+            ux, uy = vx - dx, vy - dy  # 可以通过OFFSETS[k]走到v的格子u
+            if ux < 0 or ux >= w or uy < 0 or uy >= h or distance[ux, uy] >= 0:
+                continue
+            if (explore_mask[ux, uy] >> k) & 1 == 0:
+                continue
+            distance[ux, uy] = distance[vx, vy] + 1
+            queue_x[tail], queue_y[tail] = ux, uy
+            tail += 1
+    # 下一步选择步数减一的相邻格子，多个时按照OFFSETS的顺序选择第一个
+    for ux in range(w):
+        for uy in range(h):
+            if distance[ux, uy] <= 0:
+                continue
+            for k in range(4):
+                if (explore_mask[ux, uy] >> k) & 1 == 0:
+                    continue
+                dx, dy = OFFSETS[k]
+                vx, vy = ux + dx, uy + dy
+                if vx < 0 or vx >= w or vy < 0 or vy >= h or barrier[vx, vy]:
+                    continue
+                if distance[vx, vy] == distance[ux, uy] - 1:
+                    direction[ux, uy, 0], direction[ux, uy, 1] = dx, dy
+                    break
+    return distance, direction
 
 
 # https://github.com/lc6chang/Social_Force_Model
@@ -43,16 +153,151 @@ class Path:
         return self.vec_dir
 
 
+class PathCache:
+    """
+    以(起始格子, 目标格子)为键的LRU路径缓存，同一团体追随同一leader的follower以及去往同一出口的follower可以共享路径。
+    A*的结果只与起点和终点有关，因此命中缓存与重新寻路得到的路径完全相同；
+    目标格子变化时键也随之变化，旧的路径会因为不再被使用而被逐渐淘汰
+    """
+
+    def __init__(self, planner, maxsize: int = 1024):
+        self.planner = planner
+        self.maxsize = maxsize
+        self.paths = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, start: Tuple[int, int], goal: Tuple[int, int]) -> Optional[Path]:
+        """
+        :return: 已经计算好vec_dir的路径，找不到路时为None，多个follower共享同一Path对象，不应修改
+        """
+        key = (start, goal)
+        if key in self.paths:
+            self.hits += 1
+            self.paths.move_to_end(key)
+            return self.paths[key]
+        self.misses += 1
+        re, path = self.planner.next_loc(start[0], start[1], goal[0], goal[1])
+        if path is not None:
+            path.calculate_vec_dir_in_path()
+        self.paths[key] = path
+        if len(self.paths) > self.maxsize:
+            self.paths.popitem(last=False)
+        return path
+
+    def invalidate(self, goal: Tuple[int, int] = None):
+        """
+        删除去往goal的所有路径，goal为None时清空缓存
+        """
+        if goal is None:
+            self.paths.clear()
+            return
+        for key in [key for key in self.paths if key[1] == goal]:
+            del self.paths[key]
+
+
+class FlowField:
+    def __init__(self, exit_pos, distance: np.ndarray, direction: np.ndarray):
+        """
+        某个出口的距离场与方向场
+        :param exit_pos: 出口坐标
+        :param distance: 每个格子到出口的步数，无法到达为-1
+        :param direction: 每个格子下一步的方向向量
+        """
+        self.exit_pos = exit_pos
+        self.end_pos = (int(exit_pos[0]), int(exit_pos[1]))
+        self.distance = distance
+        self.direction = direction
+
+    @classmethod
+    def build(cls, planner, exit_pos):
+        """
+        :param planner: 提供障碍物信息的AStar
+        """
+        distance, direction = _flow_field(planner.barrier_grid, planner.explore_mask, int(exit_pos[0]), int(exit_pos[1]))
+        return cls(exit_pos, distance, direction)
+
+    def to_arrays(self):
+        return {"distance": self.distance, "direction": self.direction}
+
+    def reachable(self, x, y) -> bool:
+        return 0 <= x < self.distance.shape[0] and 0 <= y < self.distance.shape[1] and self.distance[x, y] >= 0
+
+    def next_dir(self, x, y) -> Tuple[int, int]:
+        """
+        :return: 下一步的方向向量，无法到达出口时为(0, 0)
+        """
+        if not self.reachable(x, y):
+            return 0, 0
+        return int(self.direction[x, y, 0]), int(self.direction[x, y, 1])
+
+    def path(self, x, y) -> Optional[Path]:
+        """
+        沿方向场回溯出从(x, y)到出口的路径，格式与AStar.next_loc返回的Path相同
+        """
+        if not self.reachable(x, y):
+            return None
+        start_pos = (x, y)
+        path_arr = [(x + 0.5, y + 0.5)]
+        for _ in range(int(self.distance[x, y]) - 1):
+            dx, dy = self.next_dir(x, y)
+            x, y = x + dx, y + dy
+            path_arr.append((x + 0.5, y + 0.5))
+        return Path(start_pos, self.end_pos, path_arr)
+
+
+class LazyPathDict(dict):
+    """
+    键为起始坐标，值为沿方向场回溯得到的Path，只在第一次访问时计算
+    """
+
+    def __init__(self, field: FlowField, starts):
+        super().__init__()
+        self.field = field
+        self.starts = set(starts)
+
+    def __missing__(self, key):
+        if key not in self.starts:
+            raise KeyError(key)
+        self[key] = self.field.path(*key)
+        return self[key]
+
+    def __contains__(self, key):
+        return key in self.starts
+
+
 class AStar:
-    def __init__(self, map: Map):
+    BACKENDS = ("heap", "list")
+
+    def __init__(self, map: Map, backend: str = "heap"):
+        """
+        :param backend: "heap"使用二叉堆与数组实现的A*(由numba编译)，"list"使用原始的基于列表的实现，两者的结果完全相同
+        """
+        assert backend in AStar.BACKENDS, "backend必须为{}之一".format(AStar.BACKENDS)
         self.map = map
+        self.backend = backend
         self.barrier_list = []
         self.can_explore_grid_dict = {}
         self.init_barrier_list()
         self.dir_vector_matrix_dic = dict()  # 值是出口坐标(x,y)，键是ndarray
         self.path_matrix_dic = defaultdict(dict)  # 键是出口坐标(x,y),值是一个字典(键是起始坐标(sx,sy),值是路径Path)
+        self.flow_fields = dict()  # 键是出口坐标(x,y),值是FlowField
 
     def init_barrier_list(self):
+        """
+        障碍物列表与可探索方向，结果以地图内容的哈希为键缓存在磁盘上
+        """
+        arrays = load_or_build("barrier", self.map.content_hash, self._build_barrier_arrays)
+        self.barrier_grid = arrays["barrier"]
+        self.explore_mask = arrays["explore_mask"]
+        # 与地图的遍历顺序(先列后行)保持一致
+        self.barrier_list = [(int(i), int(j)) for j, i in np.argwhere(self.barrier_grid.T)]
+        self.can_explore_grid_dict = {}
+        for j, i in np.argwhere(self.explore_mask.T != ALL_DIRECTIONS):
+            mask = self.explore_mask[i, j]
+            self.can_explore_grid_dict[(int(i), int(j))] = [OFFSETS[k] for k in range(4) if (mask >> k) & 1]
+
+    def _build_barrier_arrays(self):
         terrain = self.map.map
         explore_type_dict = {
             "lw": [(1, 0)],
@@ -64,16 +309,44 @@ class AStar:
             "cluw": [(1, 0)],
             "cldw": [(1, 0)]
         }
-
+        # 供heap后端使用的数组形式，第k位表示允许向OFFSETS[k]扩展
+        barrier = np.zeros(terrain.shape, dtype=bool)
+        explore_mask = np.full(terrain.shape, ALL_DIRECTIONS, dtype=np.int64)
         for j in range(terrain.shape[1]):
             for i in range(terrain.shape[0]):
                 e = str(terrain[i, j])
                 if e in ('1', '2'):
-                    self.barrier_list.append((i, j))
+                    barrier[i, j] = True
                 elif e in explore_type_dict.keys():
-                    self.can_explore_grid_dict[(i, j)] = explore_type_dict[e]
+                    explore_mask[i, j] = sum(1 << OFFSETS.index(offset) for offset in explore_type_dict[e])
+        return {"barrier": barrier, "explore_mask": explore_mask}
 
     def next_loc(self, x, y, dest_x, dest_y) -> Tuple[Tuple, Path]:
+        if self.backend == "list":
+            return self._next_loc_list(x, y, dest_x, dest_y)
+        start_loc = (x, y)
+        aim_loc = (dest_x, dest_y)
+        find_way, father_x, father_y = _heap_a_star(self.barrier_grid, self.explore_mask, x, y,
+                                                    dest_x, dest_y, 100000)
+        if find_way:
+            # 与_next_loc_list相同的方式回溯父节点
+            temp = aim_loc
+            path_arr = []
+            clock = 0
+            while (father_x[temp], father_y[temp]) != start_loc and clock < 2000:
+                temp = (int(father_x[temp]), int(father_y[temp]))
+                path_arr.append((temp[0] + 0.5, temp[1] + 0.5))
+                clock += 1
+            path_arr.append((start_loc[0] + 0.5, start_loc[1] + 0.5))
+            path_arr.reverse()
+            path = Path(start_loc, aim_loc, path_arr)
+            re = (temp[0] - start_loc[0], temp[1] - start_loc[1])
+            return re, path
+        else:
+            print("Warning,A* find no path from {} to {}!!!".format(start_loc, aim_loc))
+            return (0, 0), None
+
+    def _next_loc_list(self, x, y, dest_x, dest_y) -> Tuple[Tuple, Path]:
         # 初始化各种状态
         start_loc = (x, y)  # 初始化起始点
         aim_loc = [(dest_x, dest_y)]  # 初始化目标地点
@@ -167,7 +440,37 @@ class AStar:
             print("Warning,A* find no path from {} to {}!!!".format(start_loc, aim_loc[0]))
             return (0, 0), None
 
-    def calculate_dir_vector(self):
+    def get_flow_field(self, exit_pos) -> FlowField:
+        """
+        得到去往exit_pos的距离场与方向场，第一次使用时计算
+        """
+        exit_pos = tuple(exit_pos)
+        if exit_pos not in self.flow_fields:
+            # 方向场只与障碍物和出口所在的格子有关，以它们的哈希为键缓存在磁盘上
+            key = hash_arrays(self.barrier_grid, self.explore_mask, np.array(exit_pos, dtype=np.int64))
+            arrays = load_or_build("flow_field", key, lambda: FlowField.build(self, exit_pos).to_arrays())
+            self.flow_fields[exit_pos] = FlowField(exit_pos, arrays["distance"], arrays["direction"])
+        return self.flow_fields[exit_pos]
+
+    def calculate_dir_vector(self, method: str = "flow_field"):
+        """
+        计算所有空地去往每个出口的下一步方向向量与路径
+        :param method: "flow_field"对每个出口做一次反向搜索，路径在使用时才回溯生成；
+                       "a_star"对每个空地都调用一次next_loc
+        """
+        if method == "a_star":
+            return self._calculate_dir_vector_a_star()
+        terrain = self.map.map
+        free = [(i, j) for j in range(terrain.shape[1]) for i in range(terrain.shape[0]) if terrain[i, j] == '0']
+        for exit in self.map.exits:
+            field = self.get_flow_field(exit)
+            vector_matrix = [[0 for i in range(terrain.shape[1])] for i in range(terrain.shape[0])]
+            for i, j in free:
+                vector_matrix[i][j] = field.next_dir(i, j)
+            self.dir_vector_matrix_dic[exit] = vector_matrix
+            self.path_matrix_dic[(exit[0], exit[1])] = LazyPathDict(field, free)
+
+    def _calculate_dir_vector_a_star(self):
         logging.warning("使用耗费大量时间的A*寻路算法！")
         terrain = self.map.map
         for exit in self.map.exits:
@@ -23,6 +23,7 @@ for angle in range(0, 360, int(360 / (ACTION_DIM - 1))):  # 逆时针旋转angle
                     [sin(theta), cos(theta)]], dtype=np.float)
     vec = np.squeeze((mat.dot(identity)).tolist())
     actions.append(np.array(vec))
+ACTIONS_ARRAY = np.array(actions)  # 用于批量将离散动作转化为方向
 # print(actions)
 
 identity = np.array([1, 0])
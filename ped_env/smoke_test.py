@@ -0,0 +1,146 @@
+"""
+PedsMoveEnv的冒烟测试：用固定种子创建环境，reset后执行若干step，检查观察与声明的观察空间一致，
+并在同一张地图上逐个检查构造参数(engine, renderer, array_output, contacts, adaptive_substeps, spatial_index, merge_walls)。
+可以直接运行(python -m ped_env.smoke_test)，也可以由pytest收集
+"""
+import logging
+from typing import List, Tuple
+
+import numpy as np
+
+from ped_env.envs import PedsMoveEnv
+from ped_env.mdp import (PedsRLHandlerWithForce, PedsVisionRLHandler, PedsGridRLHandler, PedsRLHandler,
+                         PedsRLHandlerWithPlanner)
+
+MAP = "map_10"
+PERSON_NUM = 20
+HANDLERS = (PedsRLHandlerWithForce, PedsVisionRLHandler, PedsGridRLHandler, PedsRLHandler, PedsRLHandlerWithPlanner)
+
+
+def run_env(steps: int = 3, **kwargs) -> Tuple[PedsMoveEnv, List[np.ndarray]]:
+    """
+    创建环境并以固定的动作序列运行steps步，每次都检查观察的形状与类型
+    :return: 环境与每一步(包括reset)所有智能体的观察
+    """
+    env = PedsMoveEnv(MAP, PERSON_NUM, maxStep=1000, **kwargs)
+    obs = env.reset(seed=0)
+    history = [check_obs(env, obs)]
+    for t in range(steps):
+        actions = {agent: (t + i) % 9 for i, agent in enumerate(env.agents)}
+        obs, rewards, dones, truncated, infos = env.step(actions)
+        history.append(check_obs(env, obs))
+        assert set(rewards.keys()) == set(obs.keys())
+    return env, history
+
+
+def check_obs(env: PedsMoveEnv, obs) -> np.ndarray:
+    for agent in env.agents:
+        space = env.observation_spaces[agent]
+        value = np.asarray(obs[agent])
+        assert value.shape == space.shape, (agent, value.shape, space.shape)
+        if env.array_output:
+            assert value.dtype == space.dtype, (agent, value.dtype, space.dtype)
+    return np.array([np.asarray(obs[agent], dtype=np.float64) for agent in obs])
+
+
+def assert_same_rollout(a: List[np.ndarray], b: List[np.ndarray]):
+    assert len(a) == len(b)
+    for x, y in zip(a, b):
+        assert np.array_equal(x, y.astype(x.dtype))
+
+
+def test_handlers_array_output():
+    # array_output预先按observation_space分配数组，处理器写入的观察必须与之一致
+    for handler in HANDLERS:
+        for array_output in (False, True):
+            env, _ = run_env(person_handler=handler, array_output=array_output)
+            if array_output:
+                assert env.obs_buffer.dtype == env.observation_spaces[env.possible_agents[0]].dtype
+            env.close()
+
+
+def test_array_output_same_obs():
+    # 观察数组按observation_space的类型(float32)保存，与普通输出转换为该类型后相同
+    _, expected = run_env()
+    _, actual = run_env(array_output=True)
+    assert_same_rollout([x.astype(np.float32) for x in expected], actual)
+
+
+def test_engine_numpy():
+    for handler in (PedsRLHandlerWithForce, PedsRLHandler):
+        for vectorized in (False, True):
+            env, _ = run_env(person_handler=handler, engine="numpy", vectorized=vectorized)
+            env.close()
+
+
+def test_renderer_numpy():
+    # numpy渲染后端与pygame逐像素一致
+    envs = [run_env(renderer=renderer)[0] for renderer in PedsMoveEnv.RENDERERS]
+    S = PedsMoveEnv.RENDER_CELL_PIXELS
+    for mode in ("rgb_array", "gray_array"):
+        frames = []
+        for env in envs:
+            env.render(mode)
+            frames.append(np.asarray(env.render_data))
+            assert frames[-1].shape[:2] == (env.terrain.width * S, env.terrain.height * S)
+        assert np.array_equal(frames[0], frames[1])
+    for env in envs:
+        env.close()
+
+
+def test_contacts_array():
+    # 使用spatial_index时最近行人按距离排序，两种接触统计方式的观察逐位相同
+    for engine in PedsMoveEnv.ENGINES:
+        _, expected = run_env(engine=engine, spatial_index=True, contacts="listener")
+        _, actual = run_env(engine=engine, spatial_index=True, contacts="array")
+        assert_same_rollout(expected, actual)
+
+
+def test_adaptive_substeps():
+    for engine in PedsMoveEnv.ENGINES:
+        env, _ = run_env(engine=engine, vectorized=True, adaptive_substeps=4)
+        env.close()
+    try:
+        PedsMoveEnv(MAP, PERSON_NUM, adaptive_substeps=4)
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError(u"adaptive_substeps需要vectorized=True")
+
+
+def test_spatial_index():
+    for engine in PedsMoveEnv.ENGINES:
+        env, _ = run_env(engine=engine, spatial_index=True)
+        env.close()
+
+
+def test_merge_walls():
+    env, _ = run_env(merge_walls=True)
+    assert env.static_owner is not None
+    env.close()
+    try:
+        PedsMoveEnv(MAP, PERSON_NUM, engine="numpy", merge_walls=True)
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError(u"merge_walls需要engine=\"box2d\"")
+
+
+def test_snapshot():
+    # 从同一快照出发，相同的动作得到逐位相同的观察
+    env, _ = run_env(engine="numpy")
+    state = env.get_state()
+    actions = {agent: 2 for agent in env.agents}
+    first = check_obs(env, env.step(actions)[0])
+    env.set_state(state)
+    second = check_obs(env, env.step(actions)[0])
+    assert np.array_equal(first, second)
+    env.close()
+
+
+if __name__ == '__main__':
+    logging.disable(logging.WARNING)
+    for name, func in list(globals().items()):
+        if name.startswith("test_") and callable(func):
+            func()
+            print(name, "ok")
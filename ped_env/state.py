@@ -0,0 +1,70 @@
+import numpy as np
+
+
+class PedsState:
+    """
+    以结构化数组(structure-of-arrays)的形式存放所有行人的状态，
+    每个行人占据一个槽位(slot)，Person对象只是对其槽位的一个视图，
+    这样社会力、跟随混合以及到达出口的判定都可以按数组批量计算
+    """
+    FIELDS = ("pos", "vec", "force", "desired_velocity", "exit_type", "exit_in_step",
+              "is_done", "has_removed", "is_leader", "agent_contacts", "wall_contacts")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.size = 0
+        self.pos = np.zeros([capacity, 2])
+        self.vec = np.zeros([capacity, 2])
+        self.force = np.zeros([capacity, 2])
+        self.desired_velocity = np.zeros([capacity])
+        self.exit_type = np.zeros([capacity], dtype=np.int64)
+        self.exit_in_step = np.full([capacity], -1, dtype=np.int64)
+        self.is_done = np.zeros([capacity], dtype=bool)
+        self.has_removed = np.zeros([capacity], dtype=bool)
+        self.is_leader = np.zeros([capacity], dtype=bool)
+        # 由ContactTracker维护的当前接触数(与其他团体的行人、与墙)
+        self.agent_contacts = np.zeros([capacity], dtype=np.int64)
+        self.wall_contacts = np.zeros([capacity], dtype=np.int64)
+
+    def allocate(self) -> int:
+        """
+        分配一个新的槽位，容量不足时按两倍扩容
+        :return: 槽位编号
+        """
+        if self.size >= self.capacity:
+            self._grow(max(1, self.capacity * 2))
+        slot = self.size
+        self.size += 1
+        return slot
+
+    def _grow(self, new_capacity):
+        for name in self.FIELDS:
+            old = getattr(self, name)
+            new = np.zeros((new_capacity,) + old.shape[1:], dtype=old.dtype)
+            if name == "exit_in_step":
+                new[:] = -1
+            new[:self.capacity] = old
+            setattr(self, name, new)
+        self.capacity = new_capacity
+
+    def clear(self):
+        self.size = 0
+        self.pos[:] = 0.0
+        self.vec[:] = 0.0
+        self.force[:] = 0.0
+        self.desired_velocity[:] = 0.0
+        self.exit_type[:] = 0
+        self.exit_in_step[:] = -1
+        self.is_done[:] = False
+        self.has_removed[:] = False
+        self.is_leader[:] = False
+        self.agent_contacts[:] = 0
+        self.wall_contacts[:] = 0
+
+    @property
+    def removed_mask(self):
+        """已经到达出口并被移除的行人"""
+        return self.is_done[:self.size] & self.has_removed[:self.size]
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,54 @@
+import hashlib
+import logging
+import os
+import zipfile
+from typing import Callable, Dict
+
+import numpy as np
+
+# 缓存目录，可以通过环境变量PED_ENV_CACHE_DIR修改
+CACHE_DIR = os.environ.get("PED_ENV_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ped_env"))
+# 缓存内容的格式或计算方法(障碍表、方向场的BFS、距离场等)改变时加一，旧的缓存文件不再被读取
+CACHE_VERSION = 1
+
+
+def hash_arrays(*arrays) -> str:
+    """
+    根据数组的类型、形状与内容计算哈希值，用作缓存文件的键
+    """
+    h = hashlib.sha1()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(str(arr.dtype).encode())
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()[:16]
+
+
+def load_or_build(name: str, key: str, builder: Callable[[], Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    """
+    从缓存目录读取name-<键>.npz，不存在或损坏时调用builder计算并写入缓存，
+    文件的键由CACHE_VERSION、name与key共同计算
+    :param name: 缓存的类别
+    :param key: 输入内容的哈希
+    :param builder: 返回{名称: 数组}的函数
+    :return: {名称: 数组}
+    """
+    full_key = hashlib.sha1("{}:{}:{}".format(CACHE_VERSION, name, key).encode()).hexdigest()[:16]
+    path = os.path.join(CACHE_DIR, "{}-{}.npz".format(name, full_key))
+    if os.path.exists(path):
+        try:
+            with np.load(path) as data:
+                return {k: data[k] for k in data.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            logging.warning(u"缓存文件{}损坏，重新计算...".format(path))
+    arrays = builder()
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # 先写入临时文件再改名，避免多个进程同时写入时读到不完整的文件
+        tmp_path = "{}.{}.tmp.npz".format(path[:-4], os.getpid())
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+    except OSError:
+        logging.warning(u"无法写入缓存文件{}".format(path))
+    return arrays
@@ -0,0 +1,156 @@
+import numpy as np
+
+
+class ObstacleField:
+    """
+    静态障碍物(墙与障碍物)的距离场，地图被细分为每米resolution个格子，每个格子预先记录:
+    distance: 格子中心到最近障碍物表面的距离(在障碍物内部为0)
+    nearest_vector: 格子中心指向最近障碍物表面上最近点的向量
+    nearest_index: 按表面距离升序排列的最近k个障碍物编号(不足时为-1)
+    kth_distance: 第k个障碍物的表面距离，用于判断某次查询只看这k个障碍物是否足够
+    这样最近障碍物的查询只需要一次数组索引，而不需要每步都通过Box2D的传感器或AABB查询
+    """
+    RESOLUTION = 10  # 每米细分的格子数
+    K = 16
+
+    ARRAY_NAMES = ("centers", "halves", "distance", "nearest_vector", "nearest_index", "kth_distance")
+
+    def __init__(self, centers, halves, distance, nearest_vector, nearest_index, kth_distance, resolution):
+        self.centers = centers
+        self.halves = halves
+        self.distance = distance
+        self.nearest_vector = nearest_vector
+        self.nearest_index = nearest_index
+        self.kth_distance = kth_distance
+        self.resolution = resolution
+        # 格子内任意一点到格子中心的最大距离，表面距离是1-Lipschitz的，用于估计误差上界
+        self._half_diagonal = 0.5 ** 0.5 / resolution
+
+    @classmethod
+    def build(cls, centers, halves, width, height, resolution=RESOLUTION, k=K, chunk=4096):
+        """
+        :param centers: 形状为(M, 2)的障碍物矩形中心
+        :param halves: 形状为(M, 2)的障碍物矩形半宽与半高
+        :param width: 地图宽度(米)
+        :param height: 地图高度(米)
+        """
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        halves = np.asarray(halves, dtype=np.float64).reshape(-1, 2)
+        nx, ny = int(width * resolution), int(height * resolution)
+        xs = (np.arange(nx) + 0.5) / resolution
+        ys = (np.arange(ny) + 0.5) / resolution
+        points = np.stack(np.meshgrid(xs, ys, indexing="ij"), axis=-1).reshape(-1, 2)
+        count = len(points)
+        k = min(k, len(centers))
+        distance = np.full([count], np.inf)
+        nearest_vector = np.zeros([count, 2])
+        nearest_index = np.full([count, cls.K], -1, dtype=np.int32)
+        kth_distance = np.full([count], np.inf)
+        for start in range(0, count if k > 0 else 0, chunk):
+            p = points[start:start + chunk]
+            rel = p[:, None, :] - centers[None, :, :]
+            closest = np.clip(rel, -halves, halves)
+            rect_dis = np.linalg.norm(rel - closest, axis=2)
+            order = np.argsort(rect_dis, axis=1, kind="stable")[:, :k]
+            rows = np.arange(len(p))
+            nearest = order[:, 0]
+            distance[start:start + chunk] = rect_dis[rows, nearest]
+            nearest_vector[start:start + chunk] = (closest - rel)[rows, nearest]
+            nearest_index[start:start + chunk, :k] = order
+            if k < len(centers):
+                # 第k+1近的障碍物的距离，小于它的查询范围内的障碍物一定都在前k个之中
+                kth_distance[start:start + chunk] = np.partition(rect_dis, k, axis=1)[:, k]
+        shape = (nx, ny)
+        return cls(centers, halves, distance.reshape(shape), nearest_vector.reshape(shape + (2,)),
+                   nearest_index.reshape(shape + (cls.K,)), kth_distance.reshape(shape), resolution)
+
+    @classmethod
+    def from_arrays(cls, arrays, resolution=RESOLUTION):
+        return cls(*[arrays[name] for name in cls.ARRAY_NAMES], resolution=resolution)
+
+    def to_arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAY_NAMES}
+
+    def __len__(self):
+        return len(self.centers)
+
+    def _cells(self, pos):
+        """
+        :return: 格子坐标以及是否在地图范围内
+        """
+        cells = np.floor(pos * self.resolution).astype(np.int64)
+        inside = (cells[:, 0] >= 0) & (cells[:, 0] < self.distance.shape[0]) & \
+                 (cells[:, 1] >= 0) & (cells[:, 1] < self.distance.shape[1])
+        cx = np.clip(cells[:, 0], 0, self.distance.shape[0] - 1)
+        cy = np.clip(cells[:, 1], 0, self.distance.shape[1] - 1)
+        return cx, cy, inside
+
+    def query(self, pos: np.ndarray):
+        """
+        读取行人所在格子的距离场
+        :param pos: 形状为(N, 2)的坐标
+        :return: 到最近障碍物表面的距离(N,)与指向它的向量(N, 2)
+        """
+        pos = np.asarray(pos, dtype=np.float64).reshape(-1, 2)
+        cx, cy, _ = self._cells(pos)
+        return self.distance[cx, cy], self.nearest_vector[cx, cy]
+
+    def rect_distance(self, pos, index):
+        """
+        :return: pos(N, 2)到index(N, K)对应障碍物矩形表面的距离，-1处为inf
+        """
+        safe = np.maximum(index, 0)
+        rel = pos[:, None, :] - self.centers[safe]
+        outside = np.maximum(np.abs(rel) - self.halves[safe], 0.0)
+        return np.where(index >= 0, np.linalg.norm(outside, axis=2), np.inf)
+
+    def candidates(self, pos: np.ndarray, max_distance: float):
+        """
+        查询表面距离小于max_distance的所有障碍物，大部分查询只需要读取所在格子的前k个障碍物，
+        当前k个不足以覆盖查询范围时(或者在地图外)才对所有障碍物计算距离，因此结果总是精确的
+        :param pos: 形状为(N, 2)的坐标
+        :return: 障碍物编号(N, K)(-1为空)与对应的表面距离(N, K)
+        """
+        pos = np.asarray(pos, dtype=np.float64).reshape(-1, 2)
+        cx, cy, inside = self._cells(pos)
+        index = self.nearest_index[cx, cy].astype(np.int64)
+        exact = inside & (self.kth_distance[cx, cy] - self._half_diagonal >= max_distance)
+        if not np.all(exact):
+            rows = np.flatnonzero(~exact)
+            all_index = np.broadcast_to(np.arange(len(self.centers)), (len(rows), len(self.centers)))
+            all_dis = self.rect_distance(pos[rows], all_index)
+            width = max(index.shape[1], int((all_dis < max_distance).sum(axis=1).max(initial=0)))
+            if width > index.shape[1]:
+                index = np.concatenate([index, np.full([len(pos), width - index.shape[1]], -1)], axis=1)
+            order = np.argsort(all_dis, axis=1, kind="stable")[:, :width]
+            index[rows] = -1
+            index[rows, :order.shape[1]] = order
+        dis = self.rect_distance(pos, index)
+        index = np.where(dis < max_distance, index, -1)
+        return index, np.where(index >= 0, dis, np.inf)
+
+    def nearest(self, pos: np.ndarray, n: int, half_width: float, max_distance: float = np.inf):
+        """
+        与QueryAABB的语义相同：查询以pos为中心、半边长为half_width的正方形内中心距离不超过max_distance的障碍物，
+        返回中心距离最近的n个
+        :return: 障碍物编号(N, n)(不足时为-1)与中心距离(N, n)，按距离升序排列
+        """
+        pos = np.asarray(pos, dtype=np.float64).reshape(-1, 2)
+        # 中心落在正方形内的障碍物，其表面距离不会超过中心距离
+        reach = min(max_distance, half_width * 2 ** 0.5) + 1e-9
+        index, _ = self.candidates(pos, reach)
+        safe = np.maximum(index, 0)
+        rel = self.centers[safe] - pos[:, None, :]
+        dis = (rel[:, :, 0] ** 2 + rel[:, :, 1] ** 2) ** 0.5
+        keep = (index >= 0) & (np.abs(rel[:, :, 0]) <= half_width) & (np.abs(rel[:, :, 1]) <= half_width) & \
+               (dis <= max_distance)
+        dis = np.where(keep, dis, np.inf)
+        order = np.argsort(dis, axis=1, kind="stable")[:, :n]
+        rows = np.arange(len(pos))[:, None]
+        dis = dis[rows, order]
+        index = np.where(np.isfinite(dis), index[rows, order], -1)
+        if index.shape[1] < n:
+            pad = n - index.shape[1]
+            index = np.concatenate([index, np.full([len(pos), pad], -1)], axis=1)
+            dis = np.concatenate([dis, np.full([len(pos), pad], np.inf)], axis=1)
+        return index, dis
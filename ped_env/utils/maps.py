@@ -6,9 +6,11 @@ import numpy as np
 from numpy import flipud
 from random import sample
 
-from ped_env.objects import Person
+from ped_env.objects import Person, WALL_PIECES
 from ped_env.settings import identity
 from ped_env.functions import angle_between
+from ped_env.utils.cache import hash_arrays, load_or_build
+from ped_env.utils.fields import ObstacleField
 
 
 class Map:
@@ -29,6 +31,7 @@ class Map:
         self.exit_points_dic = defaultdict(list)
         self.has_key_roads = False
         self.max_dis_to_exit = 1.0
+        self._obstacle_field = None
         #self.init()
 
     def init(self):
@@ -83,6 +86,46 @@ class Map:
             angle = 0.0
         return min_dis, angle
 
+    def get_obstacle_nodes(self):
+        """
+        按照环境创建墙体的顺序(先obstacles后walls)给出所有静态障碍物矩形的中心与半宽高
+        """
+        from ped_env.envs import Parser
+        parser = Parser.load(self.map, self.map_spawn)
+        centers, sizes_list = [], []
+        for info in parser.start_nodes_obs:
+            for node, size in zip(info[:-1], WALL_PIECES[info[-1]]):
+                centers.append(node)
+                sizes_list.append(size)
+        for node in parser.start_nodes_wall:
+            centers.append(node)
+            sizes_list.append(WALL_PIECES["box"][0])
+        return np.array(centers, dtype=np.float64).reshape(-1, 2), np.array(sizes_list, dtype=np.float64).reshape(-1, 2) / 2
+
+    @property
+    def content_hash(self) -> str:
+        """
+        地图、生成点地图以及出口坐标的哈希，用作磁盘缓存的键
+        """
+        return hash_arrays(self.map.astype(str), self.map_spawn.astype(str),
+                           np.array(self.exits, dtype=np.float64).reshape(-1, 2))
+
+    @property
+    def obstacle_field(self) -> ObstacleField:
+        """
+        静态障碍物的距离场，第一次使用时计算，并以地图内容的哈希为键缓存到磁盘
+        """
+        if self._obstacle_field is None:
+            resolution, k = ObstacleField.RESOLUTION, ObstacleField.K
+            key = hash_arrays(self.map.astype("U"), np.array([resolution, k]))
+
+            def build():
+                centers, halves = self.get_obstacle_nodes()
+                return ObstacleField.build(centers, halves, self.width, self.height, resolution, k).to_arrays()
+
+            self._obstacle_field = ObstacleField.from_arrays(load_or_build("obstacle_field", key, build), resolution)
+        return self._obstacle_field
+
     @property
     def width(self):
         return self.map.shape[0]
@@ -1,4 +1,7 @@
 import enum
+from typing import Iterable, Mapping
+
+
 
 
 def strf_now_time():
@@ -19,6 +22,74 @@ class ObjectType(enum.Enum):
     Sensor = 5
 
 
+class AgentArrayDict(Mapping):
+    """
+    以字典的形式(键为智能体id)访问按智能体排列的数组，取出的值是数组对应行的视图，
+    只在需要兼容PettingZoo的字典接口时才按键访问，批量推理时直接使用array
+    """
+
+    def __init__(self, agent_ids, array):
+        self.agent_ids = list(agent_ids)
+        self.array = array
+        self._index = {agent_id: i for i, agent_id in enumerate(self.agent_ids)}
+
+    def row(self, agent_id) -> int:
+        return self._index[agent_id]
+
+    def __getitem__(self, agent_id):
+        return self.array[self._index[agent_id]]
+
+    def __setitem__(self, agent_id, value):
+        self.array[self._index[agent_id]] = value
+
+    def __iter__(self):
+        return iter(self.agent_ids)
+
+    def __len__(self):
+        return len(self.agent_ids)
+
+
+class ActiveList:
+    """
+    保持插入顺序并支持O(1)删除的列表(基于dict)，用于保存尚未到达出口的行人，
+    迭代顺序与对list逐个调用remove后的顺序相同，但每次删除不需要线性查找与移动元素
+    """
+
+    def __init__(self, items: Iterable = ()):
+        self._items = dict.fromkeys(items)
+
+    def append(self, item):
+        self._items[item] = None
+
+    def extend(self, items: Iterable):
+        self._items.update(dict.fromkeys(items))
+
+    def remove(self, item):
+        try:
+            del self._items[item]
+        except KeyError:
+            raise ValueError("{} is not in ActiveList".format(item))
+
+    def clear(self):
+        self._items.clear()
+
+    def __getitem__(self, index):
+        # 需要复制一份列表，只用于兼容偶尔的下标访问
+        return list(self._items)[index]
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return "ActiveList({})".format(list(self._items))
+
+
 class FixtureInfo:
     def __init__(self, id: int, model: object, type: ObjectType):
         self.id = id
@@ -0,0 +1,104 @@
+from time import perf_counter_ns
+from typing import Dict
+
+import numpy as np
+
+# PedsMoveEnv.step的各个阶段，非数组化的子步中自驱动力的计算与施加在同一个循环里，都计入actions，
+# substeps为自适应子步(adaptive_substeps > 1)决定合并多少个tick时的邻居查询
+PHASES = ("actions", "substeps", "forces", "world_step", "contacts", "person_update", "group_update", "removal",
+          "handler", "render", "total")
+(ACTIONS, SUBSTEPS, FORCES, WORLD_STEP, CONTACTS, PERSON_UPDATE, GROUP_UPDATE, REMOVAL, HANDLER, RENDER,
+ TOTAL) = range(len(PHASES))
+
+
+class StepProfiler:
+    """
+    按阶段记录每个step耗时(perf_counter_ns)的环形缓冲区，每个step占预先分配的一行，
+    同一阶段在一个step内的多次耗时(例如每个子步)累加，只保留最近capacity个step。
+    lap(phase)将距上一次lap(或begin)的时间计入phase，因此各阶段之间不需要成对的开始与结束调用；
+    render可能在step之外调用，使用now与record单独计时，计入最近一个step
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.capacity = capacity
+        self.buffer = np.zeros([capacity, len(PHASES)], dtype=np.int64)
+        self.count = 0  # 已记录的step总数
+        self._row = self.buffer[0]
+        self._start = self._last = 0
+
+    def begin(self):
+        self._row = self.buffer[self.count % self.capacity]
+        self._row[:] = 0
+        self.count += 1
+        self._start = self._last = perf_counter_ns()
+
+    def lap(self, phase: int):
+        now = perf_counter_ns()
+        self._row[phase] += now - self._last
+        self._last = now
+
+    def now(self) -> int:
+        return perf_counter_ns()
+
+    def record(self, phase: int, start: int):
+        self._row[phase] += perf_counter_ns() - start
+
+    def end(self):
+        self._row[TOTAL] += perf_counter_ns() - self._start
+
+    def records(self) -> np.ndarray:
+        """
+        :return: 最近的记录，形状为(step数, 阶段数)，按时间先后排列
+        """
+        if self.count <= self.capacity:
+            return self.buffer[:self.count].copy()
+        head = self.count % self.capacity
+        return np.concatenate([self.buffer[head:], self.buffer[:head]])
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: 每个阶段在最近的step中的耗时统计(微秒)与占step总耗时的比例，
+                 other为step中不属于任何阶段的部分(例如构造返回值)，render不计入step总耗时
+        """
+        records = self.records()
+        if len(records) == 0:
+            return {}
+        total = max(int(records[:, TOTAL].sum()), 1)
+        columns = {name: records[:, i] for i, name in enumerate(PHASES)}
+        columns["other"] = records[:, TOTAL] - records[:, :RENDER].sum(axis=1)
+        result = {}
+        for name, values in columns.items():
+            us = values / 1e3
+            result[name] = {"mean_us": float(us.mean()), "p50_us": float(np.percentile(us, 50)),
+                            "p95_us": float(np.percentile(us, 95)), "max_us": float(us.max()),
+                            "share": float(values.sum() / total)}
+        result["steps"] = {"count": len(records)}
+        return result
+
+
+class NullProfiler:
+    """
+    关闭性能分析时使用，所有方法都不做任何事
+    """
+    count = 0
+
+    def begin(self):
+        pass
+
+    def lap(self, phase: int):
+        pass
+
+    def now(self) -> int:
+        return 0
+
+    def record(self, phase: int, start: int):
+        pass
+
+    def end(self):
+        pass
+
+    def records(self) -> np.ndarray:
+        return np.zeros([0, len(PHASES)], dtype=np.int64)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {}
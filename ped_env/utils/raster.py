@@ -0,0 +1,152 @@
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from ped_env.utils.colors import ColorWhite
+
+
+def rgb_to_gray(rgb: np.ndarray) -> np.ndarray:
+    """
+    与cv2.cvtColor(COLOR_RGB2GRAY)相同的定点数灰度化: 0.299R + 0.587G + 0.114B，四舍五入
+    """
+    weights = np.asarray(rgb).astype(np.int64) * np.array([4899, 9617, 1868])
+    return ((weights.sum(axis=-1) + 8192) >> 14).astype(np.uint8)
+
+
+@lru_cache(maxsize=None)
+def disc_offsets(radius: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    pygame.draw.circle填充圆所覆盖的像素相对圆心的偏移，使用与pygame相同的中点画圆算法，
+    因此与pygame的渲染结果逐像素一致
+    :param radius: 整数半径(像素)
+    :return: x与y方向的偏移数组
+    """
+    if radius < 1:
+        return np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64)
+    mask = np.zeros([2 * radius, 2 * radius], dtype=bool)  # 索引为[x, y]，圆心位于(radius, radius)
+    if radius == 1:
+        mask[:] = True
+    else:
+        def line(x1, x2, y):
+            mask[x1 + radius:x2 + radius + 1, y + radius] = True
+
+        f, ddf_x, ddf_y = 1 - radius, 0, -2 * radius
+        x, y = 0, radius
+        while x < y:
+            if f >= 0:
+                line(-x, x - 1, y - 1)
+                line(-x, x - 1, -y)
+                y -= 1
+                ddf_y += 2
+                f += ddf_y
+            x += 1
+            ddf_x += 2
+            f += ddf_x + 1
+            line(-y, y - 1, x - 1)
+            line(-y, y - 1, -x)
+    dx, dy = np.nonzero(mask)
+    return dx - radius, dy - radius
+
+
+class Rasterizer:
+    """
+    不依赖pygame的渲染后端，输出与PedsMoveEnv._render的rgb_array/gray_array模式相同(索引为[x, y])：
+    墙、障碍物与出口只在创建时光栅化一次作为背景，每次渲染先将背景复制到复用的缓冲区，
+    再用预先计算的圆盘偏移把行人批量写入，灰度模式直接在单通道上绘制，不需要再转换颜色
+    """
+
+    def __init__(self, width: int, height: int, scale: float, statics: Sequence):
+        """
+        :param width: 图像宽度(像素)
+        :param height: 图像高度(像素)
+        :param scale: 物理坐标与像素坐标的放大比例
+        :param statics: 按绘制顺序排列的静态物体(BoxWall)
+        """
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.background = {"rgb_array": np.empty([width, height, 3], dtype=np.uint8)}
+        self.background["rgb_array"][:] = ColorWhite
+        for ele in statics:
+            # 与pygame.draw.rect相同，左上角与宽高都截断为整数
+            x = int((ele.getX - ele.width / 2) * scale)
+            y = int((ele.getY - ele.height / 2) * scale)
+            w, h = int(ele.width * scale), int(ele.height * scale)
+            self.background["rgb_array"][max(x, 0):max(x + w, 0), max(y, 0):max(y + h, 0)] = ele.color[:3]
+        self.background["gray_array"] = rgb_to_gray(self.background["rgb_array"])
+        self.buffer = {mode: np.empty_like(bg) for mode, bg in self.background.items()}
+
+    def render(self, positions: np.ndarray, radii: np.ndarray, colors: np.ndarray, mode: str = "rgb_array"):
+        """
+        :param positions: 形状为(N, 2)的行人物理坐标，按绘制顺序排列(后绘制的覆盖先绘制的)
+        :param radii: 形状为(N,)的行人半径(米)
+        :param colors: 形状为(N, 3)的行人颜色
+        :param mode: rgb_array或gray_array
+        :return: 复用的缓冲区，下一次以相同的mode渲染时会被覆盖
+        """
+        out = self.buffer[mode]
+        np.copyto(out, self.background[mode])
+        if len(positions) == 0:
+            return out
+        centers = np.trunc(np.asarray(positions, dtype=np.float64) * self.scale).astype(np.int64)
+        radii = np.trunc(np.asarray(radii, dtype=np.float64) * self.scale).astype(np.int64)
+        colors = np.asarray(colors, dtype=np.int64)
+        values = colors[:, :3] if mode == "rgb_array" else rgb_to_gray(colors)
+        for radius in np.unique(radii):
+            rows = np.flatnonzero(radii == radius)
+            dx, dy = disc_offsets(int(radius))
+            xs = (centers[rows, 0:1] + dx).ravel()
+            ys = (centers[rows, 1:2] + dy).ravel()
+            owner = np.repeat(rows, len(dx))
+            inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+            out[xs[inside], ys[inside]] = values[owner[inside]]
+        return out
+
+
+def rasterize_boxes(centers: np.ndarray, halves: np.ndarray, shape: Tuple[int, int], cell_size: float,
+                    values: np.ndarray = None, fill=0) -> np.ndarray:
+    """
+    将轴对齐矩形光栅化到格子边长为cell_size的网格上，与矩形有重叠的格子都会被填充(细的墙也不会消失)
+    :param centers: 形状为(M, 2)的矩形中心
+    :param halves: 形状为(M, 2)的半宽与半高
+    :param shape: 网格的形状(x方向格子数, y方向格子数)
+    :param values: 形状为(M,)的填充值，默认为1，后面的矩形覆盖前面的矩形
+    :return: 形状为shape的网格
+    """
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+    halves = np.asarray(halves, dtype=np.float64).reshape(-1, 2)
+    values = np.ones([len(centers)]) if values is None else np.asarray(values)
+    grid = np.full(shape, fill, dtype=values.dtype)
+    low = np.clip(np.floor((centers - halves) / cell_size + 1e-9), 0, shape).astype(np.int64)
+    high = np.clip(np.ceil((centers + halves) / cell_size - 1e-9), 0, shape).astype(np.int64)
+    for (x0, y0), (x1, y1), value in zip(low, high, values):
+        grid[x0:x1, y0:y1] = value
+    return grid
+
+
+def greedy_rectangles(mask: np.ndarray, grow_x: bool = True, grow_y: bool = True) -> List[Tuple[int, int, int, int]]:
+    """
+    贪心地将网格中为True的格子合并为尽量少的轴对齐矩形：按先列后行的顺序找到第一个未覆盖的格子，
+    先沿x方向尽量延伸，再沿y方向逐行延伸直到下一行不完整
+    :param mask: 形状为(W, H)的布尔网格(索引为[x, y])
+    :param grow_x: 是否允许沿x方向合并
+    :param grow_y: 是否允许沿y方向合并
+    :return: 矩形列表(x0, y0, x1, y1)，覆盖[x0, x1) * [y0, y1)的格子
+    """
+    remaining = np.array(mask, dtype=bool)
+    rects = []
+    for j, i in np.argwhere(remaining.T):
+        if not remaining[i, j]:
+            continue
+        i1 = i + 1
+        if grow_x:
+            while i1 < remaining.shape[0] and remaining[i1, j]:
+                i1 += 1
+        j1 = j + 1
+        if grow_y:
+            while j1 < remaining.shape[1] and remaining[i:i1, j1].all():
+                j1 += 1
+        remaining[i:i1, j:j1] = False
+        rects.append((int(i), int(j), int(i1), int(j1)))
+    return rects
@@ -0,0 +1,104 @@
+import numpy as np
+
+
+class SpatialHash:
+    """
+    均匀网格的空间哈希(cell list)，每个step重建一次，
+    之后的近邻查询只需要访问查询点附近的几个格子，代价只与局部密度有关
+    """
+
+    def __init__(self, cell_size: float):
+        self.cell_size = float(cell_size)
+        self.positions = np.zeros([0, 2])
+        self._order = np.zeros([0], dtype=np.int64)
+        self._sorted_keys = np.zeros([0], dtype=np.int64)
+
+    @staticmethod
+    def _key(cx, cy):
+        # 将二维格子坐标编码为一个整数，地图坐标为非负且远小于2^20
+        return (cx + (1 << 20)) * (1 << 21) + (cy + (1 << 20))
+
+    def _cells(self, positions):
+        return np.floor(positions / self.cell_size).astype(np.int64)
+
+    def build(self, positions: np.ndarray):
+        """
+        :param positions: 形状为(N, 2)的坐标
+        """
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        cells = self._cells(self.positions)
+        keys = self._key(cells[:, 0], cells[:, 1])
+        self._order = np.argsort(keys, kind="stable")
+        self._sorted_keys = keys[self._order]
+        return self
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _candidates(self, queries, reach):
+        """
+        :return: (查询编号, 候选点编号)两个一维数组，包含查询点周围reach米内所有格子中的点，
+                 按(格子偏移, 查询编号)的顺序排列
+        """
+        q_cells = self._cells(queries)
+        m = int(np.ceil(reach / self.cell_size))
+        offsets = np.arange(-m, m + 1)
+        dx = np.repeat(offsets, len(offsets))[:, None]
+        dy = np.tile(offsets, len(offsets))[:, None]
+        # 所有格子偏移与查询点一起做一次searchsorted
+        keys = self._key(q_cells[None, :, 0] + dx, q_cells[None, :, 1] + dy).ravel()
+        start = np.searchsorted(self._sorted_keys, keys, side="left")
+        end = np.searchsorted(self._sorted_keys, keys, side="right")
+        counts = end - start
+        total = int(counts.sum())
+        if total == 0:
+            return np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64)
+        flat = np.repeat(np.arange(len(keys)), counts)
+        offset = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        return flat % len(queries), self._order[start[flat] + offset]
+
+    def query_knn(self, queries: np.ndarray, k: int, half_width: float, max_distance: float = np.inf,
+                  exclude: np.ndarray = None):
+        """
+        批量查询每个点在以其为中心、半边长为half_width的正方形内距离最近的k个点
+        :param queries: 形状为(Q, 2)的查询坐标
+        :param k: 最多返回的近邻个数
+        :param half_width: 正方形区域的半边长
+        :param max_distance: 额外的距离上限
+        :param exclude: 形状为(Q,)，每个查询需要排除的点编号(例如自身)，-1表示不排除
+        :return: 形状为(Q, k)的近邻编号(不足时为-1)与对应的距离(不足时为inf)，按距离升序排列
+        """
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 2)
+        indices = np.full([len(queries), k], -1, dtype=np.int64)
+        distances = np.full([len(queries), k], np.inf)
+        if len(queries) == 0 or len(self.positions) == 0 or k <= 0:
+            return indices, distances
+        q, p = self._candidates(queries, half_width)
+        diff = self.positions[p] - queries[q]
+        dis = (diff[:, 0] ** 2 + diff[:, 1] ** 2) ** 0.5
+        keep = (np.abs(diff[:, 0]) <= half_width) & (np.abs(diff[:, 1]) <= half_width) & (dis <= max_distance)
+        if exclude is not None:
+            keep &= p != np.asarray(exclude)[q]
+        q, p, dis = q[keep], p[keep], dis[keep]
+        order = np.lexsort((p, dis, q))
+        q, p, dis = q[order], p[order], dis[order]
+        # 每个查询内部的名次
+        first = np.searchsorted(q, np.arange(len(queries)), side="left")
+        rank = np.arange(len(q)) - first[q]
+        top = rank < k
+        indices[q[top], rank[top]] = p[top]
+        distances[q[top], rank[top]] = dis[top]
+        return indices, distances
+
+    def query_pairs(self, radius: float):
+        """
+        :return: 所有距离小于radius的点对(i, j)，i < j
+        """
+        if len(self.positions) == 0:
+            return np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64)
+        q, p = self._candidates(self.positions, radius)
+        keep = q < p
+        q, p = q[keep], p[keep]
+        diff = self.positions[p] - self.positions[q]
+        keep = diff[:, 0] ** 2 + diff[:, 1] ** 2 < radius ** 2
+        return q[keep], p[keep]
@@ -0,0 +1,207 @@
+import multiprocessing as mp
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+from gym.spaces import Discrete
+
+from ped_env.envs import PedsMoveEnv
+
+
+def _shared_array(ctx, shape, dtype):
+    """
+    :return: (共享内存, 形状, 类型)，共享内存在创建子进程时传入，子进程中用_as_array还原为数组
+    """
+    dtype = np.dtype(dtype)
+    return ctx.RawArray("b", max(int(np.prod(shape)) * dtype.itemsize, 1)), tuple(shape), dtype.str
+
+
+def _as_array(spec) -> np.ndarray:
+    raw, shape, dtype = spec
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _recv(remote):
+    """
+    接收子进程的回复，子进程发回的异常在主进程中抛出
+    """
+    result = remote.recv()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def _worker(remote, parent_remote, env_fn: Callable[[], PedsMoveEnv], buffers: Dict, index: int, num_envs: int):
+    """
+    子进程：观察、奖励与是否结束直接写入共享内存中属于第index个环境的部分，管道只用来传递命令与info。
+    reset指定了种子seed + index时，第k次自动重置使用seed + index + k * num_envs，各个环境的种子互不重复
+    """
+    parent_remote.close()
+    arrays = {name: _as_array(spec)[index] for name, spec in buffers.items()}
+    env = env_fn()
+    agents = list(env.possible_agents)
+    discrete = isinstance(env.action_spaces[agents[0]], Discrete)
+    if env.array_output:
+        # 处理器的step_into直接将观察与奖励写入共享内存
+        env.bind_output_buffers(arrays["obs"], arrays["rewards"])
+
+    def write(name, values):
+        if getattr(values, "array", None) is arrays[name]:
+            return
+        for i, agent in enumerate(agents):
+            arrays[name][i] = values[agent]
+
+    seed, episodes = None, 0
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                actions = arrays["actions"]
+                action = {agent: int(actions[i]) if discrete else actions[i].copy() for i, agent in enumerate(agents)}
+                obs, rewards, dones, truncated, info = env.step(action)
+                write("obs", obs)
+                write("rewards", rewards)
+                write("dones", dones)
+                write("truncated", truncated)
+                if np.all(arrays["dones"]) or np.all(arrays["truncated"]):
+                    # 自动重置，结束时的观察放在info中，奖励与是否结束保留最后一步的值
+                    info = dict(info, final_observation=arrays["obs"].copy())
+                    episodes += 1
+                    write("obs", env.reset(seed=None if seed is None else seed + episodes * num_envs))
+                remote.send(info)
+            elif cmd == "reset":
+                seed, episodes = data, 0
+                write("obs", env.reset(seed=data))
+                arrays["rewards"][:] = 0.0
+                arrays["dones"][:] = False
+                arrays["truncated"][:] = False
+                remote.send(None)
+            elif cmd == "get_attr":
+                remote.send(getattr(env, data))
+            elif cmd == "close":
+                env.close()
+                remote.close()
+                break
+            else:
+                # 未知的命令不结束子进程，将异常发回主进程抛出
+                remote.send(ValueError(u"未知的命令{}!".format(cmd)))
+    except KeyboardInterrupt:
+        pass
+
+
+class PedsMoveVecEnv:
+    """
+    在num_envs个子进程中并行运行PedsMoveEnv，所有环境的观察、奖励、是否结束与动作都保存在共享内存的数组中，
+    形状分别为(num_envs, agent_count, *观察形状)、(num_envs, agent_count)与(num_envs, agent_count, *动作形状)，
+    子进程直接读写这些数组，管道中只传递命令与info，不需要序列化观察。
+    某个环境的所有智能体结束(或被截断)时自动重置，此时返回的是新回合的观察，结束时的观察放在info["final_observation"]中。
+    环境使用array_output=True创建时，观察与奖励由处理器直接写入共享内存，连子进程中的复制也可以省去
+    """
+
+    def __init__(self, env_fns: Sequence[Callable[[], PedsMoveEnv]], context: Optional[str] = None,
+                 copy_obs: bool = True):
+        """
+        :param env_fns: 创建环境的函数列表，使用spawn方式创建进程时必须可以被pickle(例如functools.partial)
+        :param context: multiprocessing的进程启动方式，默认使用平台的默认方式
+        :param copy_obs: 为False时返回共享内存中观察数组的视图，它会在下一次step或reset时被覆盖
+        """
+        ctx = mp.get_context(context)
+        self.num_envs = len(env_fns)
+        self.copy_obs = copy_obs
+        # 在主进程中创建一个环境以获得观察与动作空间，共享内存需要在启动子进程前分配
+        dummy = env_fns[0]()
+        self.possible_agents: List[str] = list(dummy.possible_agents)
+        self.observation_space = dummy.observation_spaces[self.possible_agents[0]]
+        self.action_space = dummy.action_spaces[self.possible_agents[0]]
+        dummy.close()
+
+        k, a = self.num_envs, len(self.possible_agents)
+        if isinstance(self.action_space, Discrete):
+            action_shape, action_dtype = (), np.int64
+        else:
+            action_shape, action_dtype = self.action_space.shape, np.float32
+        self._buffers = {
+            "obs": _shared_array(ctx, (k, a) + self.observation_space.shape, self.observation_space.dtype),
+            "rewards": _shared_array(ctx, (k, a), np.float32),
+            "dones": _shared_array(ctx, (k, a), np.bool_),
+            "truncated": _shared_array(ctx, (k, a), np.bool_),
+            "actions": _shared_array(ctx, (k, a) + action_shape, action_dtype),
+        }
+        self.obs_buffer = _as_array(self._buffers["obs"])
+        self.reward_buffer = _as_array(self._buffers["rewards"])
+        self.done_buffer = _as_array(self._buffers["dones"])
+        self.truncated_buffer = _as_array(self._buffers["truncated"])
+        self.action_buffer = _as_array(self._buffers["actions"])
+
+        self.waiting = False
+        self.closed = False
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(self.num_envs)])
+        self.ps = [ctx.Process(target=_worker, args=(work_remote, remote, env_fn, self._buffers, i,
+                                                     self.num_envs))
+                   for i, (work_remote, remote, env_fn) in enumerate(zip(self.work_remotes, self.remotes, env_fns))]
+        for p in self.ps:
+            p.daemon = True  # 主进程崩溃时子进程不会一直挂起
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+
+    def __len__(self):
+        return self.num_envs
+
+    def _obs(self):
+        return self.obs_buffer.copy() if self.copy_obs else self.obs_buffer
+
+    def reset_async(self, seed: Optional[int] = None):
+        """
+        :param seed: 不为None时第i个环境使用seed + i作为随机种子，之后自动重置的种子由它派生
+        """
+        for i, remote in enumerate(self.remotes):
+            remote.send(("reset", None if seed is None else seed + i))
+        self.waiting = True
+
+    def reset_wait(self) -> np.ndarray:
+        for remote in self.remotes:
+            _recv(remote)
+        self.waiting = False
+        return self._obs()
+
+    def reset(self, seed: Optional[int] = None) -> np.ndarray:
+        self.reset_async(seed)
+        return self.reset_wait()
+
+    def step_async(self, actions):
+        """
+        :param actions: 形状为(num_envs, agent_count, *动作形状)的动作，写入共享内存后通知子进程
+        """
+        np.copyto(self.action_buffer, np.asarray(actions).reshape(self.action_buffer.shape), casting="unsafe")
+        for remote in self.remotes:
+            remote.send(("step", None))
+        self.waiting = True
+
+    def step_wait(self):
+        """
+        :return: 观察(num_envs, agent_count, ...)、奖励、是否结束、是否被截断(num_envs, agent_count)与info列表
+        """
+        infos = [_recv(remote) for remote in self.remotes]
+        self.waiting = False
+        return self._obs(), self.reward_buffer.copy(), self.done_buffer.copy(), self.truncated_buffer.copy(), infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def get_attr(self, name: str) -> List:
+        for remote in self.remotes:
+            remote.send(("get_attr", name))
+        return [_recv(remote) for remote in self.remotes]
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for p in self.ps:
+            p.join()
+        self.closed = True
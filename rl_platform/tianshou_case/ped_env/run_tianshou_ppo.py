@@ -178,7 +178,8 @@ train_if = False  # 是否采用test模式，即在icm模式下采用奖励模
 
 def create_peds_move_env(train_if):
     return FrameStackWrapper(PedsMoveEnv(train_map, person_num=agent_num_map, group_size=(1, 1), random_init_mode=True,
-                                            maxStep=max_step, disable_reward=train_if, person_handler=PedsVisionRLHandler))
+                                            maxStep=max_step, disable_reward=train_if, person_handler=PedsVisionRLHandler,
+                                            renderer="numpy"))
 
 
 def _get_env():
@@ -1,5 +1,3 @@
-import copy
-from collections import deque, defaultdict
 from typing import Optional
 
 import gym
@@ -66,13 +64,15 @@ class MarioRewardWrapper(gym.RewardWrapper):
 class FrameStackWrapper:
     """
     Overview:
-       Stack latest n frames(usually 4 in Atari) as one observation.
+       Stack latest n frames(usually 4 in Atari) as one observation. All frames live in one preallocated \
+       ring buffer of shape ``(agents, 2 * n_frames + n_frames - 1, *frame_shape)``, new frames are written \
+       in place and the returned observations are contiguous views of it, so no frame is copied more than twice.
     Interface:
         ``__init__``, ``reset``, ``step``, ``_get_ob``, ``new_shape``
     Properties:
         - env (:obj:`gym.Env`): the environment to wrap.
         - n_frame (:obj:`int`): the number of frames to stack.
-        - ``observation_space``, ``frames``
+        - ``observation_spaces``, ``frames``
     """
 
     def __init__(self, env, n_frames=4):
@@ -86,7 +86,12 @@ class FrameStackWrapper:
         self.venv = env
         self._metadata: Optional[dict] = None
         self.n_frames = n_frames
-        self.frames = defaultdict(lambda: deque([], maxlen=n_frames))
+        # 环形缓冲区的容量为2 * n_frames，返回的视图在之后的n_frames - 1次step内都不会被覆盖，
+        # 前n_frames - 1个位置在末尾再保存一份，使得任意连续n_frames帧在内存中都是连续的
+        self.capacity = 2 * n_frames
+        self.frames: Optional[np.ndarray] = None  # 第一次reset时按照观察的形状与类型分配
+        self._count = 0  # 已写入的帧数
+        self._agent_index = {agentid: i for i, agentid in enumerate(env.possible_agents)}
         self.render_mode = "rgb_array"
         obs_space = list(env.observation_spaces.values())[0]
 
@@ -95,20 +100,35 @@ class FrameStackWrapper:
             agentid: gym.spaces.Box(
                 low=np.min(obs_space.low), high=np.max(obs_space.high), shape=shape, dtype=obs_space.dtype
             ) for agentid in self.venv.possible_agents}
-        for agentid in self.venv.possible_agents:
-            self.frames[agentid] = deque([], maxlen=n_frames)
+
+    def _write(self, obs):
+        """
+        Overview:
+            Write one frame of every agent into the ring buffer in place.
+        """
+        pos = self._count % self.capacity
+        for agentid, i in self._agent_index.items():
+            self.frames[i, pos] = obs[agentid]
+            if pos < self.n_frames - 1:
+                self.frames[i, pos + self.capacity] = obs[agentid]
+        self._count += 1
 
     def reset(self, seed=None, options=None):
         """
         Overview:
-            Resets the state of the environment and append new observation to frames
+            Resets the state of the environment and fill the frame window with the first observation
         Returns:
             - ``self._get_ob()``: observation
         """
         obs = self.venv.reset(seed=seed)
-        for _ in range(self.n_frames):
-            for agentid in self.venv.possible_agents:
-                self.frames[agentid].extend(copy.copy(obs[agentid]) for _ in range(self.n_frames))
+        first = np.asarray(obs[self.venv.possible_agents[0]])
+        if self.frames is None or self.frames.shape[2:] != first.shape or self.frames.dtype != first.dtype:
+            self.frames = np.empty((len(self._agent_index), self.capacity + self.n_frames - 1) + first.shape,
+                                   dtype=first.dtype)
+        # 开头的n_frames个位置都是第一帧
+        for agentid, i in self._agent_index.items():
+            self.frames[i, :self.n_frames] = obs[agentid]
+        self._count = self.n_frames
         return self._get_ob()
 
     def step(self, action):
@@ -128,19 +148,17 @@ class FrameStackWrapper:
         """
 
         obs, reward, done, truncated, info = self.venv.step(action)
-        for agentid in self.venv.possible_agents:
-            self.frames[agentid].append(obs[agentid])
+        self._write(obs)
         return self._get_ob(), reward, done, truncated, info
 
     def _get_ob(self):
         """
         Overview:
-            The original wrapper use `LazyFrames` but since we use np buffer, it has no effect
+            Return views of the latest ``n_frames`` frames of every agent, oldest first. The views stay valid \
+            for the next ``n_frames - 1`` steps, copy them if they need to be kept longer.
         """
-        obs = {}
-        for agentid in self.venv.possible_agents:
-            obs[agentid] = np.stack(self.frames[agentid], axis=0)
-        return obs
+        start = (self._count - self.n_frames) % self.capacity
+        return {agentid: self.frames[i, start:start + self.n_frames] for agentid, i in self._agent_index.items()}
 
     @property
     def metadata(self) -> dict: